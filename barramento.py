@@ -0,0 +1,350 @@
+import collections
+import socket
+import threading
+import time
+import zlib
+
+import registros
+from protocolo import FORMAT, JSON_CODEC, DecodeError, FrameDecoder, FrameTooLargeError, frameBytes
+
+RECONNECT_INTERVAL = 1.0 # tempo, em segundos, entre tentativas de conexao com um no fora do ar
+
+HELLO_TIMEOUT = 5.0 # tempo maximo, em segundos, para um no que se conectou se identificar
+
+PEER_TIMEOUT = 5.0 # tempo, em segundos, apos o inicio ate que os nos que ainda nao se conectaram sejam considerados fora do ar
+
+log = registros.getLogger('barramento')
+
+class Peer:
+    '''Canal com outro no do barramento: uma fila de saida esvaziada por uma thread escritora,
+    como nas conexoes de clientes, e uma thread leitora que entrega ao barramento as mensagens
+    recebidas. A fila nao tem limite, pois as mensagens entre nos (presenca, reservas de nomes)
+    nao podem ser descartadas'''
+
+    def __init__(self, bus, node, socket, decoder=None):
+        self.bus = bus
+        self.node = node
+        self.socket = socket
+
+        # buffer de recebimento, que pode ja conter mensagens recebidas junto com a identificacao do no
+        self.decoder = decoder if decoder is not None else FrameDecoder()
+
+        # mensagens (ja com header) aguardando envio ao outro no
+        self.outbound = collections.deque()
+
+        # protege a fila de saida, compartilhada entre quem publica e a thread escritora
+        self.condition = threading.Condition()
+
+        self.closed = False
+
+        # sinalizado quando a conexao com o outro no termina
+        self.done = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self.drainQueue, daemon=True).start()
+        threading.Thread(target=self.readMessages, daemon=True).start()
+
+    # enfileira a mensagem ja enquadrada 'frame' para envio ao outro no
+    def send(self, frame):
+        with self.condition:
+            if self.closed:
+                return False
+
+            self.outbound.append(frame)
+
+            if len(self.outbound) == 1:
+                self.condition.notify()
+
+        return True
+
+    def drainQueue(self):
+        '''Loop da thread escritora: envia de uma vez tudo o que estiver na fila'''
+
+        while True:
+            with self.condition:
+                while not self.outbound and not self.closed:
+                    self.condition.wait()
+
+                if self.closed:
+                    return
+
+                data = b''.join(self.outbound)
+                self.outbound.clear()
+
+            try:
+                self.socket.sendall(data)
+            except OSError:
+                self.close()
+                return
+
+    def readMessages(self):
+        '''Loop da thread leitora: decodifica as mensagens do outro no e as entrega ao barramento;
+        ao fim da conexao, avisa o barramento que o no saiu'''
+
+        try:
+            while True:
+                for frame in self.decoder.frames():
+                    try:
+                        msgObject = JSON_CODEC.decode(frame)
+                    except DecodeError:
+                        log.warning('Falha na decodificacao da mensagem do no', node=self.node)
+                        continue
+
+                    self.bus.deliver(self, msgObject)
+
+                if not self.decoder.recvFrom(self.socket):
+                    break
+
+        except (OSError, FrameTooLargeError):
+            pass
+
+        self.close()
+        self.bus.peerDown(self)
+        self.done.set()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+        try:
+            self.socket.close()
+        except OSError:
+            pass
+
+class Bus:
+    '''Barramento entre os nos do servidor, ligados dois a dois: cada no tem um canal (Peer) com
+    cada um dos demais. Os nos podem ser processos da mesma maquina, ligados por pares de
+    sockets criados antes de inicia-los (addPeer), ou servidores em maquinas diferentes,
+    ligados por TCP (listen e connectTo): cada no aceita conexoes dos nos de identificador
+    maior e se conecta aos de identificador menor, tentando de novo sempre que a conexao cai.
+    As mensagens sao objetos codificados em JSON, com o mesmo enquadramento das mensagens dos
+    clientes.
+
+    Cada canal estabelecido e repassado a 'onPeerUp(peer)', que deve registra-lo (register)
+    para que ele passe a receber as publicacoes; as mensagens recebidas sao repassadas a
+    'onMessage(peer, msgObject)' e a queda de um no a 'onPeerDown(peer)'. Todas sao chamadas
+    por meio da funcao 'dispatch': por padrao, na propria thread que as origina (modo
+    threads); no modo asyncio, 'dispatch' as agenda no loop de eventos, que e o unico a
+    manipular as conexoes dos clientes'''
+
+    def __init__(self, nodeId, size):
+
+        # identificador deste no (0 a size - 1) e quantidade de nos
+        self.nodeId = nodeId
+        self.size = size
+
+        # identificador do no -> canal com ele, para os canais registrados
+        self.peers = {}
+
+        # protege as alteracoes do dicionario de canais
+        self.lock = threading.Lock()
+
+        # nos cuja conexao caiu e ainda nao foi restabelecida, desconsiderados na escolha do dono de
+        # cada nome; substituido (e nao alterado) a cada mudanca, para ser lido sem o lock
+        self.down = frozenset()
+
+        # identificador do no -> socket ja conectado a ele (processos da mesma maquina)
+        self.channels = {}
+
+        # socket onde este no aceita as conexoes dos demais, e endereco TCP dos nos aos quais ele se conecta
+        self.listener = None
+        self.addresses = {}
+
+        self.onMessage = None
+        self.onPeerUp = None
+        self.onPeerDown = None
+        self.dispatch = lambda function, *args: function(*args)
+
+    # adiciona o canal com o no 'node', a partir de um socket ja conectado a ele
+    def addPeer(self, node, socket):
+        self.channels[node] = socket
+
+    def listen(self, address):
+        '''Passa a aceitar conexoes dos demais nos no endereco TCP address (host, porta)'''
+
+        self.listener = socket.create_server(address)
+
+    # registra o endereco TCP (host, porta) do no 'node', ao qual este no se conecta
+    def connectTo(self, node, address):
+        self.addresses[node] = address
+
+    def start(self, onMessage, onPeerUp, onPeerDown, dispatch=None):
+        '''Comeca a estabelecer os canais com os outros nos e a receber suas mensagens'''
+
+        self.onMessage = onMessage
+        self.onPeerUp = onPeerUp
+        self.onPeerDown = onPeerDown
+
+        if dispatch is not None:
+            self.dispatch = dispatch
+
+        for node, channel in self.channels.items():
+            self.attach(node, channel)
+
+        if self.listener is not None:
+            threading.Thread(target=self.acceptPeers, daemon=True).start()
+
+            # os nos que se conectam a este e ainda nao o fizeram sao considerados fora do ar
+            timer = threading.Timer(PEER_TIMEOUT, lambda: [self.markDown(node) for node in range(self.size)])
+            timer.daemon = True
+            timer.start()
+
+        for node, address in self.addresses.items():
+            threading.Thread(target=self.dialPeer, args=(node, address), daemon=True).start()
+
+    def attach(self, node, socket, decoder=None):
+        '''Cria o canal com o no 'node' sobre um socket conectado a ele e o repassa a onPeerUp
+        Saida: o canal criado'''
+
+        peer = Peer(self, node, socket, decoder)
+        self.dispatch(self.onPeerUp, peer)
+
+        return peer
+
+    def register(self, peer):
+        '''Passa a usar o canal 'peer' nas publicacoes e comeca a receber suas mensagens; um canal
+        anterior com o mesmo no (cuja queda ainda nao foi percebida) e encerrado'''
+
+        with self.lock:
+            previous = self.peers.get(peer.node)
+            self.peers[peer.node] = peer
+            self.down = self.down - {peer.node}
+
+        if previous is not None:
+            previous.close()
+
+        peer.start()
+
+    def acceptPeers(self):
+        '''Loop da thread que aceita as conexoes dos demais nos'''
+
+        while True:
+            try:
+                peerSocket, address = self.listener.accept()
+            except OSError:
+                return
+
+            threading.Thread(target=self.greetPeer, args=(peerSocket,), daemon=True).start()
+
+    def greetPeer(self, peerSocket):
+        '''Recebe a identificacao (peer-hello) de um no que se conectou e cria o canal com ele'''
+
+        decoder = FrameDecoder()
+        peerSocket.settimeout(HELLO_TIMEOUT)
+
+        try:
+            frame = decoder.nextFrame()
+
+            while frame is None:
+                if not decoder.recvFrom(peerSocket):
+                    raise ConnectionError('conexao encerrada antes da identificacao')
+
+                frame = decoder.nextFrame()
+
+            hello = JSON_CODEC.decode(frame)
+            node = hello.get('node')
+
+            if hello.get('type') != 'peer-hello' or node not in range(self.size) or node == self.nodeId:
+                raise ValueError(f'identificacao invalida: {hello}')
+
+        except (OSError, ValueError, FrameTooLargeError) as e:
+            log.warning('Conexao de no recusada', error=e)
+            peerSocket.close()
+            return
+
+        peerSocket.settimeout(None)
+        peerSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        self.attach(node, peerSocket, decoder)
+
+    def dialPeer(self, node, address):
+        '''Loop da thread que mantem a conexao com o no 'node', restabelecendo-a quando ela cai'''
+
+        while True:
+            try:
+                peerSocket = socket.create_connection(address)
+            except OSError:
+                self.markDown(node)
+                time.sleep(RECONNECT_INTERVAL)
+                continue
+
+            peerSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            try:
+                peerSocket.sendall(frameBytes(JSON_CODEC.encode({"type": "peer-hello", "node": self.nodeId})))
+            except OSError:
+                peerSocket.close()
+                time.sleep(RECONNECT_INTERVAL)
+                continue
+
+            peer = self.attach(node, peerSocket)
+
+            # aguarda a queda da conexao para tentar de novo
+            peer.done.wait()
+            time.sleep(RECONNECT_INTERVAL)
+
+    # chamada pela thread leitora de um canal para cada mensagem recebida
+    def deliver(self, peer, msgObject):
+        self.dispatch(self.onMessage, peer, msgObject)
+
+    # chamada pela thread leitora de um canal quando a conexao com o outro no termina; a queda de
+    # um canal ja substituido por outro mais novo nao e repassada
+    def peerDown(self, peer):
+        with self.lock:
+            if self.peers.get(peer.node) is not peer:
+                return
+
+            del self.peers[peer.node]
+            self.down = self.down | {peer.node}
+
+        self.dispatch(self.onPeerDown, peer)
+
+    # considera fora do ar o no 'node', com o qual nao ha canal registrado (nunca se conectou ou
+    # a reconexao falhou), ate que um canal com ele seja registrado
+    def markDown(self, node):
+        with self.lock:
+            if node != self.nodeId and node not in self.peers:
+                self.down = self.down | {node}
+
+    def send(self, node, msgObject):
+        '''Envia a mensagem 'msgObject' ao no 'node'
+        Saida: False caso nao haja conexao com esse no'''
+
+        peer = self.peers.get(node)
+
+        if peer is None:
+            return False
+
+        return peer.send(frameBytes(JSON_CODEC.encode(msgObject)))
+
+    def publish(self, msgObject, nodes=None):
+        '''Envia a mensagem 'msgObject', codificada uma unica vez, a todos os outros nos ou
+        apenas aos nos da lista nodes'''
+
+        if nodes is None:
+            peers = list(self.peers.values())
+        else:
+            peers = [self.peers.get(node) for node in nodes]
+            peers = [peer for peer in peers if peer is not None]
+
+        if not peers:
+            return
+
+        frame = frameBytes(JSON_CODEC.encode(msgObject))
+
+        for peer in peers:
+            peer.send(frame)
+
+    def owner(self, name):
+        '''Saida: o no responsavel por reservar o nome de usuario 'name': entre os nos que nao
+        cairam, o de maior peso para o nome (rendezvous hashing). Os nos concordam sobre o dono
+        enquanto concordam sobre quais nos cairam; a queda de um no muda apenas o dono dos nomes
+        dos quais ele era o dono. Um no que ainda nao se conectou continua sendo considerado (as
+        reservas nele falham) ate que a conexao com ele falhe ou, se e ele quem se conecta a
+        este, ate PEER_TIMEOUT segundos apos o inicio (markDown)'''
+
+        down = self.down
+        nodes = [node for node in range(self.size) if node not in down]
+
+        return max(nodes, key=lambda node: zlib.crc32(f'{node}:{name}'.encode(FORMAT)))
@@ -0,0 +1,386 @@
+import argparse
+import array
+import asyncio
+import json
+import os
+import random
+import resource
+import shlex
+import subprocess
+import sys
+import time
+
+from protocolo import CODECS, JSON_CODEC
+from sessao import AsyncChatClient, SessionError
+
+WRITE_BUFFER_SIZE = 64 * 1024 # bytes pendentes de envio, em cada conexao, a partir dos quais o usuario aguarda o envio
+
+MAX_SAMPLES = 1000000 # quantidade maxima de latencias guardadas (amostragem de reservatorio acima disso)
+
+MARK = 'bench ' # prefixo do texto das mensagens geradas, seguido do instante do envio
+
+class Samples:
+    '''Amostras de latencia, em segundos: todas ate MAX_SAMPLES e, acima disso, uma amostra
+    uniforme delas (amostragem de reservatorio), de modo que a memoria usada e limitada'''
+
+    def __init__(self, limit=MAX_SAMPLES):
+        self.values = array.array('d')
+        self.limit = limit
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+        if len(self.values) < self.limit:
+            self.values.append(value)
+        else:
+            position = random.randrange(self.count)
+
+            if position < self.limit:
+                self.values[position] = value
+
+    def summary(self):
+        '''Saida: dicionario com a quantidade, a media, os percentis p50, p99 e p999 e o maximo, em milissegundos'''
+
+        if not self.count:
+            return {"count": 0}
+
+        values = sorted(self.values)
+
+        def percentile(fraction):
+            return values[min(len(values) - 1, int(fraction * len(values)))] * 1000
+
+        return {
+            "count": self.count,
+            "mean": self.total / self.count * 1000,
+            "p50": percentile(0.50),
+            "p99": percentile(0.99),
+            "p999": percentile(0.999),
+            "max": self.max * 1000
+        }
+
+class Stats:
+    '''Contadores e latencias de toda a execucao, compartilhados pelos usuarios simulados'''
+
+    def __init__(self):
+        self.public = 0
+        self.private = 0
+        self.joins = 0
+        self.leaves = 0
+        self.errors = 0
+
+        # tempo entre o envio de uma mensagem e sua chegada a cada destinatario
+        self.latency = Samples()
+
+        # tempo entre o connection-request e o connection-response
+        self.joinLatency = Samples()
+
+        # so as mensagens enviadas durante a medicao sao contadas
+        self.measuring = False
+
+class SimulatedUser:
+    '''Usuario simulado: uma conexao com o servidor (sessao.AsyncChatClient), que entra no
+    bate-papo, envia mensagens publicas e privadas em intervalos aleatorios (distribuicao
+    exponencial, com media de 1 / 'rate' segundos) e, com a rotatividade habilitada, sai e volta
+    ao bate-papo'''
+
+    def __init__(self, bench, index):
+        self.bench = bench
+        self.name = f'bench-{index}'
+        self.room = f'sala-{index % bench.args.salas}'
+
+        self.client = AsyncChatClient(bench.args.host, bench.args.porta, bench.args.codec)
+        self.client.subscribe('chat-message', self.handleChatMessage)
+
+        # instante da ultima entrada no bate-papo: mensagens enviadas antes dele sao as mensagens
+        # recentes da sala, reenviadas na entrada, e nao entram na medicao
+        self.joinedAt = 0.0
+
+    async def connect(self):
+        await self.client.connect()
+
+    async def join(self):
+        '''Entra no bate-papo, na sala do usuario, e aguarda a resposta
+        Saida: True se o servidor aceitou a entrada'''
+
+        start = self.joinedAt = time.perf_counter()
+
+        try:
+            response = await self.client.join(self.name, self.room, self.bench.args.tempo_limite)
+        except SessionError:
+            response = None
+
+        if response is None or not response.get('success'):
+            self.bench.stats.errors += 1
+            return False
+
+        self.bench.stats.joinLatency.add(time.perf_counter() - start)
+        self.bench.stats.joins += 1
+
+        return True
+
+    async def leave(self):
+        '''Sai do bate-papo, mantendo a conexao, e aguarda a resposta
+        Saida: True se o servidor respondeu'''
+
+        try:
+            await self.client.leave(self.bench.args.tempo_limite)
+        except SessionError:
+            self.bench.stats.errors += 1
+            return False
+
+        self.bench.stats.leaves += 1
+
+        return True
+
+    def handleChatMessage(self, msgObject):
+        '''Registra a latencia das mensagens geradas pelo benchmark'''
+
+        stats = self.bench.stats
+        message = msgObject.get('message', '')
+
+        if not message.startswith(MARK):
+            return
+
+        sentAt = float(message[len(MARK):])
+
+        if stats.measuring and sentAt >= self.joinedAt:
+            stats.latency.add(time.perf_counter() - sentAt)
+
+    async def run(self, stop):
+        '''Envia mensagens ate 'stop' ser sinalizado'''
+
+        args = self.bench.args
+        stats = self.bench.stats
+
+        while not stop.is_set():
+            await asyncio.sleep(random.expovariate(args.taxa))
+
+            if stop.is_set():
+                break
+
+            # sai e volta ao bate-papo, com a probabilidade de rotatividade configurada
+            if random.random() < args.rotatividade:
+                if not await self.leave() or not await self.join():
+                    break
+
+                continue
+
+            message = f'{MARK}{time.perf_counter()!r}'
+
+            if random.random() < args.privadas:
+                self.client.sendPrivate(random.choice(self.bench.users).name, message)
+
+                if stats.measuring:
+                    stats.private += 1
+            else:
+                self.client.sendPublic(message)
+
+                if stats.measuring:
+                    stats.public += 1
+
+            # respeita o controle de fluxo da conexao
+            if self.client.writer.transport.get_write_buffer_size() > WRITE_BUFFER_SIZE:
+                await self.client.drain()
+
+    async def close(self):
+        await self.client.close()
+
+class Benchmark:
+    '''Executa uma medicao: conecta os usuarios simulados, gera carga durante o tempo configurado
+    e resume os resultados'''
+
+    def __init__(self, args, serverPid):
+        self.args = args
+        self.serverPid = serverPid
+        self.stats = Stats()
+        self.users = []
+
+    async def run(self):
+        args = self.args
+
+        self.users = [SimulatedUser(self, index) for index in range(args.usuarios)]
+
+        # conecta e coloca os usuarios no bate-papo, no maximo 'args.concorrencia' de cada vez
+        limit = asyncio.Semaphore(args.concorrencia)
+
+        async def start(user):
+            async with limit:
+                try:
+                    await user.connect()
+                except OSError:
+                    self.stats.errors += 1
+                    return False
+
+                return await user.join()
+
+        connectStart = time.perf_counter()
+        joined = await asyncio.gather(*(start(user) for user in self.users))
+        connectTime = time.perf_counter() - connectStart
+
+        # so os usuarios que entraram no bate-papo geram carga
+        self.users = [user for user, success in zip(self.users, joined) if success]
+
+        # fase de medicao
+        stop = asyncio.Event()
+        senders = [asyncio.get_running_loop().create_task(user.run(stop)) for user in self.users]
+
+        self.stats.measuring = True
+        measureStart = time.perf_counter()
+
+        await asyncio.sleep(args.duracao)
+
+        stop.set()
+        self.stats.measuring = False
+        elapsed = time.perf_counter() - measureStart
+
+        await asyncio.gather(*senders, return_exceptions=True)
+
+        # aguarda as ultimas entregas
+        await asyncio.sleep(args.espera)
+
+        rss = serverMemory(self.serverPid) if self.serverPid is not None else None
+
+        await asyncio.gather(*(user.close() for user in self.users))
+
+        return self.summary(connectTime, elapsed, rss)
+
+    def summary(self, connectTime, elapsed, rss):
+        stats = self.stats
+        sent = stats.public + stats.private
+
+        return {
+            "commit": gitCommit(),
+            "config": {key: value for key, value in vars(self.args).items() if key not in ('saida',)},
+            "connect_time_s": connectTime,
+            "users_joined": len(self.users),
+            "duration_s": elapsed,
+            "messages_sent": {"public": stats.public, "private": stats.private},
+            "deliveries": stats.latency.count,
+            "throughput": {
+                "sent_per_s": sent / elapsed,
+                "delivered_per_s": stats.latency.count / elapsed
+            },
+            "latency_ms": stats.latency.summary(),
+            "join_latency_ms": stats.joinLatency.summary(),
+            "churn": {"leaves": stats.leaves, "joins": stats.joins},
+            "errors": stats.errors,
+            "server_rss_kb": rss
+        }
+
+def serverMemory(pid):
+    '''Saida: memoria residente atual e maxima (KiB) do processo 'pid' somada a dos seus filhos
+    (processos servidores, com --processos), lidas de /proc'''
+
+    total = {"current": 0, "peak": 0}
+
+    for process in [pid] + childProcesses(pid):
+        try:
+            with open(f'/proc/{process}/status') as file:
+                for line in file:
+                    if line.startswith('VmRSS:'):
+                        total['current'] += int(line.split()[1])
+                    elif line.startswith('VmHWM:'):
+                        total['peak'] += int(line.split()[1])
+        except OSError:
+            pass
+
+    return total
+
+# identificadores dos processos filhos do processo 'pid'
+def childProcesses(pid):
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as file:
+            return [int(child) for child in file.read().split()]
+    except OSError:
+        return []
+
+# identificador do commit atual do repositorio, para comparar execucoes
+def gitCommit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def startServer(args):
+    '''Inicia um servidor local (servidor.py) na porta do benchmark, com as opcoes extras informadas
+    Saida: o processo do servidor'''
+
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'servidor.py'),
+               '--porta', str(args.porta)] + shlex.split(args.servidor)
+
+    # a saida do servidor e descartada: as mensagens impressas a cada requisicao distorceriam a medicao
+    server = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    time.sleep(args.espera_servidor)
+
+    return server
+
+def raiseFileLimit():
+    '''Eleva o limite de descritores de arquivo, ja que cada usuario simulado ocupa um'''
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError):
+        pass
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description='Gerador de carga e medicao do servidor de bate-papo')
+
+    parser.add_argument('--host', default='localhost', help='maquina onde esta o servidor')
+    parser.add_argument('--porta', type=int, default=5000, help='porta do servidor')
+
+    parser.add_argument('--usuarios', type=int, default=1000, help='quantidade de usuarios simulados')
+    parser.add_argument('--salas', type=int, default=20, help='quantidade de salas entre as quais os usuarios sao distribuidos')
+    parser.add_argument('--duracao', type=float, default=10.0, help='duracao, em segundos, da medicao')
+    parser.add_argument('--taxa', type=float, default=1.0, help='mensagens por segundo enviadas por cada usuario')
+    parser.add_argument('--privadas', type=float, default=0.1, help='fracao das mensagens que sao privadas')
+    parser.add_argument('--rotatividade', type=float, default=0.0,
+                        help='probabilidade de, no lugar de uma mensagem, o usuario sair e voltar ao bate-papo')
+    parser.add_argument('--codec', choices=sorted(CODECS), default=JSON_CODEC.name, help='codec pedido pelos usuarios')
+    parser.add_argument('--concorrencia', type=int, default=100, help='quantidade maxima de entradas simultaneas durante a conexao dos usuarios')
+    parser.add_argument('--tempo-limite', type=float, default=10.0, help='tempo maximo, em segundos, aguardando a resposta de uma entrada ou saida')
+    parser.add_argument('--espera', type=float, default=1.0, help='tempo, em segundos, aguardando as ultimas entregas depois da medicao')
+
+    parser.add_argument('--servidor', metavar='OPCOES',
+                        help='inicia um servidor local com essas opcoes (ex.: "--modo asyncio"), encerrado ao fim da medicao')
+    parser.add_argument('--espera-servidor', type=float, default=1.0, help='tempo, em segundos, aguardando o servidor iniciado ficar pronto')
+    parser.add_argument('--pid-servidor', type=int, help='processo de um servidor ja em execucao, para medir sua memoria')
+
+    parser.add_argument('--saida', help='arquivo onde gravar o resultado em JSON (padrao: saida padrao)')
+
+    return parser.parse_args()
+
+def main():
+    args = parseArguments()
+
+    raiseFileLimit()
+
+    server = startServer(args) if args.servidor is not None else None
+    serverPid = server.pid if server is not None else args.pid_servidor
+
+    try:
+        result = asyncio.run(Benchmark(args, serverPid).run())
+
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    output = json.dumps(result, indent=2)
+
+    if args.saida:
+        with open(args.saida, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
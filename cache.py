@@ -0,0 +1,139 @@
+import collections
+import threading
+
+from protocolo import JSON_CODEC
+
+MESSAGES_PER_ROOM = 50 # quantidade de mensagens recentes guardadas de cada sala
+
+MAX_BYTES = 16 * 1024 * 1024 # tamanho maximo, em bytes (das mensagens em JSON), de todas as salas juntas
+
+class CachedRoom:
+    '''Mensagens recentes de uma sala, da mais antiga para a mais recente, e seu tamanho total'''
+
+    def __init__(self, maxMessages):
+
+        # pares (EncodedMessage, tamanho em bytes)
+        self.messages = collections.deque(maxlen=maxMessages)
+        self.size = 0
+
+class RecentMessages:
+    '''Cache em memoria das ultimas mensagens publicas de cada sala, ja enquadradas
+    (EncodedMessage: cada mensagem e codificada no maximo uma vez por codec, e o mesmo buffer
+    e enviado a todos os usuarios que entram na sala). Guarda ate 'messagesPerRoom' mensagens
+    por sala e, ao todo, ate 'maxBytes' bytes: quando o limite e excedido, as salas usadas ha
+    mais tempo (sem mensagens nem entradas recentes) sao descartadas inteiras (LRU).
+
+    get() conta um acerto quando a sala esta no cache e uma falha quando nao esta; quem consulta
+    pode entao carregar a sala (de outra fonte, como o historico em disco) com fill()'''
+
+    def __init__(self, messagesPerRoom=MESSAGES_PER_ROOM, maxBytes=MAX_BYTES):
+        self.messagesPerRoom = messagesPerRoom
+        self.maxBytes = maxBytes
+
+        # protege as salas e os contadores, compartilhados pelas threads que tratam os clientes
+        self.lock = threading.Lock()
+
+        # nome da sala -> CachedRoom, da usada ha mais tempo para a usada mais recentemente
+        self.rooms = collections.OrderedDict()
+
+        # tamanho total das mensagens guardadas
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def add(self, room, message):
+        '''Guarda a mensagem 'message' (EncodedMessage) como a mais recente da sala room'''
+
+        size = len(message.frame(JSON_CODEC))
+
+        with self.lock:
+            cached = self.rooms.get(room)
+
+            if cached is None:
+                cached = self.rooms[room] = CachedRoom(self.messagesPerRoom)
+            else:
+                self.rooms.move_to_end(room)
+
+            # sala cheia: a mensagem mais antiga sai para dar lugar a nova
+            if len(cached.messages) == self.messagesPerRoom:
+                _, oldSize = cached.messages[0]
+                cached.size -= oldSize
+                self.size -= oldSize
+
+            cached.messages.append((message, size))
+            cached.size += size
+            self.size += size
+
+            self.evict()
+
+    def evict(self):
+        '''Descarta as salas usadas ha mais tempo ate o cache voltar ao tamanho maximo; se resta
+        apenas uma sala, descarta suas mensagens mais antigas (chamada sob o lock)'''
+
+        while self.size > self.maxBytes:
+            if len(self.rooms) > 1:
+                _, cached = self.rooms.popitem(last=False)
+                self.size -= cached.size
+                self.evictions += 1
+            else:
+                cached = next(iter(self.rooms.values()))
+                _, oldSize = cached.messages.popleft()
+                cached.size -= oldSize
+                self.size -= oldSize
+
+    def get(self, room):
+        '''Saida: lista das mensagens recentes (EncodedMessage) da sala 'room', da mais antiga
+        para a mais recente, ou None caso a sala nao esteja no cache'''
+
+        with self.lock:
+            cached = self.rooms.get(room)
+
+            if cached is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.rooms.move_to_end(room)
+
+            return [message for message, _ in cached.messages]
+
+    def peek(self, room):
+        '''Como get, mas sem contar acerto ou falha nem alterar a ordem das salas'''
+
+        with self.lock:
+            cached = self.rooms.get(room)
+
+            return None if cached is None else [message for message, _ in cached.messages]
+
+    def fill(self, room, messages):
+        '''Carrega a sala 'room', que nao estava no cache, com as mensagens 'messages'
+        (EncodedMessage, da mais antiga para a mais recente); nao faz nada se a sala ja foi
+        criada por uma mensagem nova enquanto elas eram carregadas'''
+
+        with self.lock:
+            if room in self.rooms:
+                return
+
+            cached = self.rooms[room] = CachedRoom(self.messagesPerRoom)
+
+            for message in messages[-self.messagesPerRoom:]:
+                size = len(message.frame(JSON_CODEC))
+                cached.messages.append((message, size))
+                cached.size += size
+                self.size += size
+
+            self.evict()
+
+    def stats(self):
+        '''Saida: dicionario com os contadores e a ocupacao do cache'''
+
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "rooms": len(self.rooms),
+                "bytes": self.size
+            }
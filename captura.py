@@ -0,0 +1,152 @@
+import os
+import struct
+import threading
+import time
+
+from protocolo import HEADER
+
+MAGIC = b'CAPTURA2' # identificacao do formato, no inicio de cada arquivo de captura
+
+LEGACY_MAGIC = b'CAPTURA1' # formato anterior, sem o identificador da execucao
+
+# identificador da execucao do servidor que gravou o arquivo, logo apos MAGIC: os identificadores
+# das conexoes recomecam a cada execucao, e so identificam uma conexao junto com ele
+RUN = struct.Struct('>Q')
+
+# header de cada registro: instante do recebimento (segundos desde a epoca), identificador da
+# conexao e tamanho, em bytes, da mensagem enquadrada que segue (0 indica o fim da conexao)
+RECORD = struct.Struct('>dII')
+
+FILE_SIZE = 64 * 1024 * 1024 # tamanho, em bytes, a partir do qual um novo arquivo de captura e iniciado
+
+MAX_FILES = 8 # quantidade maxima de arquivos de captura mantidos (os mais antigos sao apagados)
+
+FILE_SUFFIX = '.cap' # extensao dos arquivos de captura
+
+BUFFER_SIZE = 1024 * 1024 # tamanho do buffer de escrita de cada arquivo
+
+FLUSH_INTERVAL = 1.0 # tempo maximo, em segundos, que um registro fica apenas no buffer antes de ser escrito no arquivo
+
+class Capture:
+    '''Captura binaria das mensagens recebidas pelo servidor, para reproducao posterior
+    (reproducao.py). Cada mensagem e gravada exatamente como chegou pela rede (header de
+    tamanho e corpo, sem decodificacao), precedida do instante do recebimento e do
+    identificador da conexao. Os arquivos sao rotacionados ao atingir 'fileSize' bytes, e
+    apenas os 'maxFiles' mais recentes sao mantidos. Todos os arquivos de uma mesma captura
+    (execucao do servidor) comecam com o mesmo identificador aleatorio da execucao.
+
+    record() apenas copia a mensagem para o buffer do arquivo, sob um lock; o buffer e escrito
+    no arquivo quando enche e, por uma thread propria, a cada 'flushInterval' segundos, e nao ha
+    fsync: a captura nao deve atrasar o tratamento das mensagens. Se o processo morre sem chamar
+    close() (SIGKILL, falha do interpretador), perdem-se os registros do ultimo 'flushInterval';
+    se o sistema operacional cai, tambem o que ele ainda nao tinha gravado. Um registro cortado
+    no fim do arquivo e ignorado na reproducao'''
+
+    def __init__(self, directory, fileSize=FILE_SIZE, maxFiles=MAX_FILES, flushInterval=FLUSH_INTERVAL):
+        self.directory = directory
+        self.fileSize = fileSize
+        self.maxFiles = maxFiles
+        self.flushInterval = flushInterval
+
+        # protege o arquivo atual, compartilhado pelas threads que tratam os clientes
+        self.lock = threading.Lock()
+
+        self.file = None
+        self.size = 0
+        self.sequence = 0
+
+        # se ha registros no buffer ainda nao escritos no arquivo
+        self.dirty = False
+
+        self.run = int.from_bytes(os.urandom(RUN.size), 'big')
+
+        os.makedirs(directory, exist_ok=True)
+
+        # continua a numeracao dos arquivos ja existentes no diretorio
+        existing = self.listFiles()
+
+        if existing:
+            self.sequence = int(existing[-1][:-len(FILE_SUFFIX)]) + 1
+
+        self.rotate()
+
+        self.stopped = threading.Event()
+
+        self.flusher = threading.Thread(target=self.flushLoop, daemon=True)
+        self.flusher.start()
+
+    # nomes dos arquivos de captura do diretorio, do mais antigo para o mais recente
+    def listFiles(self):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith(FILE_SUFFIX))
+
+    def rotate(self):
+        '''Fecha o arquivo atual, inicia um novo e apaga os mais antigos alem do limite (chamada sob o lock)'''
+
+        if self.file is not None:
+            self.file.close()
+
+        path = os.path.join(self.directory, f'{self.sequence:08d}{FILE_SUFFIX}')
+        self.sequence += 1
+
+        self.file = open(path, 'wb', buffering=BUFFER_SIZE)
+        self.file.write(MAGIC)
+        self.file.write(RUN.pack(self.run))
+        self.size = len(MAGIC) + RUN.size
+        self.dirty = True
+
+        for name in self.listFiles()[:-self.maxFiles]:
+            os.remove(os.path.join(self.directory, name))
+
+    def record(self, connectionId, payload):
+        '''Grava a mensagem de corpo 'payload', recebida da conexao 'connectionId', com seu header de tamanho'''
+
+        timestamp = time.time()
+
+        with self.lock:
+            if self.file is None:
+                return
+
+            self.file.write(RECORD.pack(timestamp, connectionId, HEADER.size + len(payload)))
+            self.file.write(HEADER.pack(len(payload)))
+            self.file.write(payload)
+            self.size += RECORD.size + HEADER.size + len(payload)
+            self.dirty = True
+
+            if self.size >= self.fileSize:
+                self.rotate()
+
+    def recordClose(self, connectionId):
+        '''Grava o fim da conexao 'connectionId' (registro sem mensagem)'''
+
+        timestamp = time.time()
+
+        with self.lock:
+            if self.file is None:
+                return
+
+            self.file.write(RECORD.pack(timestamp, connectionId, 0))
+            self.size += RECORD.size
+            self.dirty = True
+
+    def flush(self):
+        '''Escreve no arquivo os registros que estao no buffer'''
+
+        with self.lock:
+            if self.file is not None and self.dirty:
+                self.file.flush()
+                self.dirty = False
+
+    # loop da thread que escreve o buffer periodicamente, ate o fechamento da captura
+    def flushLoop(self):
+        while not self.stopped.wait(self.flushInterval):
+            self.flush()
+
+    def close(self):
+        '''Escreve os registros pendentes e fecha a captura (pode ser chamada mais de uma vez)'''
+
+        self.stopped.set()
+
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
@@ -1,68 +1,225 @@
-import socket
-import struct
-import json
-import threading
-import sys
+import argparse
+import bisect
+import collections
+import itertools
 import os
+import queue
 from tkinter import *
 import tkinter.messagebox
-from random import randint
-from json.decoder import JSONDecodeError
 
-HOST = 'localhost' # maquina onde esta o servidor
-PORT = 5000        # porta que o servidor esta escutando
+from protocolo import CODECS, JSON_CODEC
+from sessao import CONNECTION_CLOSED, HOST, PORT, ChatClient, SessionError
 
-ADDRESS = (HOST, PORT) # tupla contendo o IP e a porta do servidor
+HISTORY_LIMIT = 50 # quantidade de mensagens anteriores pedidas pelo comando /historico
 
-HEADER_LENGTH = 4 # tamanho do header utilizado para enviar o tamanho em bytes da mensagem
+DRAIN_INTERVAL = 20 # intervalo, em milissegundos, entre as aplicações na janela das mensagens recebidas
 
-FORMAT = 'utf-8' # formato utilizado para codificar/decodificar as mensagens
+MAX_EVENTS_PER_DRAIN = 500 # quantidade máxima de mensagens recebidas aplicadas de uma vez na janela
 
-online_users = {} # dicionário de usuários ativos na sala de bate-papo (endereço e nome de usuário)
+PRESENCE_NOTICE_LIMIT = 10 # quantidade máxima de entradas e saídas de um presence-delta anunciadas uma a uma na conversa
 
-# cria socket
-clientSocket = socket.socket()
+TRANSCRIPT_SIZE = 1000 # quantidade de mensagens mantidas na caixa de texto enquanto o usuário acompanha o fim da conversa
 
-# conecta-se com o servidor
-clientSocket.connect(ADDRESS)
+TRANSCRIPT_MEMORY = 20000 # quantidade de mensagens guardadas em memória para rolagem (as mais antigas são descartadas)
 
-# Função para receber 'numBytes' bytes or retornar None se EOF for atingido
-def recvall(connectionSocket, numBytes):
+TRANSCRIPT_PAGE = 200 # quantidade de mensagens antigas recolocadas na caixa de texto a cada rolagem até o topo
 
-    data = bytearray()
+# conversa exibida em uma caixa de texto, limitada às mensagens mais recentes
+class Transcript:
 
-    while len(data) < numBytes:
-        packet = connectionSocket.recv(numBytes - len(data))
+    # recebe a caixa de texto 'text', a quantidade 'size' de mensagens mantidas nela e a quantidade
+    # 'memory' de mensagens guardadas em memória, recolocadas na caixa ao rolar até o topo
+    def __init__(self, text, size=TRANSCRIPT_SIZE, memory=TRANSCRIPT_MEMORY, page=TRANSCRIPT_PAGE):
 
-        if not packet:
-            return None
+        self.text = text
+        self.size = size
+        self.page = page
+
+        # textos das mensagens guardadas, da mais antiga para a mais recente
+        self.entries = collections.deque(maxlen=memory)
+
+        # quantidade de linhas de cada mensagem presente na caixa de texto (as últimas de self.entries)
+        self.lines = collections.deque()
+
+        # rolagem até o topo pendente de tratamento
+        self.loading = False
+
+    # acrescenta os textos 'texts' ao fim da conversa, com uma única inserção na caixa de texto
+    def append(self, texts):
+
+        # só acompanha o fim da conversa (e descarta o começo da caixa) se o usuário já estiver nele
+        following = self.text.yview()[1] >= 1.0
+
+        self.entries.extend(texts)
+        self.lines.extend(entry.count('\n') for entry in texts)
+
+        self.text.config(state = NORMAL)
+        self.text.insert(END, ''.join(texts))
+
+        # com o usuário lendo mensagens antigas, a caixa só é reduzida ao passar do tamanho da memória
+        if following or len(self.lines) > self.entries.maxlen:
+            self.trim()
+
+        self.text.config(state = DISABLED)
+
+        if following:
+            self.text.see(END)
+
+    # remove do começo da caixa de texto as mensagens além das 'size' mais recentes
+    def trim(self):
+
+        excess = len(self.lines) - self.size
+
+        if excess <= 0:
+            return
+
+        lines = sum(self.lines.popleft() for _ in range(excess))
+
+        self.text.delete('1.0', f'{lines + 1}.0')
+
+    # quantidade de mensagens guardadas em memória que não estão na caixa de texto
+    def hidden(self):
+        return max(len(self.entries) - len(self.lines), 0)
+
+    # chamada pela caixa de texto a cada mudança da área visível; repassa a posição à barra de rolagem
+    # e, ao chegar ao topo, agenda a recolocação de mensagens mais antigas
+    def onScroll(self, scrollbar, first, last):
+
+        scrollbar.set(first, last)
+
+        if float(first) <= 0.0 and self.hidden() and not self.loading:
+            self.loading = True
+            self.text.after_idle(self.loadOlder)
+
+    # recoloca no começo da caixa de texto as 'page' mensagens anteriores à primeira exibida,
+    # mantendo na tela a mesma linha que o usuário via
+    def loadOlder(self):
+
+        self.loading = False
+
+        hidden = self.hidden()
 
-        data.extend(packet)
+        if not hidden:
+            return
+
+        start = max(hidden - self.page, 0)
+        texts = list(itertools.islice(self.entries, start, hidden))
+        counts = [entry.count('\n') for entry in texts]
+
+        self.text.config(state = NORMAL)
+        self.text.insert('1.0', ''.join(texts))
+        self.text.config(state = DISABLED)
+
+        self.lines.extendleft(reversed(counts))
+
+        self.text.yview(f'{sum(counts) + 1}.0')
+
+# usuários ativos na sala atual, exibidos em ordem alfabética em uma lista, depois do próprio usuário
+class UserList:
+
+    # recebe a lista 'listbox' em que os usuários são exibidos e o nome 'name' do próprio usuário
+    def __init__(self, listbox, name):
+
+        self.listbox = listbox
+        self.name = name
+
+        # endereço (host, porta) -> nome de cada usuário ativo
+        self.addresses = {}
+
+        # nomes dos usuários ativos, em ordem: a posição de um nome na lista de usuários é
+        # encontrada por busca binária, sem ler os itens da lista
+        self.names = []
+
+    # substitui os usuários pelos membros 'users_list' da sala, com uma única inserção na lista
+    def load(self, users_list):
 
-    return data
+        self.addresses = {(user['host'], user['port']): user['name'] for user in users_list}
+        self.names = sorted(self.addresses.values())
 
-# Função para receber a mensagem completa de acordo com o tamanho em bytes enviado no header
-def receiveMessage(connectionSocket):
+        self.listbox.delete(0, END)
+        self.listbox.insert(END, f' {self.name} (Você)', *(f' {name}' for name in self.names))
 
-    # recebe o trecho da mensagem relativo ao tamanho da mensagem
-    header = recvall(connectionSocket, HEADER_LENGTH)
+    # inclui o usuário de endereço 'address' e nome 'name', inserindo-o na sua posição da lista
+    # Saída: False se o usuário já estava incluído
+    def add(self, address, name):
 
-    # se mensagem recebida for vazia, retorna None
-    if not header:
-        return None
+        if address in self.addresses:
+            return False
 
-    # desempacota os 4 bytes do header que contém o tamanho da mensagem
-    msgSize = struct.unpack('>I', header)[0]
+        self.addresses[address] = name
 
-    # recebe o restante da mensagem, de tamanho msgSize
-    return recvall(connectionSocket, msgSize)
+        position = bisect.bisect_right(self.names, name)
+        self.names.insert(position, name)
+
+        # o primeiro item da lista é o próprio usuário
+        self.listbox.insert(position + 1, f' {name}')
+
+        return True
+
+    # exclui o usuário de endereço 'address', removendo-o da lista
+    # Saída: o nome do usuário, ou None se ele não estava incluído
+    def remove(self, address):
+
+        name = self.addresses.pop(address, None)
+
+        if name is None:
+            return None
+
+        position = bisect.bisect_left(self.names, name)
+        del self.names[position]
+
+        self.listbox.delete(position + 1)
+
+        return name
+
+    def __contains__(self, name):
+        position = bisect.bisect_left(self.names, name)
+        return position < len(self.names) and self.names[position] == name
+
+    def __len__(self):
+        return len(self.names)
 
 # classe para a interface de usuário oferecida
 class GUI:
    
-    # construtor
-    def __init__(self):
-        
+    # construtor, recebendo o cliente (sessao.ChatClient) usado para falar com o servidor e a
+    # quantidade de mensagens mantidas na caixa de texto
+    def __init__(self, client, transcriptSize=TRANSCRIPT_SIZE):
+
+        self.client = client
+        self.transcriptSize = transcriptSize
+
+        # a thread de recebimento do cliente apenas enfileira as mensagens recebidas; elas são
+        # tratadas na thread do Tk, em lotes, por drainEvents (widgets só são tocados nessa thread)
+        self.events = queue.Queue()
+        self.client.subscribe(None, self.events.put)
+
+        # tratadores de cada tipo de mensagem recebida
+        self.handlers = {
+            'connection-response': self.handleConnectionResponse,
+            'user-joined': self.handleUserJoined,
+            'user-left': self.handleUserLeft,
+            'chat-message': self.handleChatMessage,
+            'room-joined': self.handleRoomJoined,
+            'room-list-response': self.handleRoomList,
+            'history-response': self.handleHistory,
+            'private-error': self.handlePrivateError,
+            'presence-response': self.handlePresenceResponse,
+            'presence-delta': self.handlePresenceDelta,
+            CONNECTION_CLOSED: self.handleConnectionClosed
+        }
+
+        # textos a inserir na caixa de texto de uma só vez, enquanto um lote de mensagens é tratado
+        self.pendingText = []
+        self.draining = False
+
+        # conversa exibida na caixa de texto e usuários ativos na sala, criados com a janela de bate-papo
+        self.transcript = None
+        self.users = None
+
+        # versão da presença da sala atual refletida na lista de usuários (presença versionada)
+        self.presenceVersion = None
+
         # janela de bate-papo, iniciada de maneira escondida do usuário
         self.Window = Tk()
         self.Window.withdraw()
@@ -123,81 +280,178 @@ class GUI:
         self.go.place(relx = 0.4,
                       rely = 0.55)
                     
+        # trata periodicamente as mensagens recebidas
+        self.Window.after(DRAIN_INTERVAL, self.drainEvents)
+
         # inicia o loop principal da janela de bate-papo
         self.Window.mainloop()
+
+    # trata, na thread do Tk, as mensagens enfileiradas pela thread de recebimento, aplicando o
+    # texto de todas elas na caixa de texto com uma única atualização
+    def drainEvents(self):
+
+        self.draining = True
+
+        try:
+            for _ in range(MAX_EVENTS_PER_DRAIN):
+                try:
+                    msgObject = self.events.get_nowait()
+                except queue.Empty:
+                    break
+
+                self.printMessage(msgObject)
+
+                handler = self.handlers.get(msgObject['type'])
+
+                # caso receba um tipo de mensagem desconhecido, imprime mensagem de erro no console
+                if handler is None:
+                    print(f'Tipo de mensagem "{msgObject["type"]}" inválido!')
+                    continue
+
+                handler(msgObject)
+
+        finally:
+            self.draining = False
+            self.flushText()
+
+            # com mensagens ainda na fila, volta logo, depois de deixar o Tk processar a interface
+            self.Window.after(1 if not self.events.empty() else DRAIN_INTERVAL, self.drainEvents)
   
     def loginToChat(self, name):
 
         self.name = name
 
-        # cria a mensagem de requisição de conexão para o servidor
-        msg_object = {
-            "type": "connection-request",
-            "name": name
-        }
+        try:
+            # conecta-se ao servidor no primeiro login (a conexão é mantida ao voltar ao menu)
+            if self.client.socket is None:
+                self.client.connect()
 
-        # transforma em uma string em formato JSON
-        msg_string = json.dumps(msg_object)
-        
-        # envia a mensagem de requisição de conexão para o servidor
-        clientSocket.sendall(struct.pack('>I', len(msg_string)) + msg_string.encode(FORMAT))
+            # envia a requisição de conexão (sempre em JSON) e espera a resposta do servidor
+            receivedMsgObject = self.client.join(name)
 
-        # imprime a mensagem enviada
-        print('Mensagem enviada: ', msg_string)
+        except (OSError, SessionError) as e:
+            tkinter.messagebox.showerror('Erro', f'Falha na conexão com o servidor: {e}')
+            return
 
-        try:
-            # espera a resposta do servidor (chamada pode ser BLOQUEANTE)
-            receivedMsg = receiveMessage(clientSocket) # argumento indica a qtde maxima de bytes da mensagem
+        # se nome valido, a tela de chat ja foi mostrada (handleConnectionResponse)
+        # se nao, mostra mensagem de erro e nao muda janela
+        if receivedMsgObject['success'] != True:
 
-            # decodifica a mensagem recebida
-            receivedMsgString = receivedMsg.decode(FORMAT)
+            # mostra mensagem de erro (nome de usuário já utilizado)
+            tkinter.messagebox.showerror('Erro', receivedMsgObject['error_msg'])
 
-            # imprime a mensagem recebida
-            print('Mensagem recebida:', receivedMsgString)
+    # trata a resposta de entrada no bate-papo, antes das mensagens que chegam em seguida
+    # (mensagens recentes da sala, notificações)
+    def handleConnectionResponse(self, msgObject):
 
-            try:
-                # recupera o objeto da mensagem a partir da string JSON recebida
-                receivedMsgObject = json.loads(receivedMsgString)
+        if msgObject['success'] != True:
+            return
 
-                # se nome valido, vai pra tela de chat
-                # se nao, mostra mensagem de erro e nao muda janela
+        # sala em que o usuário entrou, registrada pelo cliente
+        self.room = self.client.room
 
-                if receivedMsgObject['success'] == True:
+        # esconde a janela de menu e passa a mostrar a janela de bate-papo
+        self.login.withdraw()
+        self.layout(self.name)
 
-                    # esconde a janela de menu e passa a mostrar a janela de bate-papo
-                    self.login.withdraw()
-                    self.layout(name)
+        # recupera a lista de membros da sala e a exibe na lista de usuários
+        self.loadUsers(msgObject['users_list'])
+        self.startPresence(msgObject)
 
-                    users_list = receivedMsgObject['users_list']
+    # substitui os usuários ativos e a lista de usuários pelos membros da sala atual
+    def loadUsers(self, users_list):
 
-                    # recuperada a lista de usuários da mensagem e guarda no dicionário 'online_users'
-                    for user in users_list:
-                        online_users[(user['host'], user['port'])] = user['name']
-                        self.listbox.insert(END, f" {user['name']}")
-                    
-                    print('online_users:', online_users)
-                    
-                    # thread para receber mensagens do servidor
-                    self.rcvThread = threading.Thread(target=self.receive)
-                    self.rcvThread.start()
+        self.users.load(users_list)
 
-                else:
-                    # mostra mensagem de erro (nome de usuário já utilizado)
-                    tkinter.messagebox.showerror('Erro', receivedMsgObject['error_msg'])
+        print('Usuários ativos:', len(self.users))
 
-            except JSONDecodeError:
-                print('Falha na decodificação da mensagem!')
+    # com a presença versionada, a resposta de entrada traz apenas a primeira página da lista de
+    # membros: guarda a versão da presença e pede as páginas seguintes
+    def startPresence(self, msgObject):
+
+        self.presenceVersion = msgObject.get('version')
+
+        if msgObject.get('next') is not None:
+            self.client.requestPresence(after=msgObject['next'])
+
+    # trata a resposta de um pedido de presença: uma página da lista de membros ou as mudanças pedidas
+    def handlePresenceResponse(self, msgObject):
+
+        # ignora respostas de outras salas, pedidas antes da troca de sala
+        if not self.isCurrentRoom(msgObject):
+            return
+
+        if 'users_list' in msgObject:
+
+            # os membros da sala, exceto o próprio usuário, já exibido no topo da lista
+            users_list = [user for user in msgObject['users_list'] if user['name'] != self.name]
+
+            # a primeira página substitui a lista; as seguintes são acrescentadas a ela
+            if msgObject.get('after') is None:
+                self.loadUsers(users_list)
+                self.presenceVersion = msgObject['version']
+            else:
+                for user in users_list:
+                    self.users.add((user['host'], user['port']), user['name'])
+
+            if msgObject.get('next') is not None:
+                self.client.requestPresence(after=msgObject['next'])
+
+        else:
+            self.applyPresence(msgObject)
+
+    # trata as entradas e saídas de usuários da sala, agrupadas pelo servidor
+    def handlePresenceDelta(self, msgObject):
+
+        # ignora mudanças de outras salas, enviadas antes da troca de sala ser concluída
+        if not self.isCurrentRoom(msgObject):
+            return
+
+        # mudanças anteriores a este presence-delta não chegaram (ex.: descartadas da fila de
+        # saída do servidor): pede as que faltam, que são aplicadas quando a resposta chegar
+        if self.presenceVersion is not None and msgObject['since'] > self.presenceVersion:
+            self.client.requestPresence(since=self.presenceVersion)
+
+        self.applyPresence(msgObject)
+
+    # aplica na lista de usuários as entradas e saídas de um presence-delta ou presence-response
+    def applyPresence(self, msgObject):
+
+        joined = [user['name'] for user in msgObject['joined']
+                  if user['name'] != self.name and self.users.add((user['host'], user['port']), user['name'])]
+
+        left = [user['name'] for user in msgObject['left'] if self.users.remove((user['host'], user['port'])) is not None]
+
+        if self.presenceVersion is None or msgObject['version'] > self.presenceVersion:
+            self.presenceVersion = msgObject['version']
+
+        # poucas mudanças são anunciadas uma a uma; muitas (ex.: uma rajada de entradas), em uma única linha
+        if len(joined) + len(left) <= PRESENCE_NOTICE_LIMIT:
+            display_msg = ''.join(f'{name} entrou na sala.\n\n' for name in joined)
+            display_msg += ''.join(f'{name} saiu da sala.\n\n' for name in left)
+        else:
+            display_msg = f'{len(joined)} usuários entraram e {len(left)} saíram da sala.\n\n'
+
+        if display_msg:
+            self.insertMessage(display_msg)
 
-        except:
-            pass
-  
     # função para inserir mensagem na caixa de texto da janela de bate-papo
+    # (durante o tratamento de um lote de mensagens recebidas, o texto é acumulado e inserido ao fim do lote)
     def insertMessage(self, display_msg):
 
-        self.textCons.config(state = NORMAL)
-        self.textCons.insert(END, display_msg)
-        self.textCons.config(state = DISABLED)
-        self.textCons.see(END)
+        self.pendingText.append(display_msg)
+
+        if not self.draining:
+            self.flushText()
+
+    # insere na caixa de texto, com uma única atualização, os textos acumulados
+    def flushText(self):
+
+        if not self.pendingText or self.transcript is None:
+            return
+
+        self.transcript.append(self.pendingText)
+        self.pendingText = []
     
     # A janela de bate-papo
     def layout(self,name):
@@ -221,7 +475,7 @@ class GUI:
         self.labelHead = Label(self.Window,
                              bg = "#17202A", 
                              fg = "#EAECEE",
-                             text = f'Bem-vindo(a), {self.name}',
+                             text = f'Bem-vindo(a), {self.name} - sala {self.room}',
                              font = "Helvetica 13 bold",
                              pady = 5)
           
@@ -272,6 +526,8 @@ class GUI:
                            relwidth = 0.25,
                            relx = 0.745,
                            rely = 0.08)
+
+        self.users = UserList(self.listbox, name)
           
         self.labelBottom = Label(self.Window,
                                  bg = "#ABB2B9",
@@ -318,11 +574,18 @@ class GUI:
           
         scrollbar.config(command = self.textCons.yview)
 
+        # a caixa de texto mantém apenas as mensagens mais recentes; as anteriores voltam ao rolar até o topo
+        self.transcript = Transcript(self.textCons, self.transcriptSize)
+        self.textCons.config(yscrollcommand = lambda first, last: self.transcript.onScroll(scrollbar, first, last))
+
         # mensagem a ser exibida para o usuário
-        display_msg = 'Você se conectou ao bate-papo.\n\n'
+        display_msg = f'Você se conectou ao bate-papo, na sala {self.room}.\n\n'
+
+        # comandos de salas disponíveis
+        display_msg += 'Use /sala <nome> para trocar de sala, /sair-sala para voltar à sala geral e /salas para listar as salas.\n\n'
 
-        # insere o nome do usuário na lista de usuários ativos
-        self.listbox.insert(END, f' {self.name} (Você)')
+        # comando de histórico
+        display_msg += 'Use /historico [quantidade] para ver mensagens anteriores da sala.\n\n'
 
         self.entryMsg.delete(0, END)
 
@@ -332,19 +595,11 @@ class GUI:
     # lógica do botão de retornar ao menu
     def returnToMenu(self):
 
-        # cria a mensagem de requisição de saída do bate-papo
-        disconnection_request = {
-            "type": "disconnection-request"
-        }
-
-        # transforma o objeto em uma string JSON
-        msg_string = json.dumps(disconnection_request)
-
-        # imprime a mensagem enviada
-        print('Mensagem enviada: ', msg_string)
-
-        # envia a mensagem para o servidor
-        clientSocket.sendall(struct.pack('>I', len(msg_string)) + msg_string.encode(FORMAT))
+        # envia a requisição de saída do bate-papo e espera a resposta do servidor
+        try:
+            self.client.leave()
+        except (OSError, SessionError) as e:
+            print(e)
 
         # esconde a janela de bate-papo e passa a mostrar a janela de menu
         self.Window.withdraw()
@@ -377,63 +632,37 @@ class GUI:
         # chama a função de envio de mensagens para o servidor
         self.sendMessage()
   
-    # recebe e trata mensagens do servidor
-    def receive(self):
-
-        while True:
-            try:
-
-                # recebe a mensagem do servidor
-                receivedMsg = receiveMessage(clientSocket)
+    # imprime no console cada mensagem recebida do servidor
+    def printMessage(self, msgObject):
+        print('Mensagem recebida:', msgObject)
 
-                # decodifica para uma string JSON
-                receivedMsgString = receivedMsg.decode(FORMAT)
+    # trata o fim da conexão com o servidor
+    def handleConnectionClosed(self, msgObject):
+        print('Conexão com o servidor encerrada')
+        self.client.close()
 
-                # imprime a mensagem recebida
-                print('Mensagem recebida:', receivedMsgString)
+    # envia a mensagem em self.msg
+    def sendMessage(self):
 
-                try:
-                    # recupera o objeto contido na string JSON
-                    receivedMsgObject = json.loads(receivedMsgString)
+        self.textCons.config(state=DISABLED)
 
-                except JSONDecodeError:
-                    print('Falha na decodificação da mensagem!')
-                    continue
-                  
-                # trata mensagem de notificação de entrada de usuário no bate-papo
-                if receivedMsgObject['type'] == 'user-joined':
-                    self.handleUserJoined(receivedMsgObject)
-        
-                # trata mensagem de notificação de saída de usuário do bate-papo
-                elif receivedMsgObject['type'] == 'user-left':
-                    self.handleUserLeft(receivedMsgObject)
+        # trata comandos de salas
+        if self.msg.startswith('/sala ') or self.msg in ('/sair-sala', '/salas'):
+            self.sendRoomCommand()
 
-                # trata mensagem de bate-papo recebida
-                elif receivedMsgObject['type'] == 'chat-message':
-                    self.handleChatMessage(receivedMsgObject)
+        # trata pedido de mensagens anteriores da sala (as recentes já chegam ao entrar nela)
+        elif self.msg == '/historico' or self.msg.startswith('/historico '):
 
-                # trata mensagem de permissão de desconexão do bate-papo
-                elif receivedMsgObject['type'] == 'disconnection-response':
-                    # sai do loop de recebimento de mensagens
-                    return
+            limit = self.msg[10:].strip()
 
-                # caso receba um tipo de mensagem desconhecido, imprime mensagem de erro no console
-                else:
-                    print(f'Tipo de mensagem "{receivedMsgObject["type"]}" inválido!')
-
-            # imprime no console possíveis exceções e encerra conexão com o servidor
-            except BaseException as e:
-                print(e)
-                clientSocket.close()
-                break 
-          
-    # envia a mensagem em self.msg
-    def sendMessage(self):
+            if limit and not limit.isdigit():
+                self.insertMessage('Uso: /historico [quantidade]\n\n')
+                return
 
-        self.textCons.config(state=DISABLED)
+            self.client.requestHistory(int(limit) if limit else HISTORY_LIMIT)
 
         # trata caso de mensagens privadas
-        if(self.msg[:4] == '/mp '):
+        elif(self.msg[:4] == '/mp '):
 
             try:
                 # recupera o índice, na string, do caracter de espaço seguinte ao nome do usuário
@@ -457,46 +686,26 @@ class GUI:
 
                 return
 
-            # se o destinatário for um usuário ativo no bate-papo
-            if receiver_name in online_users.values():
-
-                # recupera a mensagem de texto contida no comando de mensagem privada
-                msg = self.msg[next_space+1:]
+            # recupera a mensagem de texto contida no comando de mensagem privada
+            msg = self.msg[next_space+1:]
 
-                # caso a mensagem recuperada seja vazia ou seja formada apenas por whitespace
-                if not msg or msg.isspace():
+            # caso a mensagem recuperada seja vazia ou seja formada apenas por whitespace
+            if not msg or msg.isspace():
 
-                    # cria e insere mensagem de erro na janela de bate-papo
-                    display_msg = f'Mensagem privada não deve ser vazia!\n\n'
-                    self.insertMessage(display_msg)
-
-                    return
-                
-                # formata e insere a mensagem privada na janela de bate-papo
-                display_msg = f'Você -> {receiver_name}: {msg}\n\n'
+                # cria e insere mensagem de erro na janela de bate-papo
+                display_msg = f'Mensagem privada não deve ser vazia!\n\n'
                 self.insertMessage(display_msg)
 
-                # cria o objeto da mensagem privada, com os campos devidamente preenchidos
-                msg_object = {
-                    "type": "chat-message",
-                    "private": True,
-                    "sender": self.name,
-                    "receiver": receiver_name,
-                    "message": msg
-                }
-
-                # transforma o objeto da mensagem privada em uma string JSON
-                msg_string = json.dumps(msg_object)
-
-                # envia a mensagem privada para o servidor, para que ele repasse ao destinatário
-                clientSocket.sendall(struct.pack('>I', len(msg_string)) + msg_string.encode(FORMAT))  
+                return
+            
+            # formata e insere a mensagem privada na janela de bate-papo
+            display_msg = f'Você -> {receiver_name}: {msg}\n\n'
+            self.insertMessage(display_msg)
 
-            # caso o nome de usuário passado como destinatário não esteja ativo no bate-papo
-            else:
-
-                # cria e insere mensagem de erro na janela de bate-papo
-                display_msg = f'Usuário "{receiver_name}" não encontrado.\n\n'
-                self.insertMessage(display_msg)
+            # envia a mensagem privada para o servidor, para que ele repasse ao destinatário, que pode
+            # estar em qualquer sala ou processo; se ele não estiver no bate-papo, o servidor responde
+            # com um private-error
+            self.client.sendPrivate(receiver_name, msg)
 
         # trata casos de mensagens públicas (broadcast)
         else:
@@ -505,58 +714,113 @@ class GUI:
             display_msg = f'Você: {self.msg}\n\n'
             self.insertMessage(display_msg)
 
-            # cria o objeto da mensagem pública, com os campos devidamente preenchidos
-            msg_object = {
-                "type": "chat-message",
-                "private": False,
-                "sender": self.name,
-                "receiver": None,
-                "message": self.msg
-            }
+            # envia a mensagem pública para o servidor, para que ele a todos os usuários ativos no bate-papo
+            self.client.sendPublic(self.msg)
 
-            # transforma o objeto da mensagem pública em uma string JSON
-            msg_string = json.dumps(msg_object)
+    # envia ao servidor o comando de sala em self.msg
+    def sendRoomCommand(self):
 
-            # envia a mensagem pública para o servidor, para que ele a todos os usuários ativos no bate-papo
-            clientSocket.sendall(struct.pack('>I', len(msg_string)) + msg_string.encode(FORMAT))  
+        # troca para a sala informada
+        if self.msg.startswith('/sala '):
+
+            room = self.msg[6:].strip()
+
+            # caso o nome da sala seja vazio
+            if not room:
+                self.insertMessage('Nome da sala não deve ser vazio!\n\n')
+                return
+
+            self.client.joinRoom(room)
+
+        # volta para a sala padrão
+        elif self.msg == '/sair-sala':
+            self.client.leaveRoom()
+
+        # solicita a lista de salas
+        else:
+            self.client.listRooms()
+
+    # trata confirmação de troca de sala
+    def handleRoomJoined(self, msgObject):
+
+        self.room = msgObject['room']
+
+        # atualiza o título e a lista de usuários com os membros da nova sala
+        self.labelHead.config(text = f'Bem-vindo(a), {self.name} - sala {self.room}')
+        self.loadUsers(msgObject['users_list'])
+        self.startPresence(msgObject)
+
+        display_msg = f'Você entrou na sala {self.room}.\n\n'
+        self.insertMessage(display_msg)
+
+    # trata as mensagens anteriores da sala, exibindo-as antes das novas
+    def handleHistory(self, msgObject):
+
+        # ignora históricos de outras salas, pedidos antes da troca de sala
+        if not self.isCurrentRoom(msgObject) or not msgObject['messages']:
+            return
+
+        display_msg = 'Mensagens anteriores:\n\n'
+
+        for message in msgObject['messages']:
+            display_msg += f"{message['sender']}: {message['message']}\n\n"
+
+        display_msg += '--------\n\n'
+
+        self.insertMessage(display_msg)
+
+    # trata a lista de salas existentes
+    def handleRoomList(self, msgObject):
+
+        rooms = ', '.join(f"{room['name']} ({room['members']})" for room in msgObject['rooms'])
+
+        display_msg = f'Salas: {rooms}\n\n'
+        self.insertMessage(display_msg)
+
+    # verifica se uma notificação ou mensagem pública é da sala atual (servidores sem salas não a informam)
+    def isCurrentRoom(self, msgObject):
+        return msgObject.get('room', self.room) == self.room
 
     # trata mensagem de notificação de entrada de usuário no bate-papo
     def handleUserJoined(self, msgObject):
 
+        # ignora notificações de outras salas, enviadas antes da troca de sala ser concluída
+        if not self.isCurrentRoom(msgObject):
+            return
+
         # recupera o endereço e o nome de usuário do usuário recém conectado do objeto da mensagem
         new_user_address = (msgObject['host'], msgObject['port'])
         new_user_name = msgObject['name']
 
-        # inclui o usuário no dicionário de usuários ativos no bate-papo
-        online_users[new_user_address] = new_user_name
-
-        print('online_users:', online_users)
+        # inclui o usuário nos usuários ativos e na sua posição da lista na direita da janela de bate-papo
+        if not self.users.add(new_user_address, new_user_name):
+            return
 
-        # insere o nome do novo usuário na lista de usuários ativos na direita da janela de bate-papo
-        self.listbox.insert(END, ' ' + new_user_name)
+        print('Usuário entrou:', new_user_name, new_user_address)
 
         # formata e insere a mensagem de notificação de entrada de usuário na caixa de texto da janela de bate-papo
-        display_msg = f'{new_user_name} se conectou ao bate-papo.\n\n'
+        display_msg = f'{new_user_name} entrou na sala.\n\n'
         self.insertMessage(display_msg)
     
     # trata mensagem de notificação de saída de usuário do bate-papo
     def handleUserLeft(self, msgObject):
 
+        # ignora notificações de outras salas, enviadas antes da troca de sala ser concluída
+        if not self.isCurrentRoom(msgObject):
+            return
+
         # recupera o endereço e o nome de usuário do usuário que saiu do objeto da mensagem
         user_address = (msgObject['host'], msgObject['port'])
         user_name = msgObject['name']
 
-        # exclui o usuário do dicionário de usuários ativos no bate-papo
-        del online_users[user_address]
-
-        print('online_users:', online_users)
+        # exclui o usuário dos usuários ativos e da lista na direita da janela de bate-papo
+        if self.users.remove(user_address) is None:
+            return
 
-        # remove o nome do usuário da lista de usuários ativos na direita da janela de bate-papo
-        index = self.listbox.get(0, END).index(' ' + user_name)
-        self.listbox.delete(index)
+        print('Usuário saiu:', user_name, user_address)
 
         # formata e insere a mensagem de notificação de saída de usuário na caixa de texto da janela de bate-papo
-        display_msg = f'{user_name} se desconectou do bate-papo.\n\n'
+        display_msg = f'{user_name} saiu da sala.\n\n'
         self.insertMessage(display_msg)
 
     # trata mensagem de bate-papo recebida
@@ -573,12 +837,40 @@ class GUI:
             display_msg = f'{sender} -> Você: {message}\n\n'
             self.insertMessage(display_msg)
 
-        # caso a mensagem recebida seja pública
-        else:
+        # caso a mensagem recebida seja pública, da sala atual
+        elif self.isCurrentRoom(msgObject):
 
             # formata e insere a mensagem pública a caixa de texto da janela de bate-papo
             display_msg = f'{sender}: {message}\n\n'
             self.insertMessage(display_msg)
 
-# instancia a classe de interface de usuário
-g = GUI()
\ No newline at end of file
+    # trata a recusa de uma mensagem privada cujo destinatário não está no bate-papo
+    def handlePrivateError(self, msgObject):
+
+        display_msg = f"{msgObject['error_msg']}\n\n"
+        self.insertMessage(display_msg)
+
+def main():
+    parser = argparse.ArgumentParser(description='Cliente de bate-papo')
+
+    parser.add_argument('--host', default=HOST, help='máquina onde está o servidor')
+    parser.add_argument('--porta', type=int, default=PORT, help='porta do servidor')
+
+    # codec solicitado ao servidor para as mensagens da sessão de bate-papo
+    parser.add_argument('--codec', choices=sorted(CODECS), default=JSON_CODEC.name,
+                        help='codec das mensagens após a entrada no bate-papo (o connection-request é sempre JSON)')
+
+    # limite da caixa de texto da conversa
+    parser.add_argument('--mensagens-janela', type=int, default=TRANSCRIPT_SIZE,
+                        help='quantidade de mensagens mantidas na caixa de texto (as anteriores são recolocadas ao rolar até o topo)')
+
+    args = parser.parse_args()
+
+    # a conexão com o servidor só é aberta no login
+    client = ChatClient(args.host, args.porta, args.codec, presence=True)
+
+    # instancia a classe de interface de usuário
+    GUI(client, args.mensagens_janela)
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
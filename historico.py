@@ -0,0 +1,309 @@
+import array
+import bisect
+import os
+import threading
+import time
+
+import registros
+from protocolo import HEADER, HEADER_LENGTH, JSON_CODEC, DecodeError, frameBytes
+
+SEGMENT_SIZE = 64 * 1024 * 1024 # tamanho, em bytes, a partir do qual um novo segmento do historico e iniciado
+
+COMMIT_INTERVAL = 0.005 # tempo, em segundos, que o escritor espera para gravar varias mensagens de uma vez
+
+SEGMENT_SUFFIX = '.log' # extensao dos arquivos de segmento
+
+log = registros.getLogger('historico')
+
+class Segment:
+    '''Arquivo do historico com as mensagens de identificadores consecutivos, a partir de
+    'firstId', e a posicao de cada uma no arquivo (indice em memoria)'''
+
+    def __init__(self, path, firstId):
+        self.path = path
+        self.firstId = firstId
+
+        # posicao, no arquivo, do header de cada mensagem gravada (a de identificador firstId + i na posicao i)
+        self.offsets = array.array('Q')
+
+        # tamanho do arquivo ate o fim da ultima mensagem gravada
+        self.size = 0
+
+        # descritor usado nas leituras (os.pread), que nao dependem da posicao do arquivo
+        self.fd = os.open(path, os.O_RDONLY | os.O_CREAT, 0o644)
+
+    # identificador seguinte ao da ultima mensagem do segmento
+    def endId(self):
+        return self.firstId + len(self.offsets)
+
+    def read(self, firstId, lastId):
+        '''Le as mensagens de identificadores 'firstId' a 'lastId' do segmento, com uma unica leitura
+        Saida: lista com os bytes (sem header) de cada mensagem'''
+
+        start = self.offsets[firstId - self.firstId]
+        end = self.offsets[lastId + 1 - self.firstId] if lastId + 1 < self.endId() else self.size
+
+        data = os.pread(self.fd, end - start, start)
+
+        records = []
+        position = 0
+
+        while position < len(data):
+            size = HEADER.unpack_from(data, position)[0]
+            position += HEADER_LENGTH
+            records.append(data[position:position + size])
+            position += size
+
+        return records
+
+    def close(self):
+        os.close(self.fd)
+
+class History:
+    '''Historico persistente das mensagens publicas de bate-papo: um log somente de acrescimo,
+    dividido em segmentos de ate SEGMENT_SIZE bytes no diretorio 'directory'. Cada mensagem
+    recebe um identificador crescente e e gravada com o mesmo enquadramento das mensagens da
+    rede (header de 4 bytes com o tamanho, seguido do objeto em JSON).
+
+    append() apenas enfileira a mensagem e retorna seu identificador, sem tocar no disco: uma
+    thread escritora grava de uma vez tudo o que se acumulou em COMMIT_INTERVAL, com um unico
+    fsync por lote (group commit), e so entao a torna visivel nas consultas. Os indices ficam
+    em memoria: a posicao de cada mensagem no seu segmento e os identificadores das mensagens
+    de cada sala, de modo que last() e since() leem do disco apenas as mensagens retornadas.
+    Ao iniciar, os indices sao reconstruidos a partir dos segmentos, e uma mensagem gravada
+    pela metade no fim do ultimo segmento (queda durante a escrita) e descartada'''
+
+    def __init__(self, directory, segmentSize=SEGMENT_SIZE, commitInterval=COMMIT_INTERVAL):
+        self.directory = directory
+        self.segmentSize = segmentSize
+        self.commitInterval = commitInterval
+
+        # protege as mensagens pendentes e os indices, compartilhados com a thread escritora
+        self.condition = threading.Condition()
+
+        # (identificador, sala, bytes enquadrados) das mensagens aguardando gravacao
+        self.pending = []
+
+        # segmentos em ordem de identificadores, e o primeiro identificador de cada um (para busca binaria)
+        self.segments = []
+        self.firstIds = []
+
+        # nome da sala -> identificadores das suas mensagens ja gravadas, em ordem crescente
+        self.rooms = {}
+
+        # identificador da proxima mensagem
+        self.nextId = 1
+
+        self.closed = False
+
+        os.makedirs(directory, exist_ok=True)
+        self.recover()
+
+        # arquivo do ultimo segmento, aberto para acrescimo pela thread escritora
+        self.file = open(self.segments[-1].path, 'ab')
+
+        self.writer = threading.Thread(target=self.writeLoop, daemon=True)
+        self.writer.start()
+
+    def recover(self):
+        '''Reconstroi os indices a partir dos segmentos existentes no diretorio'''
+
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX))
+
+        for name in names:
+            segment = Segment(os.path.join(self.directory, name), int(name[:-len(SEGMENT_SUFFIX)]))
+
+            with open(segment.path, 'rb') as file:
+                data = file.read()
+
+            position = 0
+
+            while position + HEADER_LENGTH <= len(data):
+                size = HEADER.unpack_from(data, position)[0]
+
+                # mensagem incompleta: o restante do arquivo e descartado
+                if position + HEADER_LENGTH + size > len(data):
+                    break
+
+                try:
+                    msgObject = JSON_CODEC.decode(memoryview(data)[position + HEADER_LENGTH:position + HEADER_LENGTH + size])
+                except DecodeError:
+                    break
+
+                self.rooms.setdefault(msgObject.get('room'), array.array('Q')).append(segment.endId())
+                segment.offsets.append(position)
+
+                position += HEADER_LENGTH + size
+
+            if position < len(data):
+                log.warning('Descartados bytes incompletos no fim do segmento', bytes=len(data) - position, path=segment.path)
+                os.truncate(segment.path, position)
+
+            segment.size = position
+            self.addSegment(segment)
+
+        if self.segments:
+            self.nextId = self.segments[-1].endId()
+        else:
+            self.addSegment(self.createSegment())
+
+        log.info('Historico recuperado', messages=self.nextId - 1, segments=len(self.segments), directory=self.directory)
+
+    # cria o arquivo de um novo segmento, que comeca no identificador da proxima mensagem
+    def createSegment(self):
+        return Segment(os.path.join(self.directory, f'{self.nextId:020d}{SEGMENT_SUFFIX}'), self.nextId)
+
+    def addSegment(self, segment):
+        self.segments.append(segment)
+        self.firstIds.append(segment.firstId)
+
+    def append(self, room, msgObject):
+        '''Enfileira a mensagem 'msgObject', da sala 'room', para gravacao
+        Saida: o identificador atribuido a mensagem (incluido no objeto gravado, no campo "id")'''
+
+        with self.condition:
+            if self.closed:
+                return None
+
+            msgId = self.nextId
+            self.nextId += 1
+
+            record = frameBytes(JSON_CODEC.encode(dict(msgObject, id=msgId)))
+            self.pending.append((msgId, room, record))
+
+            if len(self.pending) == 1:
+                self.condition.notify()
+
+        return msgId
+
+    def writeLoop(self):
+        '''Loop da thread escritora: grava as mensagens pendentes em lotes, com um fsync por lote'''
+
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+
+                if not self.pending:
+                    return
+
+            # deixa acumular as mensagens que chegarem durante a janela de gravacao
+            if self.commitInterval > 0 and not self.closed:
+                time.sleep(self.commitInterval)
+
+            with self.condition:
+                batch = self.pending
+                self.pending = []
+
+            self.writeBatch(batch)
+
+    def writeBatch(self, batch):
+        '''Grava um lote de mensagens no ultimo segmento (iniciando novos segmentos quando ele
+        atinge o tamanho maximo) e as torna visiveis nos indices'''
+
+        segment = self.segments[-1]
+        chunk = []
+        offsets = []
+        rotated = []
+        size = segment.size
+
+        for msgId, room, record in batch:
+
+            # segmento cheio: grava o que ja foi acumulado para ele e passa a um novo segmento
+            if size >= self.segmentSize and (offsets or segment.offsets):
+                self.writeChunk(chunk)
+                rotated.append((segment, offsets, size))
+
+                segment = Segment(os.path.join(self.directory, f'{msgId:020d}{SEGMENT_SUFFIX}'), msgId)
+                self.file.close()
+                self.file = open(segment.path, 'ab')
+                chunk, offsets, size = [], [], 0
+
+            offsets.append((size, room))
+            chunk.append(record)
+            size += len(record)
+
+        self.writeChunk(chunk)
+        rotated.append((segment, offsets, size))
+
+        # so depois do fsync as mensagens passam a ser retornadas pelas consultas
+        with self.condition:
+            for segment, offsets, size in rotated:
+                if segment is not self.segments[-1]:
+                    self.addSegment(segment)
+
+                for offset, room in offsets:
+                    self.rooms.setdefault(room, array.array('Q')).append(segment.endId())
+                    segment.offsets.append(offset)
+
+                segment.size = size
+
+    # grava os bytes das mensagens 'chunk' no arquivo atual e os leva ao disco
+    def writeChunk(self, chunk):
+        if not chunk:
+            return
+
+        self.file.write(b''.join(chunk))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def read(self, ids):
+        '''Le as mensagens de identificadores 'ids' (em ordem crescente), agrupando em uma unica
+        leitura as de identificadores consecutivos de um mesmo segmento
+        Saida: lista com os objetos das mensagens'''
+
+        messages = []
+        position = 0
+
+        while position < len(ids):
+            segment = self.segments[bisect.bisect_right(self.firstIds, ids[position]) - 1]
+
+            # estende o trecho enquanto os identificadores forem consecutivos e do mesmo segmento
+            end = position + 1
+
+            while end < len(ids) and ids[end] == ids[end - 1] + 1 and ids[end] < segment.endId():
+                end += 1
+
+            for record in segment.read(ids[position], ids[end - 1]):
+                messages.append(JSON_CODEC.decode(record))
+
+            position = end
+
+        return messages
+
+    def last(self, room, limit):
+        '''Saida: as ultimas 'limit' mensagens gravadas da sala 'room', da mais antiga para a mais recente'''
+
+        with self.condition:
+            ids = self.rooms.get(room)
+            ids = ids[-limit:].tolist() if ids and limit > 0 else []
+
+        return self.read(ids)
+
+    def since(self, room, lastId, limit):
+        '''Saida: ate 'limit' mensagens gravadas da sala 'room' com identificador maior que 'lastId',
+        da mais antiga para a mais recente'''
+
+        with self.condition:
+            ids = self.rooms.get(room)
+
+            if not ids or limit <= 0:
+                ids = []
+            else:
+                start = bisect.bisect_right(ids, lastId)
+                ids = ids[start:start + limit].tolist()
+
+        return self.read(ids)
+
+    def close(self):
+        '''Grava as mensagens pendentes e encerra o historico'''
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+        self.writer.join()
+        self.file.close()
+
+        for segment in self.segments:
+            segment.close()
@@ -0,0 +1,241 @@
+import bisect
+import http.server
+import math
+import threading
+import weakref
+
+# limites superiores padrao dos buckets dos histogramas de duracao, em segundos
+DURATION_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# limites superiores padrao dos buckets dos histogramas de tamanho (quantidade de destinatarios)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8' # formato de exposicao do Prometheus
+
+class ThreadMarker:
+    '''Objeto guardado no armazenamento local de uma thread, descartado quando ela termina'''
+
+class Shards:
+    '''Valores de uma metrica divididos por thread: cada thread atualiza apenas a sua propria
+    lista de valores, criada na primeira atualizacao, de modo que as atualizacoes nao usam locks
+    nem alocam memoria; a leitura (na exposicao) soma as listas de todas as threads. Quando uma
+    thread termina (no modo threads, a cada conexao encerrada), sua lista e somada aos valores
+    das threads encerradas e descartada'''
+
+    def __init__(self, size):
+        self.size = size
+        self.local = threading.local()
+
+        # listas de valores das threads ativas, pelo id da lista, e soma das threads encerradas
+        # (protegidas pelo lock apenas na criacao e no descarte de uma lista)
+        self.cells = {}
+        self.retired = [0] * size
+        self.lock = threading.Lock()
+
+    # lista de valores da thread atual
+    def cell(self):
+        try:
+            return self.local.cell
+        except AttributeError:
+            cell = self.local.cell = [0] * self.size
+
+            with self.lock:
+                self.cells[id(cell)] = cell
+
+            # o marcador e descartado junto com o armazenamento local quando a thread termina
+            marker = self.local.marker = ThreadMarker()
+            weakref.finalize(marker, self.retire, cell)
+
+            return cell
+
+    def retire(self, cell):
+        with self.lock:
+            del self.cells[id(cell)]
+            self.retired = [retired + value for retired, value in zip(self.retired, cell)]
+
+    # soma dos valores de todas as threads, posicao a posicao
+    def total(self):
+        with self.lock:
+            return [sum(values) for values in zip(self.retired, *self.cells.values())]
+
+class Metric:
+    '''Metrica com nome, descricao e, opcionalmente, rotulos: labels(*valores) retorna a serie
+    desses valores, criada no primeiro uso (as series ja criadas sao lidas sem lock)'''
+
+    def __init__(self, name, description, labelNames=()):
+        self.name = name
+        self.description = description
+        self.labelNames = labelNames
+
+        # valores dos rotulos -> serie
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.newChild())
+
+        return child
+
+    # rotulos da serie de valores 'values', no formato de exposicao
+    def labelText(self, values, extra=''):
+        pairs = [f'{name}="{escape(value)}"' for name, value in zip(self.labelNames, values)]
+
+        if extra:
+            pairs.append(extra)
+
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def series(self):
+        '''Saida: lista de (valores dos rotulos, serie), sem rotulos: a propria metrica'''
+
+        if not self.labelNames:
+            return [((), self)]
+
+        with self.lock:
+            return sorted(self.children.items())
+
+class Counter(Metric):
+    '''Contador crescente'''
+
+    type = 'counter'
+
+    def __init__(self, name, description, labelNames=()):
+        super().__init__(name, description, labelNames)
+        self.shards = Shards(1)
+
+    def newChild(self):
+        return Counter(self.name, self.description)
+
+    def inc(self, amount=1):
+        self.shards.cell()[0] += amount
+
+    def value(self):
+        return self.shards.total()[0]
+
+    def expose(self):
+        lines = []
+
+        for values, series in self.series():
+            lines.append(f'{self.name}{self.labelText(values)} {formatValue(series.value())}')
+
+        return lines
+
+class Histogram(Metric):
+    '''Histograma com buckets de limites superiores 'buckets' (em ordem crescente)'''
+
+    type = 'histogram'
+
+    def __init__(self, name, description, buckets=DURATION_BUCKETS, labelNames=()):
+        super().__init__(name, description, labelNames)
+        self.buckets = tuple(buckets)
+
+        # uma posicao por bucket, mais o bucket +Inf, a soma e a contagem das observacoes
+        self.shards = Shards(len(self.buckets) + 3)
+
+    def newChild(self):
+        return Histogram(self.name, self.description, self.buckets)
+
+    def observe(self, value):
+        cell = self.shards.cell()
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-2] += value
+        cell[-1] += 1
+
+    def expose(self):
+        lines = []
+
+        for values, series in self.series():
+            total = series.shards.total()
+            cumulative = 0
+
+            for bound, count in zip(self.buckets + (math.inf,), total):
+                cumulative += count
+                le = 'le="+Inf"' if bound == math.inf else f'le="{formatValue(bound)}"'
+                lines.append(f'{self.name}_bucket{self.labelText(values, le)} {cumulative}')
+
+            lines.append(f'{self.name}_sum{self.labelText(values)} {formatValue(total[-2])}')
+            lines.append(f'{self.name}_count{self.labelText(values)} {total[-1]}')
+
+        return lines
+
+class Gauge(Metric):
+    '''Valor instantaneo, calculado pela funcao 'function' a cada exposicao (sem custo entre elas)'''
+
+    type = 'gauge'
+
+    def __init__(self, name, description, function):
+        super().__init__(name, description)
+        self.function = function
+
+    def expose(self):
+        return [f'{self.name} {formatValue(self.function())}']
+
+class Registry:
+    '''Conjunto de metricas expostas juntas'''
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, description, labelNames=()):
+        return self.register(Counter(name, description, labelNames))
+
+    def histogram(self, name, description, buckets=DURATION_BUCKETS, labelNames=()):
+        return self.register(Histogram(name, description, buckets, labelNames))
+
+    def gauge(self, name, description, function):
+        return self.register(Gauge(name, description, function))
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def expose(self):
+        '''Saida: todas as metricas, no formato de exposicao de texto do Prometheus'''
+
+        lines = []
+
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.description}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.expose())
+
+        return '\n'.join(lines) + '\n'
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def formatValue(value):
+    if isinstance(value, float):
+        return repr(value) if math.isfinite(value) else ('+Inf' if value > 0 else '-Inf')
+
+    return str(value)
+
+def serve(registry, port, host='127.0.0.1'):
+    '''Expoe as metricas de 'registry' por HTTP (GET em qualquer caminho), em uma thread propria
+    Saida: o servidor HTTP iniciado'''
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            body = registry.expose().encode()
+
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # as requisicoes nao sao registradas na saida do servidor
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
@@ -0,0 +1,134 @@
+import collections
+import os
+import sys
+import threading
+import time
+
+INTERVAL = 0.01 # intervalo, em segundos, entre duas amostras das pilhas das threads
+
+TOP_FUNCTIONS = 50 # quantidade de funcoes listadas no resumo por funcao
+
+class Profiler:
+    '''Perfilador por amostragem: uma thread propria copia, a cada 'interval' segundos, a pilha
+    de chamadas de todas as demais threads (sys._current_frames), sem instrumentar as funcoes,
+    de modo que o custo independe da quantidade de chamadas e pode ficar ligado em producao.
+    No modo asyncio, a pilha da thread do loop de eventos mostra a corotina em execucao.
+
+    dump() grava as pilhas acumuladas desde o ultimo dump no formato "colapsado" (uma linha por
+    pilha, com as funcoes separadas por ';' e a quantidade de amostras, aceito pelo flamegraph.pl
+    e pelo speedscope) e um resumo com o tempo proprio e o tempo total de cada funcao. Threads
+    bloqueadas (ex.: aguardando dados de um cliente) tambem sao amostradas, na funcao em que
+    estao esperando'''
+
+    def __init__(self, directory, interval=INTERVAL):
+        self.directory = directory
+        self.interval = interval
+
+        # protege as pilhas acumuladas, compartilhadas entre a thread de amostragem e quem chama dump()
+        self.lock = threading.Lock()
+
+        # pilha (tupla de nomes de funcoes, da mais externa para a mais interna) -> amostras
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.start = time.time()
+
+        # objeto de codigo -> nome da funcao no relatorio
+        self.labels = {}
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sampleLoop, name='perfilador', daemon=True)
+
+        os.makedirs(directory, exist_ok=True)
+
+    def run(self):
+        self.thread.start()
+
+    def label(self, code):
+        name = self.labels.get(code)
+
+        if name is None:
+            name = self.labels[code] = f'{getattr(code, "co_qualname", code.co_name)} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+        return name
+
+    def sampleLoop(self):
+        own = threading.get_ident()
+
+        while not self.stopped.wait(self.interval):
+            frames = sys._current_frames()
+            frame = None
+
+            stacks = []
+
+            for ident, frame in frames.items():
+                if ident == own:
+                    continue
+
+                stack = []
+
+                while frame is not None:
+                    stack.append(self.label(frame.f_code))
+                    frame = frame.f_back
+
+                if stack:
+                    stack.reverse()
+                    stacks.append(tuple(stack))
+
+            # libera as referencias aos frames antes da proxima espera
+            del frames, frame
+
+            with self.lock:
+                self.stacks.update(stacks)
+                self.samples += 1
+
+    def dump(self):
+        '''Grava as pilhas e o resumo por funcao acumulados desde o ultimo dump e recomeca a contagem
+        Saida: os caminhos dos dois arquivos gravados'''
+
+        with self.lock:
+            stacks, self.stacks = self.stacks, collections.Counter()
+            samples, self.samples = self.samples, 0
+            start, self.start = self.start, time.time()
+
+        name = f'perfil-{os.getpid()}-{time.strftime("%Y%m%d-%H%M%S")}'
+        stacksPath = os.path.join(self.directory, name + '.folded')
+        summaryPath = os.path.join(self.directory, name + '.txt')
+
+        with open(stacksPath, 'w') as file:
+            for stack, count in stacks.most_common():
+                file.write(f"{';'.join(stack)} {count}\n")
+
+        with open(summaryPath, 'w') as file:
+            file.write(self.summary(stacks, samples, time.time() - start))
+
+        return stacksPath, summaryPath
+
+    def summary(self, stacks, samples, elapsed):
+        '''Saida: texto com o tempo proprio (a funcao no topo da pilha) e o tempo total (a funcao
+        em qualquer posicao da pilha) estimados de cada funcao, somados entre as threads'''
+
+        own = collections.Counter()
+        total = collections.Counter()
+
+        for stack, count in stacks.items():
+            own[stack[-1]] += count
+
+            # uma funcao recursiva conta uma unica vez em cada pilha
+            for function in set(stack):
+                total[function] += count
+
+        lines = [
+            f'{samples} amostras em {elapsed:.1f} s (intervalo de {self.interval * 1000:g} ms), '
+            f'{sum(stacks.values())} pilhas de threads',
+            '',
+            f'{"proprio (ms)":>13} {"total (ms)":>13}  funcao'
+        ]
+
+        for function, count in own.most_common(TOP_FUNCTIONS):
+            lines.append(f'{count * self.interval * 1000:13.0f} {total[function] * self.interval * 1000:13.0f}  {function}')
+
+        return '\n'.join(lines) + '\n'
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
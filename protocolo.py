@@ -0,0 +1,531 @@
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+FORMAT = 'utf-8' # formato utilizado para codificar/decodificar as mensagens
+
+HEADER_LENGTH = 4 # tamanho do header utilizado para enviar o tamanho em bytes da mensagem
+
+MAX_FRAME_SIZE = 16 * 1024 * 1024 # tamanho maximo padrao, em bytes, do corpo de uma mensagem recebida
+
+BUFFER_SIZE = 4 * 1024 # tamanho base do buffer de recebimento de cada conexao (alocado no primeiro uso)
+
+MIN_READ_SIZE = 4096 # espaco livre minimo no buffer antes de cada leitura do socket
+
+# formato do header: inteiro de 4 bytes sem sinal, big-endian
+HEADER = struct.Struct('>I')
+
+# bit mais significativo do header: indica um lote, cujo corpo e uma sequencia de mensagens
+# enquadradas normalmente (o tamanho de uma mensagem nunca chega a 2 GiB, entao o bit esta livre)
+BATCH_FLAG = 0x80000000
+
+class FrameTooLargeError(Exception):
+    '''O header de uma mensagem recebida anuncia um tamanho acima do limite do decodificador'''
+
+    def __init__(self, size, limit):
+        super().__init__(f'mensagem de {size} bytes excede o limite de {limit} bytes')
+        self.size = size
+        self.limit = limit
+
+def frameBytes(payload):
+    '''Adiciona o header com o tamanho em bytes ao corpo 'payload', ja codificado
+    Saida: um buffer imutavel (memoryview) que pode ser enviado para varios destinatarios
+    sem novas copias'''
+
+    frame = bytearray(HEADER_LENGTH + len(payload))
+    HEADER.pack_into(frame, 0, len(payload))
+    frame[HEADER_LENGTH:] = payload
+
+    return memoryview(frame).toreadonly()
+
+def frameMessage(msg):
+    '''Codifica a mensagem 'msg' e adiciona o header com seu tamanho em bytes (do texto ja
+    codificado, e nao em caracteres), uma unica vez
+    Entrada: a string da mensagem
+    Saida: um buffer imutavel (memoryview) que pode ser enviado para varios destinatarios
+    sem novas copias'''
+
+    return frameBytes(msg.encode(FORMAT))
+
+def frameBatch(frames):
+    '''Agrupa mensagens ja enquadradas em um unico lote, enviado com uma unica escrita
+    Entrada: lista de buffers de mensagens enquadradas
+    Saida: os bytes do lote (header com BATCH_FLAG seguido das mensagens)'''
+
+    total = sum(len(frame) for frame in frames)
+
+    return b''.join([HEADER.pack(BATCH_FLAG | total)] + frames)
+
+class FrameDecoder:
+    '''Decodificador incremental de mensagens enquadradas (header de 4 bytes com o tamanho +
+    corpo). Os bytes recebidos sao lidos diretamente (recv_into) para um buffer reutilizado
+    durante toda a conexao, e as mensagens completas sao devolvidas como memoryviews desse
+    buffer, sem copias. Uma unica leitura do socket pode conter varias mensagens pequenas,
+    que sao todas extraidas antes da proxima chamada de sistema.
+
+    O buffer so e alocado no primeiro uso, com 'capacity' bytes, e cresce apenas para receber
+    uma mensagem maior; depois que ela e consumida e o buffer esvazia, ele volta a ser
+    liberado, de modo que conexoes ociosas ocupam pouca memoria.
+
+    As memoryviews devolvidas so sao validas ate a proxima chamada de recvFrom ou feed, que
+    podem reaproveitar o espaco do buffer: quem as recebe deve decodifica-las (ou copia-las)
+    antes de ler mais dados.
+
+    Mensagens cujo header anuncia mais de 'maxFrameSize' bytes geram FrameTooLargeError assim
+    que o header e lido, antes de qualquer alocacao para o corpo.
+
+    Lotes (header com BATCH_FLAG) sao transparentes: o header do lote e descartado e as
+    mensagens contidas nele sao entregues uma a uma, como se tivessem chegado separadas'''
+
+    def __init__(self, capacity=BUFFER_SIZE, maxFrameSize=MAX_FRAME_SIZE):
+        self.maxFrameSize = maxFrameSize
+        self.capacity = capacity
+
+        # vazio ate a primeira leitura
+        self.buffer = bytearray()
+        self.view = memoryview(self.buffer)
+
+        # inicio dos dados ainda nao consumidos e fim dos dados recebidos no buffer
+        self.start = 0
+        self.end = 0
+
+        # espaco necessario para completar a mensagem parcialmente recebida, se houver
+        self.needed = 0
+
+    def reserve(self, size):
+        '''Garante pelo menos 'size' bytes livres no fim do buffer, movendo os dados pendentes
+        (uma mensagem parcial) para o inicio e, se preciso, aumentando o buffer'''
+
+        pending = self.end - self.start
+
+        # se o buffer esta vazio, volta a escrever no inicio
+        if pending == 0:
+            self.start = self.end = 0
+
+            # um buffer aumentado para uma mensagem grande e liberado; o proximo tem o tamanho base
+            if len(self.buffer) > self.capacity:
+                self.buffer = bytearray()
+                self.view = memoryview(self.buffer)
+
+        if len(self.buffer) - self.end >= size and len(self.buffer) - self.start >= self.needed:
+            return
+
+        capacity = max(len(self.buffer), self.capacity)
+
+        while capacity - pending < max(size, self.needed - pending):
+            capacity *= 2
+
+        # aloca um novo buffer apenas quando o atual nao comporta a mensagem; as memoryviews
+        # ja entregues continuam validas, pois apontam para o buffer antigo
+        if capacity > len(self.buffer):
+            buffer = bytearray(capacity)
+            buffer[:pending] = self.view[self.start:self.end]
+
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+
+        # caso contrario, apenas move a mensagem parcial para o inicio do buffer
+        elif self.start > 0:
+            self.view[:pending] = bytes(self.view[self.start:self.end])
+
+        self.start = 0
+        self.end = pending
+
+    def recvFrom(self, sock):
+        '''Le do socket diretamente para o espaco livre do buffer (uma chamada de sistema)
+        Saida: a quantidade de bytes lidos; 0 indica que a conexao foi encerrada'''
+
+        self.reserve(MIN_READ_SIZE)
+
+        received = sock.recv_into(self.view[self.end:])
+        self.end += received
+
+        return received
+
+    def feed(self, data):
+        '''Acrescenta ao buffer os bytes 'data', obtidos por outro meio (ex.: streams asyncio)'''
+
+        self.reserve(len(data))
+
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def nextFrame(self):
+        '''Extrai a proxima mensagem completa do buffer
+        Saida: memoryview com o corpo da mensagem, ou None se ainda nao ha mensagem completa
+        Excecao: FrameTooLargeError se a proxima mensagem excede o tamanho maximo'''
+
+        while True:
+            available = self.end - self.start
+
+            if available < HEADER_LENGTH:
+                return None
+
+            # desempacota os 4 bytes do header que contém o tamanho da mensagem
+            msgSize = HEADER.unpack_from(self.buffer, self.start)[0]
+
+            # mensagem comum
+            if not msgSize & BATCH_FLAG:
+                break
+
+            # inicio de um lote: descarta seu header e segue para a primeira mensagem contida nele
+            self.start += HEADER_LENGTH
+
+        # recusa a mensagem antes de reservar espaco para ela
+        if msgSize > self.maxFrameSize:
+            raise FrameTooLargeError(msgSize, self.maxFrameSize)
+
+        # mensagem ainda incompleta: registra o espaco necessario para recebe-la inteira
+        if available < HEADER_LENGTH + msgSize:
+            self.needed = HEADER_LENGTH + msgSize
+            return None
+
+        self.needed = 0
+
+        bodyStart = self.start + HEADER_LENGTH
+        self.start = bodyStart + msgSize
+
+        return self.view[bodyStart:self.start]
+
+    def frames(self):
+        '''Gera todas as mensagens completas disponiveis no buffer'''
+
+        while True:
+            frame = self.nextFrame()
+
+            if frame is None:
+                return
+
+            yield frame
+
+MAX_DEPTH = 32 # quantidade maxima de listas e mapas aninhados em uma mensagem recebida
+
+class DecodeError(ValueError):
+    '''O corpo de uma mensagem recebida nao pode ser decodificado pelo codec da conexao'''
+
+# verifica se o valor decodificado 'msgObject' e um objeto de mensagem (um mapa no nivel mais externo)
+def checkMessage(msgObject, codec):
+    if not isinstance(msgObject, dict):
+        raise DecodeError(f'mensagem {codec} malformada: o valor mais externo nao e um objeto')
+
+    return msgObject
+
+class JsonCodec:
+    '''Codec padrao: objetos da mensagem em JSON (UTF-8)'''
+
+    name = 'json'
+
+    def encode(self, msgObject):
+        return json.dumps(msgObject).encode(FORMAT)
+
+    def decode(self, payload):
+        try:
+            msgObject = json.loads(str(payload, FORMAT))
+
+        # RecursionError: valores aninhados alem do limite do interpretador
+        except (ValueError, RecursionError) as e:
+            raise DecodeError(str(e)) from e
+
+        return checkMessage(msgObject, self.name)
+
+# identificadores numericos dos tipos de mensagem no codec binario (a ordem nao pode mudar:
+# novos tipos sao sempre acrescentados ao final)
+MESSAGE_TYPES = [
+    None,
+    'connection-request',
+    'connection-response',
+    'disconnection-request',
+    'disconnection-response',
+    'chat-message',
+    'user-joined',
+    'user-left',
+    'room-join',
+    'room-leave',
+    'room-list',
+    'room-joined',
+    'room-list-response',
+    'history-request',
+    'history-response',
+    'presence-request',
+    'presence-response',
+    'presence-delta',
+    'ping',
+    'pong',
+]
+
+# identificadores numericos dos campos das mensagens no codec binario (mesma regra de MESSAGE_TYPES)
+FIELD_NAMES = [
+    'type',
+    'name',
+    'codec',
+    'success',
+    'users_list',
+    'error_msg',
+    'private',
+    'sender',
+    'receiver',
+    'message',
+    'host',
+    'port',
+    'batch',
+    'room',
+    'rooms',
+    'members',
+    'id',
+    'limit',
+    'since',
+    'messages',
+    'presence',
+    'version',
+    'total',
+    'after',
+    'next',
+    'joined',
+    'left',
+]
+
+TYPE_TAGS = {msgType: tag for tag, msgType in enumerate(MESSAGE_TYPES)}
+FIELD_TAGS = {field: tag for tag, field in enumerate(FIELD_NAMES)}
+
+# campo sem identificador numerico: seu nome segue como string
+UNKNOWN_FIELD = 0xFF
+
+# marcadores de tipo dos valores no codec binario
+NONE, FALSE, TRUE, INT16, INT64, FLOAT, STR8, STR32, LIST, MAP = range(10)
+
+# bytes isolados pre-construidos, para nao empacotar marcadores e identificadores a cada uso
+BYTES = [bytes((value,)) for value in range(256)]
+
+UINT16 = struct.Struct('>H')
+UINT32 = struct.Struct('>I')
+INT16_STRUCT = struct.Struct('>h')
+INT64_STRUCT = struct.Struct('>q')
+FLOAT_STRUCT = struct.Struct('>d')
+
+class BinaryCodec:
+    '''Codec binario compacto: um byte com o identificador do tipo da mensagem seguido dos
+    demais campos, cujos nomes sao substituidos por identificadores de um byte e cujos valores
+    levam um marcador de tipo de um byte. Strings sao prefixadas pelo seu tamanho em bytes
+    (1 byte ate 255 bytes, 4 bytes acima disso), inteiros pequenos ocupam 2 bytes. Tipos de
+    mensagem e campos fora das tabelas continuam suportados, enviados pelo nome'''
+
+    name = 'binary'
+
+    def encode(self, msgObject):
+        parts = []
+
+        msgType = msgObject.get('type')
+        tag = TYPE_TAGS.get(msgType, 0)
+
+        parts.append(BYTES[tag])
+
+        # tipo desconhecido: o campo 'type' segue no mapa com os demais
+        fields = {key: value for key, value in msgObject.items() if key != 'type' or tag == 0}
+
+        self.encodeMap(fields, parts)
+
+        return b''.join(parts)
+
+    def encodeMap(self, fields, parts):
+        parts.append(BYTES[MAP] + UINT16.pack(len(fields)))
+
+        for key, value in fields.items():
+            fieldTag = FIELD_TAGS.get(key)
+
+            if fieldTag is None:
+                parts.append(BYTES[UNKNOWN_FIELD])
+                self.encodeString(key, parts)
+            else:
+                parts.append(BYTES[fieldTag])
+
+            self.encodeValue(value, parts)
+
+    def encodeString(self, value, parts):
+        data = value.encode(FORMAT)
+
+        if len(data) <= 0xFF:
+            parts.append(BYTES[STR8] + BYTES[len(data)])
+        else:
+            parts.append(BYTES[STR32] + UINT32.pack(len(data)))
+
+        parts.append(data)
+
+    def encodeValue(self, value, parts):
+        if value is None:
+            parts.append(BYTES[NONE])
+
+        elif value is True:
+            parts.append(BYTES[TRUE])
+
+        elif value is False:
+            parts.append(BYTES[FALSE])
+
+        elif isinstance(value, str):
+            self.encodeString(value, parts)
+
+        elif isinstance(value, int):
+            if -0x8000 <= value <= 0x7FFF:
+                parts.append(BYTES[INT16] + INT16_STRUCT.pack(value))
+            else:
+                parts.append(BYTES[INT64] + INT64_STRUCT.pack(value))
+
+        elif isinstance(value, float):
+            parts.append(BYTES[FLOAT] + FLOAT_STRUCT.pack(value))
+
+        elif isinstance(value, (list, tuple)):
+            parts.append(BYTES[LIST] + UINT32.pack(len(value)))
+
+            for item in value:
+                self.encodeValue(item, parts)
+
+        elif isinstance(value, dict):
+            self.encodeMap(value, parts)
+
+        else:
+            raise TypeError(f'valor de tipo {type(value).__name__} nao suportado pelo codec binario')
+
+    def decode(self, payload):
+        try:
+            tag = payload[0]
+
+            msgObject, position = self.decodeValue(payload, 1)
+
+            if position != len(payload):
+                raise DecodeError('mensagem binaria malformada: bytes apos o valor')
+
+            checkMessage(msgObject, self.name)
+
+            if tag != 0:
+                msgObject['type'] = MESSAGE_TYPES[tag]
+
+            return msgObject
+
+        except DecodeError:
+            raise
+
+        # qualquer outra falha (buffer curto, identificador ou UTF-8 invalido...) e uma mensagem malformada
+        except Exception as e:
+            raise DecodeError(f'mensagem binaria malformada: {e}') from e
+
+    def decodeValue(self, payload, position, depth=0):
+        '''Saida: o valor que comeca em 'position' e a posicao seguinte a ele; 'depth' e a
+        quantidade de listas e mapas que o contem'''
+
+        marker = payload[position]
+        position += 1
+
+        if marker in (LIST, MAP) and depth >= MAX_DEPTH:
+            raise DecodeError(f'mensagem binaria com mais de {MAX_DEPTH} niveis aninhados')
+
+        if marker == NONE:
+            return None, position
+
+        if marker == TRUE:
+            return True, position
+
+        if marker == FALSE:
+            return False, position
+
+        if marker == STR8:
+            size = payload[position]
+            position += 1
+            return str(payload[position:position + size], FORMAT), position + size
+
+        if marker == STR32:
+            size = UINT32.unpack_from(payload, position)[0]
+            position += 4
+            return str(payload[position:position + size], FORMAT), position + size
+
+        if marker == INT16:
+            return INT16_STRUCT.unpack_from(payload, position)[0], position + 2
+
+        if marker == INT64:
+            return INT64_STRUCT.unpack_from(payload, position)[0], position + 8
+
+        if marker == FLOAT:
+            return FLOAT_STRUCT.unpack_from(payload, position)[0], position + 8
+
+        if marker == LIST:
+            count = UINT32.unpack_from(payload, position)[0]
+            position += 4
+
+            items = []
+
+            for _ in range(count):
+                item, position = self.decodeValue(payload, position, depth + 1)
+                items.append(item)
+
+            return items, position
+
+        if marker == MAP:
+            count = UINT16.unpack_from(payload, position)[0]
+            position += 2
+
+            fields = {}
+
+            for _ in range(count):
+                fieldTag = payload[position]
+                position += 1
+
+                if fieldTag == UNKNOWN_FIELD:
+                    key, position = self.decodeValue(payload, position, depth + 1)
+
+                    # nomes de campos fora da tabela sao sempre strings
+                    if not isinstance(key, str):
+                        raise DecodeError('mensagem binaria malformada: nome de campo nao e uma string')
+                else:
+                    key = FIELD_NAMES[fieldTag]
+
+                fields[key], position = self.decodeValue(payload, position, depth + 1)
+
+            return fields, position
+
+        raise DecodeError(f'marcador de valor desconhecido: {marker}')
+
+class MsgpackCodec:
+    '''Codec binario implementado pela extensao msgpack (disponivel apenas se instalada)'''
+
+    name = 'msgpack'
+
+    def encode(self, msgObject):
+        return msgpack.packb(msgObject)
+
+    def decode(self, payload):
+        try:
+            msgObject = msgpack.unpackb(payload)
+        except Exception as e:
+            raise DecodeError(str(e)) from e
+
+        return checkMessage(msgObject, self.name)
+
+JSON_CODEC = JsonCodec()
+
+# codecs que podem ser negociados no connection-request, pelo nome
+CODECS = {
+    JSON_CODEC.name: JSON_CODEC,
+    BinaryCodec.name: BinaryCodec(),
+}
+
+if msgpack is not None:
+    CODECS[MsgpackCodec.name] = MsgpackCodec()
+
+class EncodedMessage:
+    '''Mensagem a ser enviada para um ou mais destinatarios. O objeto e codificado e enquadrado
+    no maximo uma vez por codec, na primeira vez em que um destinatario que usa esse codec
+    precisa dele; os demais recebem o mesmo buffer'''
+
+    def __init__(self, msgObject):
+        self.object = msgObject
+        self.frames = {}
+
+    def frame(self, codec):
+        frame = self.frames.get(codec.name)
+
+        if frame is None:
+            frame = self.frames[codec.name] = frameBytes(codec.encode(self.object))
+
+        return frame
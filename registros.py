@@ -0,0 +1,173 @@
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+
+QUEUE_SIZE = 100000 # quantidade maxima de registros aguardando a thread escritora (os excedentes sao descartados)
+
+LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR'] # niveis aceitos na linha de comando
+
+FORMATS = ['texto', 'json'] # formatos de saida dos registros
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    '''Handler que apenas coloca o registro na fila da thread escritora, sem formata-lo (a
+    mensagem e os campos sao formatados pela propria thread escritora) e sem nunca bloquear:
+    com a fila cheia, o registro e descartado e contado. Depois de fechado (stop), todo registro
+    e descartado, para que a fila se esvazie e a thread escritora possa ser encerrada'''
+
+    def __init__(self, recordQueue):
+        super().__init__(recordQueue)
+        self.dropped = 0
+        self.closed = False
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        if self.closed:
+            self.dropped += 1
+            return
+
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class DrainingQueueListener(logging.handlers.QueueListener):
+    '''Thread escritora cujo encerramento espera a fila abrir espaco para o sentinela (o padrao,
+    put_nowait, falha com a fila cheia), escrevendo antes os registros pendentes'''
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+class TextFormatter(logging.Formatter):
+    '''Formata o registro em uma linha: instante, nivel, origem, mensagem e campos (chave=valor)'''
+
+    def format(self, record):
+        line = f'{self.formatTime(record)} {record.levelname} {record.name}: {record.getMessage()}'
+
+        fields = getattr(record, 'fields', None)
+
+        if fields:
+            line += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+
+        return line
+
+class JsonFormatter(logging.Formatter):
+    '''Formata o registro como um objeto JSON por linha, com os campos no primeiro nivel'''
+
+    def format(self, record):
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+
+        entry.update(getattr(record, 'fields', None) or {})
+
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+class Logger:
+    '''Registro estruturado de um modulo: cada chamada recebe o texto do evento e campos nomeados, que
+    so sao formatados pela thread escritora (e nem chegam a ela se o nivel estiver desabilitado).
+
+    message() e usado para os registros feitos a cada mensagem tratada, que podem ser amostrados
+    (cada um e registrado com a probabilidade configurada) ou desligados por completo com setup()'''
+
+    def __init__(self, name):
+        self.logger = logging.getLogger(name)
+
+    def log(self, level, text, fields):
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, text, extra={'fields': fields})
+
+    def debug(self, text, **fields):
+        self.log(logging.DEBUG, text, fields)
+
+    def info(self, text, **fields):
+        self.log(logging.INFO, text, fields)
+
+    def warning(self, text, **fields):
+        self.log(logging.WARNING, text, fields)
+
+    def error(self, text, **fields):
+        self.log(logging.ERROR, text, fields)
+
+    # registra, no nivel ERROR, o texto, os campos e a excecao sendo tratada (chamada em um bloco except)
+    def exception(self, text, **fields):
+        if self.logger.isEnabledFor(logging.ERROR):
+            self.logger.error(text, exc_info=True, extra={'fields': fields})
+
+    def message(self, text, **fields):
+        '''Registra, no nivel INFO, um evento de mensagem tratada, respeitando a amostragem'''
+
+        if sampleRate >= 1 or (sampleRate > 0 and random.random() < sampleRate):
+            self.log(logging.INFO, text, fields)
+
+# fracao dos registros por mensagem que e registrada (0 os desliga)
+sampleRate = 1.0
+
+# handler da fila e thread escritora, criados por setup()
+handler = None
+listener = None
+
+def getLogger(name):
+    return Logger(name)
+
+def setup(level='INFO', format='texto', path=None, sampleRate=1.0):
+    '''Configura o registro: nivel minimo 'level', formato 'format' (texto ou json), arquivo 'path'
+    (saida padrao se None) e fracao 'sampleRate' dos registros por mensagem (0 os desliga). Os
+    registros sao escritos por uma thread propria, a partir de uma fila limitada'''
+
+    global handler, listener
+
+    stop()
+
+    setSampleRate(sampleRate)
+
+    output = logging.StreamHandler(sys.stdout) if path is None else logging.FileHandler(path)
+    output.setFormatter(JsonFormatter() if format == 'json' else TextFormatter())
+
+    recordQueue = queue.Queue(QUEUE_SIZE)
+
+    handler = DroppingQueueHandler(recordQueue)
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+
+    listener = DrainingQueueListener(recordQueue, output)
+    listener.start()
+
+def setSampleRate(rate):
+    global sampleRate
+    sampleRate = rate
+
+def stop():
+    '''Escreve os registros pendentes e encerra a thread escritora'''
+
+    global listener
+
+    if listener is not None:
+
+        # novos registros sao descartados: a fila apenas se esvazia ate o sentinela caber nela
+        handler.closed = True
+        listener.stop()
+
+        for output in listener.handlers:
+            output.close()
+
+        listener = None
+
+# quantidade de registros descartados por fila cheia
+def droppedRecords():
+    return handler.dropped if handler is not None else 0
@@ -0,0 +1,197 @@
+import argparse
+import mmap
+import selectors
+import socket
+import sys
+import time
+
+from captura import LEGACY_MAGIC, MAGIC, RECORD, RUN
+
+READ_SIZE = 64 * 1024 # quantidade maxima de bytes lidos de uma vez das respostas do servidor
+
+def readRecords(path):
+    '''Percorre um arquivo de captura mapeado em memoria, sem copiar nem decodificar as mensagens
+    Entrada: o caminho do arquivo
+    Saida: gerador de (instante, identificador da conexao, mensagem enquadrada), em que a
+    mensagem e um memoryview da propria area mapeada (vazio no fim da conexao) e o
+    identificador da conexao e o par (execucao do servidor, conexao nessa execucao); nos
+    arquivos do formato anterior, sem a execucao, o proprio arquivo faz as vezes dela'''
+
+    with open(path, 'rb') as file:
+
+        # arquivo vazio (captura interrompida antes de gravar o header)
+        if not file.read(len(MAGIC)):
+            return
+
+        mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    view = memoryview(mapping)
+
+    try:
+        if view[:len(MAGIC)] == MAGIC:
+
+            # captura interrompida antes de gravar o identificador da execucao
+            if len(view) < len(MAGIC) + RUN.size:
+                return
+
+            run, = RUN.unpack_from(view, len(MAGIC))
+            position = len(MAGIC) + RUN.size
+
+        elif view[:len(LEGACY_MAGIC)] == LEGACY_MAGIC:
+            run = path
+            position = len(LEGACY_MAGIC)
+
+        else:
+            raise ValueError(f'{path} nao e um arquivo de captura')
+
+        while position + RECORD.size <= len(view):
+            timestamp, connectionId, size = RECORD.unpack_from(view, position)
+            position += RECORD.size
+
+            # registro incompleto no fim do arquivo (captura interrompida)
+            if position + size > len(view):
+                break
+
+            frame = view[position:position + size]
+            position += size
+
+            try:
+                yield timestamp, (run, connectionId), frame
+            finally:
+                frame.release()
+
+    finally:
+        view.release()
+        mapping.close()
+
+class Replayer:
+    '''Reinjeta as mensagens de uma captura em um servidor, com uma conexao para cada conexao
+    capturada, respeitando os intervalos originais divididos por 'speed' (0 envia o mais
+    rapido possivel). As respostas do servidor sao lidas e descartadas enquanto se espera o
+    momento do proximo envio, para que as filas de saida do servidor nao encham'''
+
+    def __init__(self, address, speed):
+        self.address = address
+        self.speed = speed
+
+        # identificador (execucao, conexao) da conexao capturada -> socket da conexao reproduzida
+        self.connections = {}
+
+        self.selector = selectors.DefaultSelector()
+
+        self.frames = 0
+        self.sent = 0
+        self.received = 0
+
+    def run(self, paths):
+        '''Reproduz os arquivos de captura 'paths', em ordem'''
+
+        firstTimestamp = None
+        start = time.monotonic()
+
+        for path in paths:
+            for timestamp, connectionId, frame in readRecords(path):
+
+                if firstTimestamp is None:
+                    firstTimestamp = timestamp
+
+                # aguarda o momento do envio, lendo as respostas do servidor enquanto isso
+                if self.speed > 0:
+                    self.waitUntil(start + (timestamp - firstTimestamp) / self.speed)
+                else:
+                    self.waitUntil(0)
+
+                if len(frame) == 0:
+                    self.closeConnection(connectionId)
+                else:
+                    self.send(connectionId, frame)
+
+        # le as ultimas respostas antes de encerrar as conexoes
+        self.waitUntil(time.monotonic() + 0.5)
+
+        for connectionId in list(self.connections):
+            self.closeConnection(connectionId)
+
+        return time.monotonic() - start
+
+    def send(self, connectionId, frame):
+        connection = self.connections.get(connectionId)
+
+        if connection is None:
+            connection = self.connections[connectionId] = socket.create_connection(self.address)
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.selector.register(connection, selectors.EVENT_READ, connectionId)
+
+        try:
+            connection.sendall(frame)
+        except OSError:
+            self.closeConnection(connectionId)
+            return
+
+        self.frames += 1
+        self.sent += len(frame)
+
+    def closeConnection(self, connectionId):
+        connection = self.connections.pop(connectionId, None)
+
+        if connection is not None:
+            self.selector.unregister(connection)
+            connection.close()
+
+    def waitUntil(self, deadline):
+        '''Le e descarta as respostas do servidor ate o instante 'deadline' (de time.monotonic); com
+        o instante ja passado, le apenas as respostas ja disponiveis'''
+
+        while True:
+            remaining = deadline - time.monotonic()
+
+            if not self.connections:
+                if remaining > 0:
+                    time.sleep(remaining)
+
+                return
+
+            for key, _ in self.selector.select(max(remaining, 0)):
+                try:
+                    data = key.fileobj.recv(READ_SIZE)
+                except OSError:
+                    data = b''
+
+                if not data:
+                    self.closeConnection(key.data)
+                else:
+                    self.received += len(data)
+
+            if remaining <= 0:
+                return
+
+def main():
+    parser = argparse.ArgumentParser(description='Reproduz capturas do servidor de bate-papo contra um servidor local')
+
+    parser.add_argument('arquivos', nargs='+',
+                        help='arquivos de captura (.cap), na ordem em que foram gravados')
+
+    parser.add_argument('--host', default='localhost',
+                        help='maquina onde esta o servidor')
+
+    parser.add_argument('--porta', type=int, default=5000,
+                        help='porta do servidor')
+
+    parser.add_argument('--velocidade', type=float, default=1.0,
+                        help='fator de aceleracao em relacao aos intervalos originais (0: o mais rapido possivel)')
+
+    args = parser.parse_args()
+
+    replayer = Replayer((args.host, args.porta), args.velocidade)
+
+    try:
+        elapsed = replayer.run(args.arquivos)
+    except (OSError, ValueError) as e:
+        print('Falha na reproducao:', e)
+        sys.exit(1)
+
+    print(f'{replayer.frames} mensagens ({replayer.sent} bytes) reproduzidas em {elapsed:.3f} s; '
+          f'{replayer.received} bytes recebidos do servidor')
+
+if __name__ == '__main__':
+    main()
@@ -1,326 +1,2021 @@
+import argparse
+import asyncio
+import atexit
+import bisect
+import itertools
+import os
+import resource
+import signal
 import socket
 import select
-import struct
+import collections
 import sys
 import threading
-import json
-from json.decoder import JSONDecodeError
+import time
+
+import registros
+from barramento import Bus
+from cache import MAX_BYTES, MESSAGES_PER_ROOM, RecentMessages
+from captura import FILE_SIZE, MAX_FILES, Capture
+from historico import COMMIT_INTERVAL, History
+from metricas import SIZE_BUCKETS, Registry, serve
+from perfilador import INTERVAL, Profiler
+from protocolo import CODECS, HEADER_LENGTH, JSON_CODEC, TYPE_TAGS, DecodeError, EncodedMessage, FrameDecoder, FrameTooLargeError, frameBatch
+from temporizador import TICK, TimerWheel
 
 # localizacao do servidor
 HOST = '' # '' possibilita acessar qualquer endereco alcancavel da maquina local
 PORT = 5000 # porta onde chegarao as mensagens para essa aplicacao
 
-FORMAT = 'utf-8' # formato utilizado para codificar/decodificar as mensagens
+MAX_MESSAGE_SIZE = 64 * 1024 # tamanho maximo, em bytes, de uma mensagem enviada por um cliente
 
-HEADER_LENGTH = 4 # tamanho do header utilizado para enviar o tamanho em bytes da mensagem
+OUTBOUND_QUEUE_SIZE = 1024 # quantidade maxima de mensagens na fila de saida de cada cliente
+
+OVERFLOW_POLICY = 'drop-oldest' # o que fazer quando a fila de saida de um cliente enche
+
+DEFAULT_ROOM = 'geral' # sala em que os usuarios entram quando nao escolhem outra
+
+MAX_ROOM_NAME = 64 # tamanho maximo do nome de uma sala
+
+BATCH_WINDOW = 0 # tempo, em segundos, que o escritor espera para acumular mensagens em um lote (0 desabilita)
+
+BATCH_MAX_MESSAGES = 64 # quantidade maxima de mensagens em um lote
+
+LISTEN_BACKLOG = 1024 # limite de conexoes pendentes, em ambos os modos (suporta rajadas de conexoes)
+
+READ_SIZE = 64 * 1024 # quantidade maxima de bytes lidos de uma vez no modo asyncio
+
+HISTORY_LIMIT = 200 # quantidade maxima de mensagens em uma resposta de historico
+
+HISTORY_DEFAULT_LIMIT = 50 # quantidade de mensagens do historico enviadas quando o cliente nao informa o limite
+
+WORKERS = 1 # quantidade de processos servidores compartilhando a porta (1 desabilita o barramento)
+
+PRESENCE_INTERVAL = 0.1 # tempo, em segundos, em que as mudancas de presenca de uma sala sao agrupadas em um presence-delta
+
+PRESENCE_PAGE_SIZE = 500 # quantidade maxima de usuarios em uma pagina da lista de membros de uma sala
+
+PRESENCE_LOG_SIZE = 4096 # quantidade maxima de usuarios no registro de mudancas de presenca de cada sala
+
+PING_INTERVAL = 15.0 # tempo, em segundos, sem receber nada de um cliente apos o qual ele recebe um ping
+
+IDLE_TIMEOUT = 45.0 # tempo, em segundos, sem receber nada de um cliente no bate-papo apos o qual ele e desconectado (0 desabilita)
+
+JOIN_TIMEOUT = 10.0 # tempo, em segundos, que uma conexao fora do bate-papo (recem-aceita ou depois de sair) tem para entrar nele (0 desabilita)
 
 # lista de entradas (I/O) a serem observados pela aplicacao
 inputs = [sys.stdin]
 
-# armazena os sockets e endereços de clientes atualmente conectados a aplicacao
-connected_clients = {}
+# gerador dos identificadores das conexoes (usados na captura das mensagens recebidas)
+connectionIds = itertools.count(1)
+
+# registro dos eventos do servidor, escrito por uma thread propria (ver registros.py)
+log = registros.getLogger('servidor')
+
+
+def initialize():
+    '''Cria um socket para o servidor e o coloca em modo de espera por conexoes
+    Saida: o socket de servidor criado'''
+
+    # cria socket
+    serverSocket = socket.socket()
+
+    # permite o reuso da porta caso a aplicacao seja finalizada de forma abrupta
+    serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+    # com varios processos, cada um tem seu socket na mesma porta e o kernel distribui as conexoes
+    if WORKERS > 1:
+        serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+    # define o socket do servidor como nao-bloqueante
+    serverSocket.setblocking(False)
+
+    # vincula a interface e porta para comunicacao
+    serverSocket.bind((HOST, PORT))
+
+    # define o limite maximo de conexoes pendentes e coloca-se em modo de espera por conexao
+    serverSocket.listen(LISTEN_BACKLOG)
+
+    # adiciona o socket do servidor na lista de entradas da aplicacao
+    inputs.append(serverSocket)
+
+    return serverSocket
+
+def acceptConnection(serverSocket):
+    '''Estabelece conexao com um cliente
+    Entrada: o socket do servidor
+    Saida: a conexao criada e o endereco (IP, PORTA) do cliente'''
+
+    # Aceita o pedido de conexao do cliente
+    clientSocket, address = serverSocket.accept()
+
+    # cria a conexao, com sua fila de saida e thread escritora
+    connection = ThreadedConnection(clientSocket, address)
+
+    # Armazena a conexao no registro de conexoes ativas
+    registry.add(connection)
+
+    # a conexao tem um prazo para entrar no bate-papo
+    watchConnection(connection)
+
+    # imprime o par (IP,PORTA) da conexao estabelecida
+    log.info('Conexao estabelecida', address=address)
+
+    return connection, address
+
+class ClientConnection:
+    '''Conexao de um cliente com uma fila de saida limitada. Os tratadores de requisicoes apenas
+    enfileiram as mensagens com send(), sem nunca bloquear; o esvaziamento da fila e feito por
+    quem escreve no socket (uma thread no modo threads ou uma tarefa no modo asyncio), de forma
+    que um cliente lento nao atrasa quem envia a mensagem nem os demais destinatarios'''
+
+    def __init__(self, address):
+        self.address = address
+        self.id = next(connectionIds)
+
+        # mensagens (ja com header) aguardando envio
+        self.outbound = collections.deque()
+
+        # quantidade de mensagens descartadas por estouro da fila
+        self.dropped = 0
+
+        # nome do usuario e sala em que ele esta, preenchidos quando ele entra no bate-papo
+        self.name = None
+        self.room = None
+
+        # codec das mensagens da conexao; o negociado no connection-request vale ate a saida do bate-papo
+        self.codec = JSON_CODEC
+
+        # se o cliente aceita lotes de mensagens (negociado no connection-request)
+        self.batching = False
+
+        # se o cliente recebe a presenca versionada (presence-delta) no lugar de user-joined / user-left
+        self.presence = False
+
+        # se o cliente responde a pings (anunciado no connection-request; vale enquanto estiver no bate-papo)
+        self.heartbeat = False
+
+        # instante (time.monotonic) em que algo foi recebido do cliente pela ultima vez
+        self.lastActivity = time.monotonic()
+
+        # instante em que a conexao passou a estar fora do bate-papo (aceita ou saida), para o prazo de entrada
+        self.outsideSince = self.lastActivity
+
+        self.closed = False
+
+    def send(self, data):
+        '''Enfileira 'data' para envio ao cliente, aplicando a politica de estouro caso a fila
+        esteja cheia. Retorna False se a mensagem nao foi enfileirada'''
+
+        if self.closed:
+            return False
+
+        # fila cheia: cliente nao esta consumindo as mensagens na mesma taxa em que sao produzidas
+        if len(self.outbound) >= OUTBOUND_QUEUE_SIZE:
+
+            # desconecta o cliente lento
+            if OVERFLOW_POLICY == 'disconnect':
+                log.warning('Fila de saida cheia, desconectando o cliente', address=self.address)
+                self.abort()
+                return False
+
+            # descarta a mensagem mais antiga para abrir espaco para a nova
+            self.outbound.popleft()
+            self.dropped += 1
+            droppedMessages.inc()
+
+        self.outbound.append(data)
+
+        # acorda o escritor quando a fila deixa de estar vazia ou quando ja ha um lote completo
+        if len(self.outbound) == 1 or len(self.outbound) >= BATCH_MAX_MESSAGES:
+            self.wakeWriter()
+
+        return True
+
+    def takeBatch(self):
+        '''Retira da fila ate BATCH_MAX_MESSAGES mensagens e as junta em um unico buffer, enviado
+        com uma unica escrita: um lote, se o cliente os aceita, ou as mensagens concatenadas'''
+
+        count = min(len(self.outbound), BATCH_MAX_MESSAGES)
+
+        if count == 1:
+            return self.outbound.popleft()
+
+        frames = [self.outbound.popleft() for _ in range(count)]
+
+        if self.batching:
+            return frameBatch(frames)
+
+        return b''.join(frames)
+
+    # enfileira a mensagem 'message' (EncodedMessage) codificada no codec da conexao
+    def sendMessage(self, message):
+        frame = message.frame(self.codec)
+
+        messagesOut.labels(message.object['type']).inc()
+        bytesOut.inc(len(frame))
+
+        return self.send(frame)
+
+    # quantidade de mensagens aguardando envio
+    def queueDepth(self):
+        return len(self.outbound)
+
+class ThreadedConnection(ClientConnection):
+    '''Conexao do modo threads: a fila de saida e esvaziada por uma thread escritora dedicada'''
+
+    def __init__(self, socket, address):
+        super().__init__(address)
+
+        self.socket = socket
+
+        # protege a fila de saida, compartilhada entre as threads que enviam e a thread escritora
+        self.condition = threading.Condition()
+
+        self.writer = threading.Thread(target=self.drainQueue, daemon=True)
+        self.writer.start()
+
+    def send(self, data):
+        with self.condition:
+            return super().send(data)
+
+    def wakeWriter(self):
+        self.condition.notify()
+
+    # executa 'function', que pode bloquear (leitura do disco), e em seguida 'done' com o seu
+    # resultado, ambas na thread leitora
+    def runBlocking(self, function, done):
+        done(function())
+
+    def drainQueue(self):
+        '''Loop da thread escritora: envia as mensagens enfileiradas ate a conexao ser fechada'''
+
+        while True:
+            with self.condition:
+                while not self.outbound and not self.closed:
+                    self.condition.wait()
+
+                # com lotes habilitados, aguarda ate a janela expirar ou um lote completar
+                if BATCH_WINDOW > 0:
+                    deadline = time.monotonic() + BATCH_WINDOW
+
+                    while len(self.outbound) < BATCH_MAX_MESSAGES and not self.closed:
+                        remaining = deadline - time.monotonic()
+
+                        if remaining <= 0:
+                            break
+
+                        self.condition.wait(remaining)
+
+                if self.closed:
+                    return
+
+                # a mensagem so sai da fila quando vai ser enviada, para que a profundidade
+                # reportada inclua o que o cliente ainda nao consumiu
+                if BATCH_WINDOW > 0:
+                    data = self.takeBatch()
+                else:
+                    data = self.outbound.popleft()
+
+            try:
+                self.socket.sendall(data)
+
+            # falha de envio: encerra a conexao (a thread leitora trata a saida do cliente)
+            except OSError:
+                self.abort()
+                return
+
+    def abort(self):
+        '''Encerra a conexao de forma que a thread leitora receba EOF e trate a saida do cliente'''
+
+        self.closed = True
+
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+        self.socket.close()
+
+class AsyncConnection(ClientConnection):
+    '''Conexao do modo asyncio: a fila de saida e esvaziada por uma tarefa do loop de eventos'''
+
+    def __init__(self, writer, address):
+        super().__init__(address)
+
+        self.writer = writer
+
+        # sinaliza para a tarefa escritora que ha mensagens na fila
+        self.ready = asyncio.Event()
+
+        # tratamento de mensagem em andamento fora do loop (runBlocking), aguardado pela leitora
+        self.pending = None
+
+        self.writerTask = asyncio.get_running_loop().create_task(self.drainQueue())
+
+    def wakeWriter(self):
+        self.ready.set()
+
+    def runBlocking(self, function, done):
+        '''Executa 'function', que pode bloquear (leitura do disco), em uma thread do executor
+        padrao, fora do loop de eventos, e em seguida 'done' com o seu resultado, de volta no
+        loop. A leitora da conexao aguarda o fim de ambas (pending) antes de tratar a proxima
+        mensagem do cliente, que sao tratadas na ordem de chegada, como no modo threads'''
+
+        loop = asyncio.get_running_loop()
+
+        async def run():
+            done(await loop.run_in_executor(None, function))
+
+        self.pending = loop.create_task(run())
+
+    async def drainQueue(self):
+        '''Tarefa escritora: repassa as mensagens enfileiradas ao transporte, respeitando o
+        controle de fluxo (drain) para que o buffer do transporte nao cresca sem limite'''
+
+        try:
+            while not self.closed:
+                await self.ready.wait()
+                self.ready.clear()
+
+                # com lotes habilitados, aguarda ate a janela expirar ou um lote completar
+                if BATCH_WINDOW > 0 and len(self.outbound) < BATCH_MAX_MESSAGES:
+                    try:
+                        await asyncio.wait_for(self.ready.wait(), BATCH_WINDOW)
+                    except asyncio.TimeoutError:
+                        pass
+
+                    self.ready.clear()
+
+                while self.outbound and not self.closed:
+                    if BATCH_WINDOW > 0:
+                        self.writer.write(self.takeBatch())
+                    else:
+                        self.writer.write(self.outbound.popleft())
+
+                    await self.writer.drain()
+
+        except ConnectionError:
+            self.abort()
+
+    def abort(self):
+        '''Encerra a conexao imediatamente; a leitura pendente do cliente falha e trata sua saida'''
+
+        self.closed = True
+        self.writer.transport.abort()
+
+    def close(self):
+        self.closed = True
+        self.ready.set()
+        self.writer.close()
+
+class Room:
+    '''Sala de bate-papo: o conjunto de conexoes dos seus membros e um snapshot imutavel desse
+    conjunto, reconstruido apenas quando a sala muda (ver SessionRegistry), alem dos membros
+    conectados a outros processos do servidor.
+
+    A presenca da sala (os nomes dos membros, em todos os processos) e versionada: cada entrada
+    ou saida recebe a proxima versao do registro e fica no registro de mudancas da sala, que
+    guarda apenas a ultima mudanca de cada nome (uma entrada seguida da saida do mesmo usuario
+    ocupa uma unica posicao) e descarta as mais antigas alem de PRESENCE_LOG_SIZE nomes. As
+    mudancas posteriores a uma versao a partir de 'floor' podem ser obtidas sem percorrer a lista
+    de membros; para versoes anteriores, o cliente precisa de uma nova copia da lista'''
+
+    def __init__(self, name, version=0):
+        self.name = name
+        self.members = set()
+
+        # tupla com as conexoes dos membros; None quando precisa ser (re)construida, no primeiro
+        # roomSnapshot apos a criacao da sala ou a ultima mudanca dos membros
+        self.snapshot = None
+
+        # nome -> (processo, endereco) dos membros conectados a outros processos
+        self.remote = {}
+
+        # processo -> quantidade de membros da sala conectados a ele
+        self.nodes = collections.Counter()
+
+        # nome -> endereco de todos os membros, e os nomes em ordem, para a lista paginada
+        self.users = {}
+        self.names = []
+
+        # nome -> (versao, se entrou, endereco) da ultima mudanca de presenca de cada usuario,
+        # da mais antiga para a mais recente
+        self.changes = collections.OrderedDict()
+
+        # versao da ultima mudanca, versao a partir da qual o registro de mudancas esta completo e
+        # versao da ultima mudanca enviada aos membros em um presence-delta
+        self.version = version
+        self.floor = version
+        self.notified = version
+
+    # se a sala nao tem membros em nenhum processo
+    def isEmpty(self):
+        return not self.members and not self.remote
+
+    # registra a entrada ('joined' verdadeiro) ou a saida do usuario 'name' na versao 'version'
+    def recordPresence(self, version, name, address, joined):
+        if joined:
+            if name not in self.users:
+                bisect.insort(self.names, name)
+
+            self.users[name] = address
+
+        elif self.users.pop(name, None) is not None:
+            del self.names[bisect.bisect_left(self.names, name)]
+
+        self.changes[name] = (version, joined, address)
+        self.changes.move_to_end(name)
+        self.version = version
+
+        # descarta a mudanca mais antiga: o registro deixa de estar completo ate a sua versao
+        if len(self.changes) > PRESENCE_LOG_SIZE:
+            _, (self.floor, _, _) = self.changes.popitem(last=False)
+
+    def changesSince(self, since):
+        '''Saida: lista de (nome, se entrou, endereco) das mudancas posteriores a versao 'since',
+        da mais antiga para a mais recente, ou None caso o registro nao as tenha mais'''
+
+        if since < self.floor or since > self.version:
+            return None
+
+        changes = []
+
+        # percorre apenas as mudancas posteriores a 'since', a partir da mais recente
+        for name in reversed(self.changes):
+            version, joined, address = self.changes[name]
+
+            if version <= since:
+                break
+
+            changes.append((name, joined, address))
+
+        changes.reverse()
+
+        return changes
+
+    def page(self, after, limit):
+        '''Saida: lista de (nome, endereco) de ate 'limit' membros, em ordem de nome, a partir do
+        primeiro nome posterior a 'after' (do inicio se None), e o ultimo nome da pagina, caso
+        haja mais membros depois dela (None se nao houver)'''
+
+        start = 0 if after is None else bisect.bisect_right(self.names, after)
+        names = self.names[start:start + limit]
+
+        following = names[-1] if start + limit < len(self.names) else None
+
+        return [(name, self.users[name]) for name in names], following
+
+class SessionRegistry:
+    '''Registro das sessoes de clientes (objetos ClientConnection), com indices por conexao,
+    por endereco, por nome de usuario e por sala. Os indices sao atualizados juntos na entrada,
+    na troca de sala e na saida de cada cliente, de modo que localizar um destinatario ou
+    verificar se um nome ja esta em uso tem custo constante, e o custo de um broadcast e
+    proporcional ao tamanho da sala, e nao a quantidade de usuarios no servidor.
+
+    Modelo de concorrencia: toda alteracao dos indices (add, remove, join, moveToRoom, leave) e
+    feita sob um unico lock, mantido apenas pelo tempo de algumas operacoes de dicionario.
+    Leituras pontuais (getByName, isConnected) sao consultas simples a dicionarios, atomicas no
+    CPython, e dispensam o lock. Quem percorre os membros de uma sala (broadcast) usa
+    roomSnapshot(): uma tupla imutavel das conexoes, reconstruida sob o lock apenas quando a
+    sala mudou desde a ultima leitura (copy-on-write preguicoso). Assim varios broadcasts
+    percorrem o mesmo snapshot em paralelo, sem bloquear entradas e saidas, e nunca observam
+    um conjunto sendo alterado durante a iteracao.
+
+    Com varios processos, o registro tambem guarda os usuarios ativos nos demais (a presenca
+    replicada pelo barramento) e, para os nomes dos quais este processo e o dono, as reservas
+    de nomes. O 'listener', se definido, e avisado de cada entrada, troca de sala e saida de
+    usuario ainda sob o lock, na mesma ordem em que elas acontecem'''
+
+    def __init__(self):
+
+        # protege as alteracoes dos indices (reentrante: 'welcome' pode consultar o registro)
+        self.lock = threading.RLock()
+
+        # conexao -> endereco, para todos os clientes conectados ao servidor
+        self.connections = {}
+
+        # endereco -> conexao, para todos os clientes conectados ao servidor
+        self.by_address = {}
+
+        # nome de usuario -> conexao, apenas para os usuarios ativos no bate-papo
+        self.by_name = {}
+
+        # nome da sala -> Room; salas vazias sao descartadas, exceto a sala padrao
+        self.rooms = {DEFAULT_ROOM: Room(DEFAULT_ROOM)}
+
+        # nome de usuario -> (processo, endereco, sala), para os usuarios ativos em outros processos
+        self.remote = {}
+
+        # nome de usuario -> processo que o reservou, para os nomes dos quais este processo e o dono
+        self.reservations = {}
+
+        # avisado das entradas, trocas de sala e saidas de usuarios deste processo
+        self.listener = None
+
+        # versao da presenca, incrementada a cada entrada ou saida de um usuario de qualquer sala
+        self.presenceVersion = 0
+
+        # nomes das salas com mudancas de presenca ainda nao enviadas aos membros
+        self.changedRooms = set()
+
+    # registra uma nova conexao
+    def add(self, connection):
+        with self.lock:
+            self.connections[connection] = connection.address
+            self.by_address[connection.address] = connection
+
+    # remove uma conexao encerrada (a saida do bate-papo e tratada por leave)
+    def remove(self, connection):
+        with self.lock:
+            self.connections.pop(connection, None)
+            self.by_address.pop(connection.address, None)
+
+    def isConnected(self, connection):
+        return connection in self.connections
+
+    # recupera a sala 'roomName', criando-a se necessario (chamada sob o lock)
+    def getRoom(self, roomName):
+        room = self.rooms.get(roomName)
+
+        if room is None:
+            room = self.rooms[roomName] = Room(roomName, self.presenceVersion)
+
+        return room
+
+    # registra a entrada ou saida de um usuario na sala 'room' com a proxima versao da presenca (chamada sob o lock)
+    def recordPresence(self, room, name, address, joined):
+        self.presenceVersion += 1
+        room.recordPresence(self.presenceVersion, name, address, joined)
+        self.changedRooms.add(room.name)
+
+    # descarta a sala 'room' caso tenha ficado vazia, exceto a sala padrao (chamada sob o lock)
+    def discardIfEmpty(self, room):
+        if room.isEmpty() and room.name != DEFAULT_ROOM:
+            del self.rooms[room.name]
+
+    # coloca a conexao na sala 'roomName' (chamada sob o lock)
+    def enterRoom(self, connection, roomName):
+        room = self.getRoom(roomName)
+        room.members.add(connection)
+        room.snapshot = None
+        connection.room = roomName
+
+        self.recordPresence(room, connection.name, connection.address, True)
+
+    # retira a conexao da sua sala (chamada sob o lock)
+    def exitRoom(self, connection):
+        room = self.rooms.get(connection.room)
+
+        if room is not None:
+            room.members.discard(connection)
+            room.snapshot = None
+
+            self.recordPresence(room, connection.name, connection.address, False)
+            self.discardIfEmpty(room)
+
+        connection.room = None
+
+    def join(self, connection, name, roomName, welcome=None):
+        '''Coloca a conexao no bate-papo com o nome 'name', na sala 'roomName'. A verificacao do
+        nome e a insercao sao feitas sob o mesmo lock, entao dois clientes nunca obtem o mesmo
+        nome. A funcao 'welcome', se informada, e chamada ainda sob o lock, antes que o novo
+        usuario apareca em qualquer snapshot: o que ela enfileirar chega ao cliente antes de
+        qualquer broadcast
+        Saida: False caso o nome ja esteja em uso ou a conexao ja esteja no bate-papo'''
+
+        with self.lock:
+
+            # o nome ja esta em uso, a conexao ja entrou com outro nome (que continuaria ocupado,
+            # assim como o seu lugar na sala) ou ela foi encerrada enquanto a entrada era tratada
+            if name in self.by_name or connection.name is not None or connection not in self.connections:
+                return False
+
+            connection.name = name
+            self.by_name[name] = connection
+
+            if welcome is not None:
+                welcome()
+
+            self.enterRoom(connection, roomName)
+
+            if self.listener is not None:
+                self.listener.userJoined(connection)
+
+        return True
+
+    def moveToRoom(self, connection, roomName, welcome=None):
+        '''Transfere um usuario ativo para a sala 'roomName'; 'welcome' tem o mesmo papel que em join
+        Saida: o nome da sala anterior, ou None caso o usuario nao esteja no bate-papo'''
+
+        with self.lock:
+            if connection.name is None:
+                return None
+
+            previous = connection.room
+            self.exitRoom(connection)
+
+            if welcome is not None:
+                welcome()
+
+            self.enterRoom(connection, roomName)
+
+            if self.listener is not None:
+                self.listener.userMoved(connection, previous)
+
+        return previous
+
+    def leave(self, connection):
+        '''Retira a conexao do bate-papo
+        Saida: o nome que o usuario usava e sua sala, ou (None, None) caso ele nao estivesse no bate-papo'''
+
+        with self.lock:
+            name = connection.name
+
+            if name is None or self.by_name.get(name) is not connection:
+                return None, None
+
+            roomName = connection.room
+
+            del self.by_name[name]
+            self.exitRoom(connection)
+            connection.name = None
+
+            if self.listener is not None:
+                self.listener.userLeft(name, roomName)
+
+        return name, roomName
+
+    # coloca um usuario de outro processo na sala 'roomName' (chamada sob o lock)
+    def enterRemoteRoom(self, name, node, address, roomName):
+        room = self.getRoom(roomName)
+        room.remote[name] = (node, address)
+        room.nodes[node] += 1
+
+        self.recordPresence(room, name, address, True)
+
+    # retira um usuario de outro processo da sala 'roomName' (chamada sob o lock)
+    def exitRemoteRoom(self, name, node, roomName):
+        room = self.rooms.get(roomName)
+
+        if room is None:
+            return
+
+        address = room.remote.pop(name, (None, None))[1]
+
+        if address is None:
+            return
+
+        room.nodes[node] -= 1
+
+        if room.nodes[node] <= 0:
+            del room.nodes[node]
+
+        self.recordPresence(room, name, address, False)
+        self.discardIfEmpty(room)
+
+    def addRemote(self, name, node, address, roomName):
+        '''Registra o usuario 'name', ativo no processo 'node', na sala 'roomName'
+        Saida: False caso ele ja estivesse registrado nessa sala'''
+
+        with self.lock:
+            current = self.remote.get(name)
+
+            if current is not None:
+                if current[0] == node and current[2] == roomName:
+                    return False
+
+                self.exitRemoteRoom(name, current[0], current[2])
+
+            self.remote[name] = (node, address, roomName)
+            self.enterRemoteRoom(name, node, address, roomName)
+
+        return True
+
+    def moveRemote(self, name, node, roomName):
+        '''Transfere o usuario 'name', ativo no processo 'node', para a sala 'roomName'
+        Saida: o endereco do usuario e o nome da sala anterior, ou (None, None) caso ele nao esteja registrado'''
+
+        with self.lock:
+            current = self.remote.get(name)
+
+            if current is None or current[0] != node:
+                return None, None
+
+            _, address, previous = current
+
+            self.exitRemoteRoom(name, node, previous)
+            self.remote[name] = (node, address, roomName)
+            self.enterRemoteRoom(name, node, address, roomName)
+
+        return address, previous
+
+    def removeRemote(self, name, node):
+        '''Retira o usuario 'name', ativo no processo 'node'
+        Saida: o endereco e a sala do usuario, ou (None, None) caso ele nao esteja registrado'''
+
+        with self.lock:
+            current = self.remote.get(name)
+
+            if current is None or current[0] != node:
+                return None, None
+
+            _, address, roomName = current
+
+            del self.remote[name]
+            self.exitRemoteRoom(name, node, roomName)
+
+        return address, roomName
+
+    def removeNode(self, node):
+        '''Retira todos os usuarios do processo 'node' e as reservas de nomes feitas por ele
+        Saida: lista de (nome, endereco, sala) dos usuarios retirados'''
+
+        with self.lock:
+            removed = [(name, address, roomName)
+                       for name, (owner, address, roomName) in self.remote.items() if owner == node]
+
+            for name, address, roomName in removed:
+                del self.remote[name]
+                self.exitRemoteRoom(name, node, roomName)
+
+            for name in [name for name, owner in self.reservations.items() if owner == node]:
+                del self.reservations[name]
+
+        return removed
+
+    # recupera o processo em que o usuario 'name' esta ativo, ou None
+    def remoteNode(self, name):
+        current = self.remote.get(name)
+        return None if current is None else current[0]
+
+    # lista dos outros processos com membros na sala 'roomName'
+    def roomNodes(self, roomName):
+        with self.lock:
+            room = self.rooms.get(roomName)
+            return [] if room is None else list(room.nodes)
+
+    def reserveName(self, name, node):
+        '''Reserva o nome 'name' para um usuario do processo 'node'; usada apenas no processo dono
+        do nome, o que garante que ele nunca e concedido a dois usuarios, em qualquer processo
+        Saida: False caso o nome ja esteja reservado'''
+
+        with self.lock:
+            if name in self.reservations:
+                return False
+
+            self.reservations[name] = node
+
+        return True
+
+    # libera a reserva do nome 'name', caso tenha sido feita pelo processo 'node'
+    def releaseName(self, name, node):
+        with self.lock:
+            if self.reservations.get(name) == node:
+                del self.reservations[name]
+
+    def claimNames(self, owner, nodeId):
+        '''Refaz as reservas do processo 'nodeId' depois de uma mudanca nos processos ativos:
+        libera os nomes dos quais ele deixou de ser o dono e reserva os nomes dos usuarios
+        ativos (neste e nos demais processos) dos quais ele passou a ser o dono
+        Entrada: a funcao que devolve o dono de cada nome e o identificador deste processo'''
+
+        with self.lock:
+            for name in [name for name in self.reservations if owner(name) != nodeId]:
+                del self.reservations[name]
+
+            for name in self.by_name:
+                if owner(name) == nodeId:
+                    self.reservations.setdefault(name, nodeId)
+
+            for name, (node, _, _) in self.remote.items():
+                if owner(name) == nodeId:
+                    self.reservations.setdefault(name, node)
+
+    # recupera a conexao do usuario ativo de nome 'name', ou None
+    def getByName(self, name):
+        return self.by_name.get(name)
+
+    def roomSnapshot(self, roomName):
+        '''Saida: tupla imutavel com as conexoes dos membros da sala de nome roomName'''
+
+        room = self.rooms.get(roomName)
+
+        if room is None:
+            return ()
+
+        snapshot = room.snapshot
+
+        if snapshot is None:
+            with self.lock:
+
+                # outra thread pode ter reconstruido o snapshot enquanto esperavamos o lock
+                if room.snapshot is None:
+                    room.snapshot = tuple(room.members)
+
+                snapshot = room.snapshot
+
+        return snapshot
+
+    def roomUsers(self, roomName):
+        '''Saida: lista de (endereco, nome) dos membros da sala de nome roomName, em todos os processos'''
+
+        with self.lock:
+            room = self.rooms.get(roomName)
+            return [] if room is None else [(address, name) for name, address in room.users.items()]
+
+    def presencePage(self, roomName, after, limit):
+        '''Saida: uma pagina da lista de membros da sala (ver Room.page), a versao da presenca
+        refletida por ela, a quantidade total de membros e o ultimo nome da pagina, caso haja mais'''
+
+        with self.lock:
+            room = self.rooms.get(roomName)
+
+            if room is None:
+                return [], self.presenceVersion, 0, None
+
+            users, following = room.page(after, limit)
+
+            return users, room.version, len(room.names), following
+
+    def presenceChanges(self, roomName, since):
+        '''Saida: as mudancas de presenca da sala posteriores a versao 'since' (ver
+        Room.changesSince) e a versao atual, ou (None, versao) caso elas nao estejam mais disponiveis'''
+
+        with self.lock:
+            room = self.rooms.get(roomName)
+
+            # sala inexistente: vazia desde qualquer versao posterior a sua remocao
+            if room is None:
+                return None, self.presenceVersion
+
+            return room.changesSince(since), room.version
+
+    def takePresenceChanges(self):
+        '''Retira as mudancas de presenca ainda nao enviadas aos membros de cada sala
+        Saida: lista de (nome da sala, versao anterior, versao atual, mudancas)'''
+
+        with self.lock:
+            pending = []
+
+            for roomName in self.changedRooms:
+                room = self.rooms.get(roomName)
+
+                # sala descartada: nao ha mais membros para avisar
+                if room is None:
+                    continue
+
+                # mudancas ja descartadas do registro: os membros que nao as receberam pedem a lista
+                since = max(room.notified, room.floor)
+
+                pending.append((roomName, since, room.version, room.changesSince(since)))
+                room.notified = room.version
+
+            self.changedRooms.clear()
+
+        return pending
+
+    # lista de (nome da sala, quantidade de membros) das salas existentes
+    def listRooms(self):
+        with self.lock:
+            return [(room.name, len(room.members) + len(room.remote)) for room in self.rooms.values()]
+
+    # lista das conexoes dos usuarios ativos no bate-papo deste processo
+    def activeConnections(self):
+        with self.lock:
+            return list(self.by_name.values())
+
+    # quantidade de usuarios ativos no bate-papo, em todos os processos
+    def onlineCount(self):
+        return len(self.by_name) + len(self.remote)
+
+    # lista de (conexao, endereco) de todos os clientes conectados
+    def connectedClients(self):
+        with self.lock:
+            return list(self.connections.items())
+
+# registro das sessoes dos clientes atualmente conectados a aplicacao
+registry = SessionRegistry()
+
+# metricas do servidor, sempre atualizadas (sem locks: cada thread atualiza os seus proprios
+# contadores) e expostas por HTTP, no formato do Prometheus, com --metricas
+metrics = Registry()
+
+messagesIn = metrics.counter('chat_messages_received_total', 'Mensagens recebidas dos clientes, por tipo', ('type',))
+bytesIn = metrics.counter('chat_received_bytes_total', 'Bytes recebidos dos clientes (mensagens completas, com header)')
+messagesOut = metrics.counter('chat_messages_sent_total', 'Mensagens enfileiradas para os clientes, por tipo', ('type',))
+bytesOut = metrics.counter('chat_sent_bytes_total', 'Bytes enfileirados para os clientes (mensagens com header, antes de lotes)')
+droppedMessages = metrics.counter('chat_dropped_messages_total', 'Mensagens descartadas por estouro da fila de saida de um cliente')
+pingsSent = metrics.counter('chat_pings_sent_total', 'Pings enviados a clientes ociosos')
+idleDisconnections = metrics.counter('chat_idle_disconnections_total', 'Clientes desconectados por nao responderem dentro do tempo limite')
+joinTimeouts = metrics.counter('chat_join_timeouts_total', 'Conexoes encerradas por nao entrarem no bate-papo dentro do tempo limite')
+
+handlingDuration = metrics.histogram('chat_message_handling_seconds', 'Tempo de tratamento de cada mensagem recebida, por tipo', labelNames=('type',))
+broadcastDuration = metrics.histogram('chat_broadcast_seconds', 'Tempo de cada broadcast para os membros de uma sala')
+fanout = metrics.histogram('chat_broadcast_recipients', 'Quantidade de destinatarios de cada broadcast', SIZE_BUCKETS)
+
+metrics.gauge('chat_active_connections', 'Conexoes de clientes abertas', lambda: len(registry.connections))
+metrics.gauge('chat_joined_users', 'Usuarios no bate-papo, neste processo', lambda: len(registry.by_name))
+metrics.gauge('chat_log_dropped_records', 'Registros de log descartados por fila cheia', registros.droppedRecords)
+
+class Cluster:
+    '''Coordena este no com os demais nos do servidor (processos da mesma maquina ou servidores
+    em maquinas diferentes) por meio do barramento (barramento.Bus): replica a presenca dos
+    usuarios, encaminha as mensagens de bate-papo apenas aos nos com destinatarios e reserva
+    cada nome de usuario no no dono do nome, de modo que um nome nunca e usado por dois
+    usuarios, em qualquer no. Quando o canal com um no e (re)estabelecido, cada lado envia ao
+    outro a presenca dos seus usuarios, e o dono de cada nome recupera dela as reservas.
+
+    O dono de cada nome e escolhido entre os nos que nao cairam (Bus.owner): quando um no cai
+    ou volta, os demais refazem as reservas dos nomes dos quais passaram a ser (ou deixaram de
+    ser) os donos, a partir da presenca replicada. Enquanto dois nos discordam sobre quem caiu
+    (por exemplo, numa particao da rede entre eles), o mesmo nome pode ser concedido em ambos.
+
+    E o 'listener' do registro: as entradas, trocas de sala e saidas de usuarios deste processo
+    sao publicadas ainda sob o lock do registro, na mesma ordem em que acontecem'''
+
+    def __init__(self, bus):
+        self.bus = bus
+
+        # protege as reservas de nomes aguardando resposta
+        self.lock = threading.Lock()
+
+        # identificador -> (processo dono do nome, funcao chamada com o resultado da reserva)
+        self.pending = {}
+        self.tokens = itertools.count()
+
+    def start(self, dispatch=None):
+        '''Passa a publicar a presenca deste processo e a tratar as mensagens dos demais'''
+
+        registry.listener = self
+        self.bus.start(self.handleMessage, self.handlePeerUp, self.handlePeerDown, dispatch)
+
+    # mensagem de presença de um usuário ativo neste nó
+    def presenceMessage(self, connection):
+        return {
+            "type": "peer-user-joined",
+            "node": self.bus.nodeId,
+            "name": connection.name,
+            "host": connection.address[0],
+            "port": connection.address[1],
+            "room": connection.room
+        }
+
+    # publica a entrada de um usuario deste processo (chamada sob o lock do registro)
+    def userJoined(self, connection):
+        self.bus.publish(self.presenceMessage(connection))
+
+    # publica a troca de sala de um usuario deste processo (chamada sob o lock do registro)
+    def userMoved(self, connection, previous):
+        self.bus.publish({
+            "type": "peer-user-moved",
+            "node": self.bus.nodeId,
+            "name": connection.name,
+            "room": connection.room
+        })
+
+    # publica a saida de um usuario deste processo (chamada sob o lock do registro); o dono do
+    # nome libera a reserva ao receber a notificacao
+    def userLeft(self, name, room):
+        if self.bus.owner(name) == self.bus.nodeId:
+            registry.releaseName(name, self.bus.nodeId)
+
+        self.bus.publish({
+            "type": "peer-user-left",
+            "node": self.bus.nodeId,
+            "name": name
+        })
+
+    def reserve(self, name, callback):
+        '''Reserva o nome 'name' no processo dono dele e chama 'callback' com o resultado (True
+        se o nome foi concedido, False se ja esta em uso e None se o dono esta inacessivel):
+        imediatamente, se este processo e o dono, ou quando a resposta chegar pelo barramento'''
+
+        owner = self.bus.owner(name)
+
+        if owner == self.bus.nodeId:
+            callback(registry.reserveName(name, owner))
+            return
+
+        with self.lock:
+            token = next(self.tokens)
+            self.pending[token] = (owner, callback)
+
+        request = {"type": "name-reserve", "node": self.bus.nodeId, "name": name, "token": token}
+
+        # sem conexao com o dono do nome, a reserva falha sem que o nome esteja em uso
+        if not self.bus.send(owner, request):
+            with self.lock:
+                self.pending.pop(token, None)
+
+            callback(None)
+
+    # libera o nome 'name', reservado para uma entrada que nao se concretizou
+    def release(self, name):
+        owner = self.bus.owner(name)
+
+        if owner == self.bus.nodeId:
+            registry.releaseName(name, owner)
+        else:
+            self.bus.send(owner, {"type": "name-release", "node": self.bus.nodeId, "name": name})
+
+    # encaminha uma mensagem pública da sala 'room' aos processos com membros nela
+    def forwardRoomMessage(self, room, msgObject):
+        nodes = registry.roomNodes(room)
+
+        if nodes:
+            self.bus.publish({"type": "peer-room-message", "room": room, "message": msgObject}, nodes)
+
+    # encaminha uma mensagem privada ao processo do destinatário 'receiver'; False caso ele não esteja ativo
+    def forwardPrivateMessage(self, receiver, msgObject):
+        node = registry.remoteNode(receiver)
+
+        if node is None:
+            return False
+
+        return self.bus.send(node, {"type": "peer-private-message", "receiver": receiver, "message": msgObject})
+
+    def handleMessage(self, peer, msgObject):
+        '''Trata uma mensagem recebida de outro processo pelo barramento
+        Entrada: o canal com o processo e o objeto da mensagem'''
+
+        msgType = msgObject['type']
+        node = peer.node
+
+        # entrada de usuario em outro processo: notifica os membros da sala neste processo
+        if msgType == 'peer-user-joined':
+            name, room = msgObject['name'], msgObject['room']
+            address = (msgObject['host'], msgObject['port'])
+
+            # o dono do nome recupera a reserva, caso a tenha perdido (reinicio deste no)
+            if self.bus.owner(name) == self.bus.nodeId:
+                registry.reserveName(name, node)
+
+            if registry.addRemote(name, node, address, room):
+                notifyRoom(None, address, 'user-joined', name, room)
+
+        # troca de sala de usuario em outro processo
+        elif msgType == 'peer-user-moved':
+            name, room = msgObject['name'], msgObject['room']
+            address, previous = registry.moveRemote(name, node, room)
+
+            if previous is not None:
+                notifyRoom(None, address, 'user-left', name, previous)
+                notifyRoom(None, address, 'user-joined', name, room)
+
+        # saida de usuario em outro processo
+        elif msgType == 'peer-user-left':
+            name = msgObject['name']
+
+            if self.bus.owner(name) == self.bus.nodeId:
+                registry.releaseName(name, node)
+
+            address, room = registry.removeRemote(name, node)
+
+            if room is not None:
+                notifyRoom(None, address, 'user-left', name, room)
+
+        # mensagem publica de uma sala com membros neste processo
+        elif msgType == 'peer-room-message':
+            publishRoomMessage(None, msgObject['message'], msgObject['room'])
+
+        # mensagem privada para um usuario deste processo
+        elif msgType == 'peer-private-message':
+            receiver_connection = registry.getByName(msgObject['receiver'])
+
+            if receiver_connection is not None:
+                receiver_connection.sendMessage(EncodedMessage(msgObject['message']))
+
+        # pedido de reserva de um nome do qual este processo e o dono
+        elif msgType == 'name-reserve':
+            granted = registry.reserveName(msgObject['name'], node)
+            self.bus.send(node, {"type": "name-reserved", "token": msgObject['token'], "granted": granted})
+
+        # resposta de uma reserva feita por este processo
+        elif msgType == 'name-reserved':
+            with self.lock:
+                pending = self.pending.pop(msgObject['token'], None)
+
+            if pending is not None:
+                pending[1](msgObject['granted'])
+
+        # liberacao de um nome reservado para uma entrada que nao se concretizou
+        elif msgType == 'name-release':
+            registry.releaseName(msgObject['name'], node)
+
+        else:
+            log.warning('Tipo de mensagem do barramento invalido', type=msgType, node=peer.node)
+
+    def handlePeerUp(self, peer):
+        '''Trata o estabelecimento do canal com outro no: o que se sabia dele por um canal anterior
+        e descartado, e ele recebe a presenca dos usuarios deste no'''
+
+        log.info('Conexao estabelecida com o no', node=peer.node)
+
+        self.dropNode(peer.node)
+
+        # sob o lock do registro, nenhuma entrada ou saida acontece entre a presenca enviada e o
+        # registro do canal, a partir do qual as proximas sao publicadas tambem para esse no
+        with registry.lock:
+            self.bus.register(peer)
+
+            for connection in registry.activeConnections():
+                self.bus.send(peer.node, self.presenceMessage(connection))
+
+            # os nomes dos quais o no volta a ser o dono deixam de ser reservados aqui; ele os
+            # recupera da presenca enviada por cada no
+            registry.claimNames(self.bus.owner, self.bus.nodeId)
+
+    def handlePeerDown(self, peer):
+        '''Trata a queda de outro no: os nomes dos quais ele era o dono passam a ser reservados
+        nos demais'''
+
+        log.info('Conexao encerrada com o no', node=peer.node)
+
+        self.dropNode(peer.node)
+
+        registry.claimNames(self.bus.owner, self.bus.nodeId)
+
+    def dropNode(self, node):
+        '''Os usuarios do no 'node' saem do bate-papo, suas reservas de nomes sao liberadas e as
+        reservas pendentes nele falham (com o dono inacessivel)'''
+
+        for name, address, room in registry.removeNode(node):
+            notifyRoom(None, address, 'user-left', name, room)
+
+        with self.lock:
+            failed = [token for token, (owner, _) in self.pending.items() if owner == node]
+            callbacks = [self.pending.pop(token)[1] for token in failed]
+
+        for callback in callbacks:
+            callback(None)
+
+# coordenacao com os demais nos do servidor (None quando ha um unico processo, fora de um cluster)
+cluster = None
+
+# historico persistente das mensagens publicas (None quando desabilitado)
+history = None
+
+# captura das mensagens recebidas, para reproducao (None quando desabilitada)
+capture = None
+
+# mensagens recentes de cada sala, enviadas a quem entra nela (None quando desabilitado)
+cache = None
+
+# perfilador por amostragem das threads do servidor (None quando desabilitado)
+profiler = None
+
+# prazos de verificacao da atividade das conexoes (None quando os tempos limite estao desabilitados)
+heartbeats = None
+
+def nextCheck(connection):
+    '''Prazo da proxima verificacao de uma conexao no seu estado atual
+    Entrada: a conexao
+    Saida: o instante (time.monotonic) da verificacao, ou None se o estado nao tem tempo limite'''
+
+    # fora do bate-papo: o prazo para entrar conta a partir da aceitacao ou da saida, e nao da atividade
+    if connection.name is None:
+        return connection.outsideSince + JOIN_TIMEOUT if JOIN_TIMEOUT > 0 else None
+
+    if IDLE_TIMEOUT <= 0:
+        return None
+
+    # no bate-papo, apenas quem responde a pings recebe um antes de ser desconectado
+    return connection.lastActivity + (PING_INTERVAL if connection.heartbeat else IDLE_TIMEOUT)
+
+def watchConnection(connection):
+    '''Agenda (ou reagenda) a verificacao de atividade de uma conexao conforme o seu estado;
+    chamada ao aceitar a conexao e a cada entrada ou saida do bate-papo'''
+
+    if heartbeats is None:
+        return
+
+    deadline = nextCheck(connection)
+
+    if deadline is None:
+        heartbeats.cancel(connection)
+    else:
+        heartbeats.schedule(connection, deadline)
+
+def forgetConnection(connection):
+    '''Cancela a verificacao de atividade de uma conexao encerrada'''
+
+    if heartbeats is not None:
+        heartbeats.cancel(connection)
+
+def checkHeartbeats():
+    '''Verifica as conexoes cujo prazo expirou. Fora do bate-papo, quem nao entrou em JOIN_TIMEOUT
+    (ex.: um socket que nunca envia o connection-request) e desconectado. No bate-papo, quem esta
+    ocioso ha IDLE_TIMEOUT (ex.: conexao TCP meio aberta) e desconectado, e quem responde a pings
+    recebe um depois de PING_INTERVAL ocioso. Os demais tem a verificacao reagendada (a atividade
+    apenas atualiza lastActivity, sem mexer na roda). A saida de quem e desconectado e tratada
+    por quem le a conexao, como a de qualquer cliente'''
+
+    now = time.monotonic()
+
+    for connection in heartbeats.advance(now):
+
+        if connection.closed:
+            continue
+
+        if connection.name is None:
+            waited = now - connection.outsideSince
+
+            if 0 < JOIN_TIMEOUT <= waited:
+                log.info('Conexao fora do bate-papo encerrada', address=connection.address, waited=round(waited, 1))
+                joinTimeouts.inc()
+                connection.abort()
+            else:
+                watchConnection(connection)
+
+            continue
+
+        idle = now - connection.lastActivity
+
+        if 0 < IDLE_TIMEOUT <= idle:
+            log.info('Cliente ocioso desconectado', address=connection.address, idle=round(idle, 1))
+            idleDisconnections.inc()
+            connection.abort()
+
+        elif IDLE_TIMEOUT > 0 and connection.heartbeat and idle >= PING_INTERVAL:
+            connection.sendMessage(EncodedMessage({"type": "ping"}))
+            pingsSent.inc()
+            heartbeats.schedule(connection, connection.lastActivity + IDLE_TIMEOUT)
+
+        else:
+            watchConnection(connection)
+
+# verifica periodicamente a atividade das conexoes (modo threads)
+def heartbeatLoop():
+    while True:
+        time.sleep(heartbeats.tick)
+        checkHeartbeats()
+
+# verifica periodicamente a atividade das conexoes (modo asyncio)
+async def heartbeatAsync():
+    while True:
+        await asyncio.sleep(heartbeats.tick)
+        checkHeartbeats()
+
+def printCacheStats():
+    '''Imprime os contadores do cache de mensagens recentes'''
+
+    if cache is None:
+        print('Cache de mensagens recentes desabilitado')
+        return
+
+    stats = cache.stats()
+    lookups = stats['hits'] + stats['misses']
+    ratio = stats['hits'] / lookups if lookups else 0
+
+    print(f"Cache: {stats['hits']} acertos, {stats['misses']} falhas ({ratio:.1%} de acertos), "
+          f"{stats['evictions']} salas descartadas, {stats['rooms']} salas e {stats['bytes']} bytes em memoria")
+
+def dumpProfile():
+    '''Grava as pilhas amostradas pelo perfilador desde o ultimo pedido'''
+
+    if profiler is None:
+        print('Perfilador desabilitado (use --perfil DIRETORIO)')
+        return
+
+    stacksPath, summaryPath = profiler.dump()
+
+    print(f'Perfil gravado em {stacksPath} (pilhas colapsadas) e {summaryPath} (tempo por funcao)')
+
+def printQueueDepths():
+    '''Imprime a profundidade da fila de saida de cada cliente conectado'''
+
+    for connection, address in registry.connectedClients():
+        print(f'{address}: {connection.queueDepth()} mensagens na fila, {connection.dropped} descartadas')
+
+def handleRequests(connectionSocket, address):
+    '''Recebe e processa mensagens do cliente, tratando suas diferentes requisições e 
+    enviando para ele os retornos gerados pela aplicacao para a mensagem recebida
+    Entrada: a conexao e o endereco do cliente'''
+
+    # buffer de recebimento da conexao, reutilizado por todas as mensagens
+    decoder = FrameDecoder(maxFrameSize=MAX_MESSAGE_SIZE)
+
+    try:
+        while True:
+
+            # le do socket tudo o que estiver disponivel (uma ou mais mensagens)
+            received = decoder.recvFrom(connectionSocket.socket)
+
+            # caso receba dados vazios: cliente encerrou a conexao
+            if not received:
+                break
+
+            connectionSocket.lastActivity = time.monotonic()
+
+            # trata todas as mensagens completas recebidas nessa leitura
+            for receivedMsg in decoder.frames():
+                processMessage(connectionSocket, address, receivedMsg)
+
+    # conexao resetada ou encerrada pelo servidor (cliente lento): tratada como encerramento
+    except OSError:
+        pass
+
+    # mensagem acima do tamanho maximo: o cliente e desconectado sem que ela seja recebida
+    except FrameTooLargeError as e:
+        log.warning('Mensagem recusada', address=address, error=e)
+
+    # falha inesperada no tratamento de uma mensagem: o cliente e desconectado, sem derrubar o servidor
+    except Exception:
+        log.exception('Falha no tratamento da conexao', address=address)
+
+    # qualquer que seja o motivo do fim da leitura, a sessao do cliente e encerrada
+    finally:
+
+        # fecha a conexao
+        connectionSocket.close()
+
+        # retira a entrada referente ao cliente do registro de conexoes atuais
+        registry.remove(connectionSocket)
+        forgetConnection(connectionSocket)
+
+        # registra o fim da conexao na captura
+        if capture is not None:
+            capture.recordClose(connectionSocket.id)
+
+        # imprime mensagem de conexao encerrada
+        log.info('Conexao encerrada', address=address)
+
+        # trata requisições de saída do bate-papo
+        handleLeaveRequest(connectionSocket, address)
+
+def processMessage(connection, address, receivedMsg):
+    '''Decodifica uma mensagem recebida e a encaminha para o tratador do seu tipo
+    Entrada: a conexao do cliente, seu endereco e os bytes da mensagem recebida (valido
+    apenas durante a chamada, pois aponta para o buffer de recebimento da conexao)'''
+
+    start = time.perf_counter()
+
+    bytesIn.inc(HEADER_LENGTH + len(receivedMsg))
+
+    # grava a mensagem na captura exatamente como foi recebida, antes de decodificá-la
+    if capture is not None:
+        capture.record(connection.id, receivedMsg)
+
+    try:
+        # recupera o objeto da mensagem, no codec negociado pela conexao (JSON por padrao)
+        receivedMsgObject = connection.codec.decode(receivedMsg)
+
+    except DecodeError:
+        messagesIn.labels('invalida').inc()
+        log.warning('Falha na decodificacao da mensagem', address=address)
+        return
+
+    # tipos desconhecidos sao contados juntos, para que um cliente nao crie series arbitrarias
+    msgType = receivedMsgObject.get('type')
+    label = msgType if isinstance(msgType, str) and msgType in TYPE_TAGS else 'desconhecido'
+
+    messagesIn.labels(label).inc()
+
+    # imprime a mensagem recebida
+    log.message('Mensagem recebida', address=address, message=receivedMsgObject)
+
+    # trata requisição de entrada de usuário no bate-papo
+    if msgType == 'connection-request':
+        handleJoinRequest(connection, address, receivedMsgObject)
+    
+    # trata requisição de saída de usuário do bate-papo
+    elif msgType == 'disconnection-request':
+        handleLeaveRequest(connection, address)
+
+    # trata as mensagens de bate-papo recebidas
+    elif msgType == 'chat-message':
+        handleChatMessage(connection, address, receivedMsgObject)
+
+    # trata requisições de troca de sala
+    elif msgType in ('room-join', 'room-leave'):
+        handleRoomChange(connection, address, receivedMsgObject)
+
+    # trata requisição da lista de salas
+    elif msgType == 'room-list':
+        handleRoomList(connection, address)
+
+    # trata requisição de mensagens anteriores da sala
+    elif msgType == 'history-request':
+        handleHistoryRequest(connection, address, receivedMsgObject)
+
+    # trata requisição de presença da sala
+    elif msgType == 'presence-request':
+        handlePresenceRequest(connection, address, receivedMsgObject)
+
+    # responde ao ping do cliente (qualquer mensagem recebida já conta como atividade)
+    elif msgType == 'ping':
+        connection.sendMessage(EncodedMessage({"type": "pong"}))
+
+    # resposta a um ping do servidor: nada a fazer além de registrar a atividade
+    elif msgType == 'pong':
+        pass
+
+    # caso receba um tipo de mensagem desconhecido, imprime mensagem de erro no console
+    else:
+        log.warning('Tipo de mensagem invalido', address=address, type=msgType)
+
+    handlingDuration.labels(label).observe(time.perf_counter() - start)
+
+async def handleRequestsAsync(reader, writer):
+    '''Equivalente a handleRequests para o modo asyncio: uma corotina por cliente, todas
+    executadas pelo mesmo loop de eventos
+    Entrada: o leitor e o escritor de stream da conexao'''
+
+    # recupera o par (IP,PORTA) do cliente
+    address = writer.get_extra_info('peername')
+
+    connection = AsyncConnection(writer, address)
+
+    # armazena a conexao no registro de conexoes ativas
+    registry.add(connection)
+
+    # a conexao tem um prazo para entrar no bate-papo
+    watchConnection(connection)
+
+    log.info('Conexao estabelecida', address=address)
+
+    # buffer de recebimento da conexao, reutilizado por todas as mensagens
+    decoder = FrameDecoder(maxFrameSize=MAX_MESSAGE_SIZE)
+
+    try:
+        while True:
+
+            # le tudo o que estiver disponivel (uma ou mais mensagens)
+            data = await reader.read(READ_SIZE)
+
+            # caso receba dados vazios: cliente encerrou a conexao
+            if not data:
+                break
+
+            connection.lastActivity = time.monotonic()
+
+            decoder.feed(data)
+
+            # trata todas as mensagens completas recebidas nessa leitura
+            for receivedMsg in decoder.frames():
+                processMessage(connection, address, receivedMsg)
+
+                # uma mensagem cujo tratamento continua fora do loop (leitura do disco) e concluida
+                # antes da proxima; as falhas chegam aqui, como as do proprio tratamento
+                if connection.pending is not None:
+                    pending, connection.pending = connection.pending, None
+                    await pending
+
+            # cede o loop para as tarefas escritoras: com dados ja disponiveis no buffer, read
+            # nao suspende, e uma rajada de um unico cliente encheria as filas de saida dos demais
+            await asyncio.sleep(0)
+
+    # conexao resetada ou encerrada pelo servidor (cliente lento)
+    except ConnectionError:
+        pass
+
+    # mensagem acima do tamanho maximo: o cliente e desconectado sem que ela seja recebida
+    except FrameTooLargeError as e:
+        log.warning('Mensagem recusada', address=address, error=e)
+
+    # falha inesperada no tratamento de uma mensagem: o cliente e desconectado, sem derrubar o servidor
+    except Exception:
+        log.exception('Falha no tratamento da conexao', address=address)
+
+    finally:
+
+        # fecha a conexao e a retira do registro de conexoes atuais
+        connection.close()
+        registry.remove(connection)
+        forgetConnection(connection)
+
+        # registra o fim da conexao na captura
+        if capture is not None:
+            capture.recordClose(connection.id)
+
+        log.info('Conexao encerrada', address=address)
+
+        # trata requisições de saída do bate-papo
+        handleLeaveRequest(connection, address)
+
+# função para fazer o broadcast da mensagem 'message' para os membros da sala 'room', com exceção daquele de conexão 'connection'
+# (se informada a função 'include', apenas para os membros cuja conexão ela aceita)
+def broadcast(connection, message, room, include=None):
+
+    start = time.perf_counter()
+
+    # snapshot das conexões dos membros da sala, que não é alterado
+    # por entradas e saídas concorrentes de outros usuários
+    members = registry.roomSnapshot(room)
+
+    recipients = 0
+
+    # percorre o snapshot
+    for client in members:
+
+        # se essa conexão é diferente da de quem enviou a mensagem
+        if client is not connection and (include is None or include(client)):
+
+            # enfileira para esse usuário o buffer da mensagem no seu codec (codificado uma única vez por codec)
+            client.sendMessage(message)
+            recipients += 1
+
+    fanout.observe(recipients)
+    broadcastDuration.observe(time.perf_counter() - start)
+
+# função para entregar a mensagem pública 'msgObject' aos membros da sala 'room' neste nó, com exceção daquele de conexão 'connection'
+def publishRoomMessage(connection, msgObject, room):
+
+    # grava a mensagem no histórico, que lhe atribui um identificador (informado aos clientes no campo "id")
+    if history is not None:
+        msgObject = dict(msgObject, id=history.append(room, msgObject))
+
+    message = EncodedMessage(msgObject)
+
+    # guarda a mensagem entre as recentes da sala, para quem entrar nela depois
+    if cache is not None:
+        cache.add(room, message)
+
+    broadcast(connection, message, room)
+
+# função para recuperar as mensagens recentes da sala 'room', enviadas a quem entra nela; chamada sob o
+# lock do registro, apenas lê o cache em memória (a sala é carregada antes, por loadRecentMessages)
+def recentMessages(room):
+
+    if cache is None:
+        return []
+
+    messages = cache.peek(room)
+
+    return messages if messages is not None else []
+
+# função para carregar no cache as mensagens recentes da sala 'room', lidas do histórico em disco
+def loadRecentMessages(room):
+
+    try:
+        messages = [EncodedMessage(msgObject) for msgObject in history.last(room, cache.messagesPerRoom)]
+    except OSError as e:
+        log.warning('Falha na leitura do historico', room=room, error=e)
+        return
+
+    cache.fill(room, messages)
+
+# função para executar 'done' depois de garantir que a sala 'room' está no cache, antes de o usuário
+# entrar nela (fora do lock do registro): se for preciso ler o histórico em disco, a leitura é feita
+# na thread leitora, no modo threads, ou fora do loop de eventos, no modo asyncio
+def whenRecentLoaded(connection, room, done):
+
+    if cache is not None and cache.get(room) is None:
+
+        # sem histórico, a sala começa vazia
+        if history is None:
+            cache.fill(room, [])
+
+        else:
+            connection.runBlocking(lambda: loadRecentMessages(room), lambda _: done())
+            return
+
+    done()
+
+# função para recuperar e validar o nome de sala informado em uma mensagem
+def getRoomName(msgObject):
+
+    room = msgObject.get('room')
+
+    # nome ausente ou inválido: usa a sala padrão
+    if not isinstance(room, str) or not room.strip() or len(room) > MAX_ROOM_NAME:
+        return DEFAULT_ROOM
+
+    return room.strip()
+
+# função para montar o objeto de um usuário enviado aos clientes
+def userEntry(user_name, user_address):
+
+    # é necessário enviar um objeto pois não existem tuplas no formato JSON
+    return {
+        "host": user_address[0],
+        "port": user_address[1],
+        "name": user_name
+    }
+
+# função para montar a lista de membros de uma sala enviada aos clientes
+def getUsersList(room):
+    return [userEntry(user_name, user_address) for user_address, user_name in registry.roomUsers(room)]
+
+# função para montar os campos com os membros de uma sala enviados ao entrar nela: a lista completa
+# ou, para clientes com presença versionada, a primeira página da lista e a versão da presença
+def usersFields(room, presence):
+
+    if not presence:
+        return {"users_list": getUsersList(room)}
+
+    users, version, total, following = registry.presencePage(room, None, PRESENCE_PAGE_SIZE)
+
+    return {
+        "users_list": [userEntry(user_name, user_address) for user_name, user_address in users],
+        "version": version,
+        "total": total,
+        "next": following
+    }
+
+# função para notificar os membros de uma sala da entrada ou saída de um usuário
+def notifyRoom(connectionSocket, address, msgType, username, room):
+
+    # cria objeto de notificação de entrada (user-joined) ou saída (user-left) de usuário
+    notification = {
+        "type": msgType,
+        "name": username,
+        "host": address[0],
+        "port": address[1],
+        "room": room
+    }
+
+    log.message('Notificacao enviada a sala', message=notification)
+
+    # envia a notificação para todos os outros membros da sala (os com presença versionada recebem presence-delta)
+    broadcast(connectionSocket, EncodedMessage(notification), room, lambda client: not client.presence)
+
+# envia a cada sala com entradas ou saídas desde o último envio um único presence-delta, com a última mudança de cada usuário
+def notifyPresence():
+
+    for room, since, version, changes in registry.takePresenceChanges():
+
+        # o presence-delta lista as entradas e as saídas posteriores à versão 'since' (os membros
+        # que não têm essa versão pedem as mudanças que perderam com um presence-request)
+        delta = {
+            "type": "presence-delta",
+            "room": room,
+            "since": since,
+            "version": version,
+            "joined": [userEntry(name, address) for name, joined, address in changes if joined],
+            "left": [userEntry(name, address) for name, joined, address in changes if not joined]
+        }
+
+        log.message('Notificacao enviada a sala', message=delta)
+
+        broadcast(None, EncodedMessage(delta), room, lambda client: client.presence)
+
+# envia periodicamente as mudanças de presença acumuladas (modo threads)
+def notifyPresenceLoop():
+    while True:
+        time.sleep(PRESENCE_INTERVAL)
+        notifyPresence()
+
+# envia periodicamente as mudanças de presença acumuladas (modo asyncio)
+async def notifyPresenceAsync():
+    while True:
+        await asyncio.sleep(PRESENCE_INTERVAL)
+        notifyPresence()
+
+# trata requisição de entrada de usuário no bate-papo
+def handleJoinRequest(connectionSocket, address, msgObject):
+
+    # recupera o nome do usuário e a sala desejada do objeto da mensagem
+    username = msgObject.get('name')
+    room = getRoomName(msgObject)
+
+    # os nomes são mantidos em ordem nas salas: apenas strings são aceitas
+    if not isinstance(username, str) or not username:
+        log.warning('Nome de usuario invalido', address=address)
+        connectionSocket.sendMessage(EncodedMessage({
+            "type": "connection-response",
+            "success": False,
+            "users_list": None,
+            "error_msg": "Nome de usuário inválido!",
+            "codec": JSON_CODEC.name
+        }))
+        return
+
+    # um usuário já no bate-papo precisa sair antes de entrar de novo (com outro nome ou em outra sala)
+    if connectionSocket.name is not None:
+        log.warning('Pedido de entrada de usuario ja no bate-papo', address=address, name=connectionSocket.name)
+        connectionSocket.sendMessage(EncodedMessage({
+            "type": "connection-response",
+            "success": False,
+            "users_list": None,
+            "error_msg": "Você já está no bate-papo!\nSaia antes de entrar novamente.",
+            "codec": connectionSocket.codec.name
+        }))
+        return
+
+    # recupera o codec solicitado pelo cliente para o restante da sessão (JSON caso não suportado)
+    codec = CODECS.get(msgObject.get('codec'), JSON_CODEC)
+
+    # o cliente recebe lotes de mensagens se os aceitar e se eles estiverem habilitados no servidor
+    batching = msgObject.get('batch') is True and BATCH_WINDOW > 0
 
-online_users = {} # dicionário de usuários ativos na sala de bate-papo (endereço e nome de usuário)
+    # o cliente recebe a presença versionada se a pedir
+    presence = msgObject.get('presence') is True
 
-def initialize():
-    '''Cria um socket para o servidor e o coloca em modo de espera por conexoes
-    Saida: o socket de servidor criado'''
+    # apenas clientes que respondem a pings os recebem; os antigos, que nunca respondem, são apenas desconectados quando ociosos
+    heartbeat = msgObject.get('heartbeat') is True
 
-    # cria socket
-    serverSocket = socket.socket()
+    def enter():
 
-    # permite o reuso da porta caso a aplicacao seja finalizada de forma abrupta
-    serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # com um único processo, o registro decide sozinho se o nome está disponível
+        if cluster is None:
+            joinChat(connectionSocket, address, username, room, codec, batching, presence, heartbeat)
 
-    # define o socket do servidor como nao-bloqueante
-    serverSocket.setblocking(False)
+        # com vários processos, o nome é antes reservado no processo dono dele, e a entrada é concluída quando a reserva for respondida
+        else:
+            cluster.reserve(username, lambda reserved: joinChat(connectionSocket, address, username, room, codec, batching, presence, heartbeat, reserved))
 
-    # vincula a interface e porta para comunicacao
-    serverSocket.bind((HOST, PORT))
+    # as mensagens recentes da sala são carregadas antes da entrada, que as envia ainda sob o lock do registro
+    whenRecentLoaded(connectionSocket, room, enter)
 
-    # define o limite maximo de conexoes pendentes e coloca-se em modo de espera por conexao
-    serverSocket.listen(5)
+# conclui a entrada de usuário no bate-papo; 'reserved' indica se o nome foi concedido pelo processo dono dele (None se ele estava inacessível)
+def joinChat(connectionSocket, address, username, room, codec, batching, presence, heartbeat, reserved=True):
 
-    # adiciona o socket do servidor na lista de entradas da aplicacao
-    inputs.append(serverSocket)
+    # envia a resposta de sucesso ao cliente; executada pelo registro antes que o usuário fique
+    # visível para broadcasts, de modo que a resposta é sempre a primeira mensagem da sessão
+    def welcome():
 
-    return serverSocket
+        # cria objeto de resposta de sucesso de conexão, com os demais membros da sala
+        connection_response_object = {
+            "type": "connection-response",
+            "success": True,
+            "error_msg": None,
+            "codec": codec.name,
+            "batch": batching,
+            "presence": presence,
+            "room": room
+        }
 
-def acceptConnection(serverSocket):
-    '''Estabelece conexao com um cliente
-    Entrada: o socket do servidor
-    Saida: o socket de conexao criado e o endereco (IP, PORTA) do cliente'''
+        connection_response_object.update(usersFields(room, presence))
 
-    # Aceita o pedido de conexao do cliente
-    socket, address = serverSocket.accept()
+        # envia a resposta de conexão ainda no codec JSON e passa a usar o codec negociado
+        connectionSocket.sendMessage(EncodedMessage(connection_response_object))
+        connectionSocket.codec = codec
+        connectionSocket.batching = batching
+        connectionSocket.presence = presence
+        connectionSocket.heartbeat = heartbeat
 
-    # Armazena o socket e o endereco do cliente no dicinario de conexoes ativas
-    connected_clients[socket] = address
+        log.message('Mensagem enviada', address=address, message=connection_response_object)
 
-    # imprime o par (IP,PORTA) da conexao estabelecida
-    print('Conexao estabelecida com:', address)
+        # em seguida, envia as mensagens recentes da sala, já no codec negociado
+        for message in recentMessages(room):
+            connectionSocket.sendMessage(message)
 
-    return socket, address
+    # tenta colocar o usuário no bate-papo; falha se o nome de usuário já está em uso ou se o processo dono dele está inacessível
+    if not reserved or not registry.join(connectionSocket, username, room, welcome):
 
-# função para receber 'numBytes' bytes or retornar None se EOF for atingido
-def recvall(connectionSocket, numBytes):
+        # devolve a reserva de um nome que não chegou a ser usado
+        if reserved and cluster is not None:
+            cluster.release(username)
 
-    data = bytearray()
+        # imprime mensagem de erro no console
+        if reserved is None:
+            log.warning('Dono do nome de usuario inacessivel', address=address, name=username)
+            error_msg = "Servidor temporariamente indisponível!\nPor favor, tente novamente."
+        else:
+            log.info('Nome de usuario ja em uso', address=address, name=username)
+            error_msg = "Nome de usuário já está em uso!\nPor favor, digite outro nome."
 
-    while len(data) < numBytes:
-        packet = connectionSocket.recv(numBytes - len(data))
+        # cria objeto com dados de resposta de conexão contendo a mensagem de erro
+        connection_response_object = {
+            "type": "connection-response",
+            "success": False,
+            "users_list": None,
+            "error_msg": error_msg,
+            "codec": JSON_CODEC.name
+        }
 
-        if not packet:
-            return None
+        # envia a resposta de falha de conexão para o cliente
+        connectionSocket.sendMessage(EncodedMessage(connection_response_object))
 
-        data.extend(packet)
+        log.message('Mensagem enviada', address=address, message=connection_response_object)
 
-    return data
+    # se o nome de usuário não estava em uso
+    else:
 
-# função para receber a mensagem completa de acordo com o tamanho em bytes enviado no header
-def receiveMessage(connectionSocket):
+        log.info('Usuario entrou no bate-papo', name=username, room=room, online=registry.onlineCount())
 
-    # recebe o trecho da mensagem relativo ao tamanho da mensagem
-    header = recvall(connectionSocket, HEADER_LENGTH)
+        # a partir daqui, vale o tempo limite de ociosidade no lugar do prazo de entrada
+        watchConnection(connectionSocket)
 
-    # se mensagem recebida for vazia, retorna None
-    if not header:
-        return None
+        # envia a notificação de entrada de novo usuário para os outros membros da sala
+        notifyRoom(connectionSocket, address, 'user-joined', username, room)
 
-    # desempacota os 4 bytes do header que contém o tamanho da mensagem
-    msgSize = struct.unpack('>I', header)[0]
+# trata requisição de saída de usuário do bate-papo
+def handleLeaveRequest(connectionSocket, address):
 
-    # recebe o restante da mensagem, de tamanho msgSize
-    return recvall(connectionSocket, msgSize)
+    # caso o cliente que deseja sair esteja no registro de conexões atuais
+    if registry.isConnected(connectionSocket):
 
-def handleRequests(connectionSocket, address):
-    '''Recebe e processa mensagens do cliente, tratando suas diferentes requisições e 
-    enviando para ele os retornos gerados pela aplicacao para a mensagem recebida
-    Entrada: o socket da conexao e o endereco do cliente'''
+        # cria objeto de resposta de desconexão
+        disconnection_response = {
+            "type": "disconnection-response"
+        }
 
-    while True:
+        log.message('Mensagem enviada', address=address, message=disconnection_response)
 
-        # recebe a mensagem do cliente
-        receivedMsg = receiveMessage(connectionSocket)
+        # envia a resposta de desconexão para o cliente que a solicitou, ainda no codec da sessão
+        connectionSocket.sendMessage(EncodedMessage(disconnection_response))
 
-        # caso receba dados vazios: cliente encerrou a conexao
-        if not receivedMsg:
+    # remove o usuário do registro de usuários ativos no bate-papo, caso ele esteja lá
+    # retorno para o menu / encerramento da aplicação diretamente da janela de bate-papo
+    username, room = registry.leave(connectionSocket)
 
-            # fecha o socket da conexao
-            connectionSocket.close()
+    # fim da sessão: um novo connection-request é sempre enviado em JSON
+    connectionSocket.codec = JSON_CODEC
+    connectionSocket.batching = False
+    connectionSocket.presence = False
+    connectionSocket.heartbeat = False
 
-            # retira a entrada referente ao cliente do dicionario de conexoes atuais
-            del connected_clients[connectionSocket]
+    if username is not None:
 
-            # imprime mensagem de conexao encerrada
-            print('Conexao encerrada com:', address)
+        # fora do bate-papo, a conexão volta a ter um prazo para entrar de novo
+        connectionSocket.outsideSince = time.monotonic()
+        watchConnection(connectionSocket)
 
-            # trata requisições de saída do bate-papo 
-            handleLeaveRequest(connectionSocket, address)
+        log.info('Usuario saiu do bate-papo', name=username, room=room, online=registry.onlineCount())
 
-            return
+        # envia a notificação de saída de usuário para os outros membros da sala
+        notifyRoom(connectionSocket, address, 'user-left', username, room)
 
-        # transforma a mensagem em uma string JSON
-        receivedMsgString = receivedMsg.decode(FORMAT)
+# trata requisição de troca de sala: 'room-join' para a sala informada, 'room-leave' de volta para a sala padrão
+def handleRoomChange(connectionSocket, address, msgObject):
 
-        # imprime a mensagem recebida
-        print(str(address) + ':', receivedMsgString)
+    # apenas usuários ativos no bate-papo podem trocar de sala
+    if connectionSocket.name is None:
+        log.warning('Troca de sala de cliente fora do bate-papo', address=address)
+        return
 
-        try:
-            # recupera o objeto contido na string JSON
-            receivedMsgObject = json.loads(receivedMsgString)
+    username = connectionSocket.name
 
-        except JSONDecodeError:
-            print('Falha na decodificação da mensagem!')
-            continue
+    if msgObject['type'] == 'room-join':
+        room = getRoomName(msgObject)
+    else:
+        room = DEFAULT_ROOM
 
-        # trata requisição de entrada de usuário no bate-papo
-        if receivedMsgObject['type'] == 'connection-request':
-            handleJoinRequest(connectionSocket, address, receivedMsgObject)
-        
-        # trata requisição de saída de usuário do bate-papo
-        elif receivedMsgObject['type'] == 'disconnection-request':
-            handleLeaveRequest(connectionSocket, address)
+    # envia ao usuário a lista de membros da nova sala, antes que ele passe a receber os broadcasts dela
+    def welcome():
 
-        # trata as mensagens de bate-papo recebidas
-        elif receivedMsgObject['type'] == 'chat-message':
-            handleChatMessage(connectionSocket, address, receivedMsgObject)
+        room_joined_object = {
+            "type": "room-joined",
+            "room": room
+        }
 
-        # caso receba um tipo de mensagem desconhecido, imprime mensagem de erro no console
-        else:
-            print(f'Tipo de mensagem "{receivedMsgObject["type"]}" inválido!')
-            
-# função para fazer o broadcast da mensagem 'msg' para todos os clientes com exceção daquele de socket 'connection'
-def broadcast(connection, msg):
+        room_joined_object.update(usersFields(room, connectionSocket.presence))
 
-    # percorre os sockets de conexão dos clientes atualmente conectados ao servidor
-    for socket in connected_clients:
+        connectionSocket.sendMessage(EncodedMessage(room_joined_object))
 
-        # se esse socket corresponde a um usuário ativo no bate-papo, diferente de quem enviou a mensagem
-        if connected_clients[socket] in online_users and socket != connection:
+        log.message('Mensagem enviada', address=address, message=room_joined_object)
 
-            # envia a mensagem para esse usuário
-            socket.sendall(struct.pack('>I', len(msg)) + msg.encode(FORMAT))
+        # em seguida, envia as mensagens recentes da nova sala
+        for message in recentMessages(room):
+            connectionSocket.sendMessage(message)
 
-# trata requisição de entrada de usuário no bate-papo
-def handleJoinRequest(connectionSocket, address, msgObject):
+    def move():
 
-    # recupera o nome do usuário do objeto da mensagem
-    username = msgObject['name']
+        previous = registry.moveToRoom(connectionSocket, room, welcome)
 
-    # se o nome de usuário já está em uso
-    if username in online_users.values():
+        if previous is None:
+            return
 
-        # imprime mensagem de erro no console
-        print(f'ERRO: Nome de usuário "{username}" já em uso!')
+        log.info('Usuario trocou de sala', name=username, previous=previous, room=room)
 
-        # cria objeto com dados de resposta de conexão contendo a mensagem de erro
-        connection_response_object = {
-            "type": "connection-response",
-            "success": False,
-            "users_list": None,
-            "error_msg": "Nome de usuário já está em uso!\nPor favor, digite outro nome."
-        }
+        # notifica a saída aos membros da sala anterior e a entrada aos membros da nova sala
+        notifyRoom(connectionSocket, address, 'user-left', username, previous)
+        notifyRoom(connectionSocket, address, 'user-joined', username, room)
 
-    # se o nome de usuário não estiver em uso
-    else:
+    # as mensagens recentes da nova sala são carregadas antes da troca, que as envia ainda sob o lock do registro
+    whenRecentLoaded(connectionSocket, room, move)
 
-        print(username, 'se conectou!')
+# trata requisição de presença da sala atual: as mudanças posteriores à versão 'since' ou, se elas não
+# estiverem mais disponíveis ou não for informada a versão, uma página da lista de membros a partir do nome 'after'
+def handlePresenceRequest(connectionSocket, address, msgObject):
 
-        # cria uma lista vazia para armazenar os usuários ativos
-        # é necessário enviar uma lista pois não existem tuplas no formato JSON,
-        # e o dicionario 'online_users' tem como chave as tuplas de endereço dos usuários
-        users_list = []
+    room = connectionSocket.room
 
-        # preenche a lista de usuários ativos a partir do dicionario 'online_users'
-        for user in online_users:
-            user_to_list = {
-                "host": user[0],
-                "port": user[1],
-                "name": online_users[user]
-            }
-            users_list.append(user_to_list)
+    # apenas usuários ativos no bate-papo consultam a presença
+    if room is None:
+        log.warning('Pedido de presenca de cliente fora do bate-papo', address=address)
+        return
 
-        # cria objeto de resposta de sucesso de conexão
-        connection_response_object = {
-            "type": "connection-response",
-            "success": True,
-            "users_list": users_list,
-            "error_msg": None
-        }
+    since = msgObject.get('since')
+    after = msgObject.get('after')
+    limit = msgObject.get('limit')
 
-        # adiciona o usuário no dicionário de usuários ativos no bate-papo
-        online_users[address] = username
+    if not isinstance(after, str):
+        after = None
 
-        # cria objeto de notificação de entrada de novo usuário no bate-papo
-        connection_object = {
-            "type": "user-joined",
-            "name": username,
-            "host": address[0],
-            "port": address[1]
-        }
+    if not isinstance(limit, int) or not 0 < limit <= PRESENCE_PAGE_SIZE:
+        limit = PRESENCE_PAGE_SIZE
 
-        # transforma o objeto de notificação de entrada de usuário em uma string JSON
-        connection_msg = json.dumps(connection_object)
+    changes = None
 
-        print('Mensagem broadcast enviada:', connection_msg)
+    if isinstance(since, int) and after is None:
+        changes, version = registry.presenceChanges(room, since)
 
-        # envia a notificação de entrada de novo usuário para todos os outros usuários ativos
-        broadcast(connectionSocket, connection_msg)
+    presence_response = {
+        "type": "presence-response",
+        "room": room
+    }
 
-    # transforma o objeto de resposta de conexão em uma string JSON
-    connection_response_msg = json.dumps(connection_response_object)
+    if changes is not None:
+        presence_response.update({
+            "since": since,
+            "version": version,
+            "joined": [userEntry(name, user_address) for name, joined, user_address in changes if joined],
+            "left": [userEntry(name, user_address) for name, joined, user_address in changes if not joined]
+        })
 
-    # envia a resposta de conexão (sucesso ou falha) para o cliente
-    connectionSocket.sendall(struct.pack('>I', len(connection_response_msg)) + connection_response_msg.encode(FORMAT))
+    # página da lista de membros (a primeira, caso as mudanças pedidas não estejam mais disponíveis)
+    else:
+        users, version, total, following = registry.presencePage(room, after, limit)
 
-    print('Mensagem enviada:', connection_response_msg)
+        presence_response.update({
+            "after": after,
+            "version": version,
+            "total": total,
+            "next": following,
+            "users_list": [userEntry(name, user_address) for name, user_address in users]
+        })
 
-    print('online_users:', online_users)
+    connectionSocket.sendMessage(EncodedMessage(presence_response))
 
-# trata requisição de saída de usuário do bate-papo
-def handleLeaveRequest(connectionSocket, address):
+    log.message('Mensagem enviada', address=address, message=presence_response)
 
-    # caso o socket do cliente que deseja sair esteja no dicionário de conexões atuais
-    if connectionSocket in connected_clients:
+# trata requisição da lista de salas existentes
+def handleRoomList(connectionSocket, address):
 
-        # cria objeto de resposta de desconexão
-        disconnection_response = {
-            "type": "disconnection-response"
-        }
+    room_list_object = {
+        "type": "room-list-response",
+        "rooms": [{"name": name, "members": members} for name, members in registry.listRooms()]
+    }
 
-        # transforma o objeto de resposta de desconexão em uma string JSON
-        disconnection_response_msg = json.dumps(disconnection_response)
+    connectionSocket.sendMessage(EncodedMessage(room_list_object))
 
-        print('disconnection_response:', disconnection_response_msg)
+    log.message('Mensagem enviada', address=address, message=room_list_object)
 
-        # envia a resposta de desconexão para o cliente que a solicitou
-        connectionSocket.sendall(struct.pack('>I', len(disconnection_response_msg)) + disconnection_response_msg.encode(FORMAT))
+# trata requisição de mensagens anteriores da sala atual: as últimas 'limit' ou, se informado 'since', as seguintes à de identificador 'since'
+def handleHistoryRequest(connectionSocket, address, msgObject):
 
-    # caso o usuário esteja no dicionário de usuários ativos na sala de bate-papo
-    # retorno para o menu / encerramento da aplicação diretamente da janela de bate-papo
-    if address in online_users:
-
-        # cria objeto de notificação de saída de usuário do bate-papo
-        disconnection_broadcast = {
-            "type": "user-left",
-            "name": online_users[address],
-            "host": address[0],
-            "port": address[1]
-        }
- 
-        # remove o usuário do dicionário de usuários ativos no bate-papo
-        del online_users[address]
+    room = connectionSocket.room
 
-        # transforma o objeto de notificação de saída de usuário em uma string JSON
-        disconnection_broadcast_msg = json.dumps(disconnection_broadcast)
+    # apenas usuários ativos no bate-papo consultam o histórico
+    if room is None:
+        log.warning('Pedido de historico de cliente fora do bate-papo', address=address)
+        return
 
-        print('disconnection_broadcast:', disconnection_broadcast_msg)
+    limit = msgObject.get('limit')
+    since = msgObject.get('since')
 
-        print('online_users:', online_users)
+    # limite ausente ou inválido: usa o padrão; acima do máximo: usa o máximo
+    if not isinstance(limit, int) or limit <= 0:
+        limit = HISTORY_DEFAULT_LIMIT
 
-        # envia a notificação de saída de usuário para todos os outros usuários ativos
-        broadcast(connectionSocket, disconnection_broadcast_msg)
+    limit = min(limit, HISTORY_LIMIT)
 
-# função para recuperar, a partir do nome de um usuário, seu socket de conexão com o servidor
-def getReceiverSocket(receiver_name):
+    # envia as mensagens lidas do histórico
+    def respond(messages):
 
-    # se usuário não estiver ativo, retorna None
-    if not receiver_name in online_users.values():
-        return None
-    
-    # recupera o endereço do usuário a partir do seu nome
-    receiver_address = list(online_users.keys())[list(online_users.values()).index(receiver_name)]
+        history_response_object = {
+            "type": "history-response",
+            "room": room,
+            "messages": messages
+        }
 
-    print(f'receiver_address: "{receiver_address}"')
-    
-    # se usuário não estiver com conexão ativa com o servidor, retorna None
-    if not receiver_address in connected_clients.values():
-        return None
-    
-    # recupera o socket de conexão do usuário a partir do seu endereço
-    receiver_socket = list(connected_clients.keys())[list(connected_clients.values()).index(receiver_address)]
+        connectionSocket.sendMessage(EncodedMessage(history_response_object))
+
+        log.message('Historico enviado', address=address, room=room, messages=len(messages))
 
-    return receiver_socket
+    if history is None:
+        respond([])
+
+    # a leitura dos segmentos em disco é feita fora do loop de eventos, no modo asyncio
+    elif isinstance(since, int):
+        connectionSocket.runBlocking(lambda: history.since(room, since, limit), respond)
+    else:
+        connectionSocket.runBlocking(lambda: history.last(room, limit), respond)
 
 # função para tratar as mensagens de bate-papo recebidas pelo servidor
 def handleChatMessage(connectionSocket, address, msgObject):
 
     # recupera o texto e o nome do remetente da mensagem do objeto
-    message = msgObject['message']
-    sender = msgObject['sender']
+    message = msgObject.get('message')
+    sender = msgObject.get('sender')
 
     # caso a mensagem seja privada
-    if msgObject['private'] == True:
+    if msgObject.get('private') == True:
 
         # recupera o nome do destinatário da mensagem privada
-        receiver_name = msgObject['receiver']
+        receiver_name = msgObject.get('receiver')
 
-        # recupera o socket do destinatário da mensagem privada
-        receiver_socket = getReceiverSocket(receiver_name)
+        # destinatário ausente ou inválido: a mensagem é descartada
+        if not isinstance(receiver_name, str):
+            log.warning('Destinatario de mensagem privada invalido', address=address)
+            return
+
+        # recupera a conexão do destinatário da mensagem privada
+        receiver_connection = registry.getByName(receiver_name)
 
-        # se não encontrar o socket do destinatário, retorna
-        if not receiver_socket:
+        # se o destinatário não estiver ativo no bate-papo deste processo nem de outro, avisa o remetente
+        if receiver_connection is None and (cluster is None or registry.remoteNode(receiver_name) is None):
+            connectionSocket.sendMessage(EncodedMessage({"type": "private-error","receiver": receiver_name,
+                "error_msg": f'Usuário "{receiver_name}" não encontrado.'}))
             return
         
         # cria o objeto da mensagem privada de bate-papo
@@ -331,35 +2026,44 @@ def handleChatMessage(connectionSocket, address, msgObject):
             "message": message
         }
 
-        # transforma o objeto da mensagem privada de bate-papo em uma string JSON
-        msg_string = json.dumps(msg_object)
+        log.message('Mensagem privada', message=msg_object)
 
-        print('chat-message private:', msg_string)
-
-        # envia a mensagem privada para o destinatário correspondente
-        receiver_socket.sendall(struct.pack('>I', len(msg_string)) + msg_string.encode(FORMAT))
+        # envia a mensagem privada para o destinatário correspondente, neste processo ou no processo em que ele está
+        if receiver_connection is not None:
+            receiver_connection.sendMessage(EncodedMessage(msg_object))
+        else:
+            cluster.forwardPrivateMessage(receiver_name, msg_object)
 
     # caso a mensagem seja pública
     else:
 
+        # recupera a sala do remetente, para onde a mensagem é enviada
+        room = connectionSocket.room
+
+        # mensagem pública de quem não está no bate-papo é descartada
+        if room is None:
+            return
+
         # cria o objeto da mensagem pública de bate-papo
         msg_object = {
             "type": "chat-message",
             "private": False,
             "sender": sender,
-            "message": message
+            "message": message,
+            "room": room
         }
 
-        # transforma o objeto da mensagem pública de bate-papo em uma string JSON
-        msg_string = json.dumps(msg_object)
+        log.message('Mensagem publica', message=msg_object)
 
-        print('chat-message broadcast:', msg_string)
+        # envia a mensagem pública para todos os membros da sala, com exceção de quem a enviou
+        publishRoomMessage(connectionSocket, msg_object, room)
 
-        # envia a mensagem pública para todos os usuários ativos no bate-papo, com exceção de quem a enviou
-        broadcast(connectionSocket, msg_string)
+        # e para os processos com membros da sala (cada nó grava a mensagem no seu histórico)
+        if cluster is not None:
+            cluster.forwardRoomMessage(room, msg_object)
 
-def main():
-    '''Loop principal do servidor'''
+def runThreadedServer():
+    '''Loop principal do servidor no modo com uma thread por cliente'''
 
     # armazena as threads criadas para tratar requisicoes
     threads = []
@@ -367,7 +2071,27 @@ def main():
     # inicializa o servidor
     serverSocket = initialize()
 
-    print('O servidor esta pronto para receber conexoes...')
+    if cluster is not None:
+        cluster.start()
+
+    # envia periodicamente as mudanças de presença das salas
+    threading.Thread(target=notifyPresenceLoop, daemon=True).start()
+
+    # verifica periodicamente a atividade das conexões
+    if heartbeats is not None:
+        threading.Thread(target=heartbeatLoop, daemon=True).start()
+
+    # em um dos processos do servidor, os comandos chegam do processo principal como sinais
+    if WORKERS > 1:
+        inputs.remove(sys.stdin)
+        signal.signal(signal.SIGTERM, lambda signum, frame: stopThreadedServer(serverSocket, threads))
+        signal.signal(signal.SIGUSR1, lambda signum, frame: printQueueDepths())
+        signal.signal(signal.SIGUSR2, lambda signum, frame: printCacheStats())
+        signal.signal(signal.SIGPROF, lambda signum, frame: dumpProfile())
+    else:
+        signal.signal(signal.SIGTERM, lambda signum, frame: terminate())
+
+    log.info('O servidor esta pronto para receber conexoes', port=PORT, mode='threads')
 
     while True:
 
@@ -400,20 +2124,514 @@ def main():
 
                 # caso seja uma solicitacao de encerramento do servidor
                 if command == 'exit':
+                    stopThreadedServer(serverSocket, threads)
+
+                # caso seja uma solicitacao da profundidade das filas de saida
+                elif command == 'filas':
+                    printQueueDepths()
+
+                # caso seja uma solicitacao dos contadores do cache de mensagens recentes
+                elif command == 'cache':
+                    printCacheStats()
+
+                # caso seja uma solicitacao do perfil de execucao
+                elif command == 'perfil':
+                    dumpProfile()
+
+def stopThreadedServer(serverSocket, threads):
+    '''Encerra o servidor no modo threads depois que todos os clientes saem'''
+
+    log.info('Aguardando clientes para encerrar servidor')
+
+    # a espera pelos clientes pode terminar com um SIGKILL: o que ja foi capturado e escrito antes
+    if capture is not None:
+        capture.flush()
+
+    # aguarda todas as threads (clientes) finalizarem
+    for t in threads:
+        t.join()
+
+    # encerra o socket do servidor
+    serverSocket.close()
+
+    closeStorage()
+
+    log.info('Servidor encerrado')
+    registros.stop()
+
+    # encerra a aplicacao
+    sys.exit(0)
+
+async def runAsyncServer():
+    '''Loop principal do servidor no modo asyncio: todas as conexoes sao atendidas por um
+    unico loop de eventos, sem criar uma thread por cliente'''
+
+    loop = asyncio.get_running_loop()
+
+    # cada conexao aceita e tratada por uma corotina handleRequestsAsync
+    server = await asyncio.start_server(handleRequestsAsync, HOST, PORT, reuse_address=True,
+                                        reuse_port=WORKERS > 1, backlog=LISTEN_BACKLOG)
+
+    log.info('O servidor esta pronto para receber conexoes', port=PORT, mode='asyncio')
+
+    # sinalizado quando o comando de encerramento e digitado na entrada padrao
+    stop = asyncio.Event()
+
+    # trata os comandos digitados na entrada padrao
+    def readCommand():
+        command = sys.stdin.readline().lower().strip()
+
+        # caso seja uma solicitacao de encerramento do servidor
+        if command == 'exit':
+            stop.set()
+
+        # caso seja uma solicitacao da profundidade das filas de saida
+        elif command == 'filas':
+            printQueueDepths()
+
+        # caso seja uma solicitacao dos contadores do cache de mensagens recentes
+        elif command == 'cache':
+            printCacheStats()
+
+        # caso seja uma solicitacao do perfil de execucao
+        elif command == 'perfil':
+            dumpProfile()
+
+    # as mensagens do barramento sao tratadas no loop de eventos
+    if cluster is not None:
+        cluster.start(lambda function, *args: loop.call_soon_threadsafe(function, *args))
+
+    # envia periodicamente as mudancas de presenca das salas e verifica a atividade das conexoes
+    tasks = [loop.create_task(notifyPresenceAsync())]
+
+    if heartbeats is not None:
+        tasks.append(loop.create_task(heartbeatAsync()))
+
+    # em um dos processos do servidor, os comandos chegam do processo principal como sinais
+    if WORKERS > 1:
+        loop.add_signal_handler(signal.SIGTERM, stop.set)
+        loop.add_signal_handler(signal.SIGUSR1, printQueueDepths)
+        loop.add_signal_handler(signal.SIGUSR2, printCacheStats)
+        loop.add_signal_handler(signal.SIGPROF, dumpProfile)
+    else:
+        loop.add_reader(sys.stdin, readCommand)
+        loop.add_signal_handler(signal.SIGTERM, terminate)
 
-                    print('Aguardando clientes para encerrar servidor...')
+    await stop.wait()
 
-                    # aguarda todas as threads (clientes) finalizarem
-                    for t in threads:
-                        t.join()
+    for task in tasks:
+        task.cancel()
 
-                    # encerra o socket do servidor
-                    serverSocket.close()
+    if WORKERS == 1:
+        loop.remove_reader(sys.stdin)
 
-                    print('Servidor encerrado')
+    # deixa de aceitar novas conexoes
+    server.close()
 
-                    # encerra a aplicacao
-                    sys.exit(0)
+    log.info('Aguardando clientes para encerrar servidor')
+
+    # a espera pelos clientes pode terminar com um SIGKILL: o que ja foi capturado e escrito antes
+    if capture is not None:
+        capture.flush()
+
+    # aguarda todos os clientes encerrarem suas conexoes
+    await server.wait_closed()
+
+    closeStorage()
+
+    log.info('Servidor encerrado')
+    registros.stop()
+
+def openStorage(args, subdirectory=None):
+    '''Cria o cache de mensagens recentes e abre o historico e a captura habilitados na linha de
+    comando; com varios processos, cada um usa o seu subdiretorio 'subdirectory' dos diretorios
+    informados'''
+
+    global history, capture, cache
+
+    if args.cache_mensagens > 0:
+        cache = RecentMessages(args.cache_mensagens, args.cache_mb * 1024 * 1024)
+
+    if args.historico is not None:
+        directory = args.historico if subdirectory is None else os.path.join(args.historico, subdirectory)
+        history = History(directory, commitInterval=args.historico_commit_ms / 1000)
+
+    if args.captura is not None:
+        directory = args.captura if subdirectory is None else os.path.join(args.captura, subdirectory)
+        capture = Capture(directory, args.captura_tamanho_mb * 1024 * 1024, args.captura_arquivos)
+
+        # em um encerramento sem closeStorage (ex.: excecao no loop principal), o buffer da captura ainda e escrito
+        atexit.register(capture.close)
+
+def startLogging(args):
+    '''Configura o registro dos eventos com as opcoes da linha de comando'''
+
+    registros.setup(args.log_nivel, args.log_formato, args.log_arquivo, args.log_mensagens)
+
+def startProfiler(args):
+    '''Inicia o perfilador por amostragem, se habilitado na linha de comando'''
+
+    global profiler
+
+    if args.perfil is None:
+        return
+
+    profiler = Profiler(args.perfil, args.perfil_intervalo_ms / 1000)
+    profiler.run()
+
+    log.info('Perfilador iniciado', directory=args.perfil, interval_ms=args.perfil_intervalo_ms)
+
+def startMetrics(args, nodeId=0):
+    '''Expoe as metricas por HTTP, se habilitado na linha de comando; com varios processos, cada
+    um usa a porta informada somada ao seu identificador'''
+
+    if args.metricas is None:
+        return
+
+    port = args.metricas + nodeId
+
+    try:
+        serve(metrics, port)
+    except OSError as e:
+        log.error('Nao foi possivel expor as metricas', port=port, error=e)
+        return
+
+    log.info('Metricas expostas', url=f'http://127.0.0.1:{port}/metrics')
+
+def terminate():
+    '''Trata o SIGTERM de um servidor com um unico processo: encerra imediatamente, sem aguardar
+    os clientes como o comando exit, mas gravando antes o historico e a captura pendentes'''
+
+    log.info('Servidor encerrado por sinal')
+
+    closeStorage()
+    registros.stop()
+
+    os._exit(128 + signal.SIGTERM)
+
+def closeStorage():
+    '''Grava as mensagens pendentes do historico e da captura'''
+
+    if history is not None:
+        history.close()
+
+    if capture is not None:
+        capture.close()
+
+def runWorkers(args):
+    '''Inicia WORKERS processos servidores, com as opcoes da linha de comando 'args'. Cada um aceita conexoes na mesma porta
+    (SO_REUSEPORT, com o kernel distribuindo as conexoes entre eles) e esta ligado a cada um dos
+    demais por um par de sockets Unix, formando o barramento por onde circulam a presenca, as
+    mensagens e as reservas de nomes. Este processo apenas repassa a eles, como sinais, os
+    comandos da entrada padrao'''
+
+    # cria o canal entre cada par de processos, antes de iniciá-los
+    channels = [{} for _ in range(WORKERS)]
+
+    for i in range(WORKERS):
+        for j in range(i + 1, WORKERS):
+            channels[i][j], channels[j][i] = socket.socketpair()
+
+    pids = []
+
+    for nodeId in range(WORKERS):
+        pid = os.fork()
+
+        if pid == 0:
+            try:
+                # fecha as pontas dos canais que pertencem aos outros processos
+                for other in range(WORKERS):
+                    if other != nodeId:
+                        for channel in channels[other].values():
+                            channel.close()
+
+                runWorker(nodeId, channels[nodeId], args)
+
+            except SystemExit:
+                pass
+
+            finally:
+                registros.stop()
+                sys.stdout.flush()
+                os._exit(0)
+
+        pids.append(pid)
+
+    for nodeChannels in channels:
+        for channel in nodeChannels.values():
+            channel.close()
+
+    # o registro e configurado depois de criar os processos, que configuram cada um o seu
+    startLogging(args)
+
+    log.info('Processos servidores iniciados', workers=WORKERS, port=PORT)
+
+    for line in sys.stdin:
+        command = line.lower().strip()
+
+        # caso seja uma solicitacao de encerramento do servidor
+        if command == 'exit':
+            for pid in pids:
+                os.kill(pid, signal.SIGTERM)
+
+            break
+
+        # caso seja uma solicitacao da profundidade das filas de saida
+        elif command == 'filas':
+            for pid in pids:
+                os.kill(pid, signal.SIGUSR1)
+
+        # caso seja uma solicitacao dos contadores do cache de mensagens recentes
+        elif command == 'cache':
+            for pid in pids:
+                os.kill(pid, signal.SIGUSR2)
+
+        # caso seja uma solicitacao do perfil de execucao
+        elif command == 'perfil':
+            for pid in pids:
+                os.kill(pid, signal.SIGPROF)
+
+    # aguarda todos os processos encerrarem
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+    log.info('Servidor encerrado')
+    registros.stop()
+
+def runWorker(nodeId, channels, args):
+    '''Executa um dos processos servidores
+    Entrada: seu identificador, os canais com os demais processos (identificador -> socket) e as
+    opcoes da linha de comando'''
+
+    global cluster
+
+    startLogging(args)
+
+    bus = Bus(nodeId, WORKERS)
+
+    for node, channel in channels.items():
+        bus.addPeer(node, channel)
+
+    cluster = Cluster(bus)
+
+    # historico e captura de cada processo ficam em um subdiretorio proprio
+    openStorage(args, f'processo-{nodeId}')
+    startMetrics(args, nodeId)
+    startProfiler(args)
+
+    log.info('Processo iniciado', node=nodeId, pid=os.getpid())
+
+    if args.modo == 'asyncio':
+        raiseFileLimit()
+        asyncio.run(runAsyncServer())
+    else:
+        runThreadedServer()
+
+def joinCluster(addresses, nodeId):
+    '''Prepara este servidor para fazer parte de um cluster
+    Entrada: a lista dos enderecos (host, porta) do barramento de todos os nos, na mesma ordem
+    em todos eles, e a posicao deste no na lista'''
+
+    global cluster
+
+    bus = Bus(nodeId, len(addresses))
+
+    # aceita as conexoes dos nos seguintes na lista e se conecta aos anteriores
+    bus.listen(addresses[nodeId])
+
+    for node in range(nodeId):
+        bus.connectTo(node, addresses[node])
+
+    cluster = Cluster(bus)
+
+    log.info('No do cluster iniciado', node=nodeId, nodes=len(addresses), bus=addresses[nodeId])
+
+# converte uma lista de enderecos 'host:porta' separados por virgulas em uma lista de (host, porta)
+def parseAddresses(text):
+    addresses = []
+
+    for item in text.split(','):
+        host, _, port = item.strip().rpartition(':')
+        addresses.append((host, int(port)))
+
+    return addresses
+
+def raiseFileLimit():
+    '''Eleva o limite de descritores de arquivo abertos do processo ate o maximo permitido,
+    ja que cada conexao ocupa um descritor'''
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            log.warning('Nao foi possivel elevar o limite de descritores de arquivo', limit=soft)
+
+def parseArguments():
+    '''Le as opcoes de linha de comando do servidor'''
+
+    parser = argparse.ArgumentParser(description='Servidor de bate-papo')
+
+    parser.add_argument('--porta', type=int, default=PORT,
+                        help='porta onde o servidor aceita as conexoes dos clientes')
+
+    parser.add_argument('--modo', choices=['threads', 'asyncio'], default='threads',
+                        help='threads: uma thread por cliente; asyncio: um unico loop de eventos para todas as conexoes')
+
+    parser.add_argument('--tamanho-maximo-mensagem', type=int, default=MAX_MESSAGE_SIZE,
+                        help='tamanho maximo, em bytes, de uma mensagem enviada por um cliente; quem exceder e desconectado')
+
+    parser.add_argument('--tamanho-fila', type=int, default=OUTBOUND_QUEUE_SIZE,
+                        help='quantidade maxima de mensagens na fila de saida de cada cliente')
+
+    parser.add_argument('--politica-estouro', choices=['drop-oldest', 'disconnect'], default=OVERFLOW_POLICY,
+                        help='drop-oldest: descarta a mensagem mais antiga da fila; disconnect: desconecta o cliente lento')
+
+    parser.add_argument('--lote-janela-ms', type=float, default=BATCH_WINDOW * 1000,
+                        help='tempo, em milissegundos, que cada escritor espera para agrupar mensagens em um unico envio (0 desabilita)')
+
+    parser.add_argument('--lote-max-mensagens', type=int, default=BATCH_MAX_MESSAGES,
+                        help='quantidade maxima de mensagens agrupadas em um unico envio')
+
+    parser.add_argument('--processos', type=int, default=WORKERS,
+                        help='quantidade de processos servidores compartilhando a porta (SO_REUSEPORT), ligados por um barramento local')
+
+    parser.add_argument('--presenca-intervalo-ms', type=float, default=PRESENCE_INTERVAL * 1000,
+                        help='tempo, em milissegundos, em que as entradas e saidas de uma sala sao agrupadas em um unico presence-delta')
+
+    parser.add_argument('--intervalo-ping-s', type=float, default=PING_INTERVAL,
+                        help='tempo, em segundos, sem receber nada de um cliente apos o qual o servidor lhe envia um ping')
+
+    parser.add_argument('--tempo-ocioso-s', type=float, default=IDLE_TIMEOUT,
+                        help='tempo, em segundos, sem receber nada de um cliente no bate-papo (nem o pong) apos o qual ele e desconectado e sai do bate-papo (0 desabilita)')
+
+    parser.add_argument('--tempo-entrada-s', type=float, default=JOIN_TIMEOUT,
+                        help='tempo, em segundos, que uma conexao recem-aceita ou que saiu do bate-papo tem para entrar nele antes de ser encerrada (0 desabilita)')
+
+    parser.add_argument('--historico', metavar='DIRETORIO',
+                        help='grava as mensagens publicas em um log no diretorio informado e atende pedidos de historico')
+
+    parser.add_argument('--historico-commit-ms', type=float, default=COMMIT_INTERVAL * 1000,
+                        help='tempo, em milissegundos, que o historico acumula mensagens antes de grava-las com um unico fsync')
+
+    parser.add_argument('--cache-mensagens', type=int, default=MESSAGES_PER_ROOM,
+                        help='quantidade de mensagens recentes de cada sala enviadas a quem entra nela (0 desabilita)')
+
+    parser.add_argument('--cache-mb', type=int, default=MAX_BYTES // (1024 * 1024),
+                        help='tamanho maximo, em MiB, do cache de mensagens recentes; as salas usadas ha mais tempo sao descartadas')
+
+    parser.add_argument('--captura', metavar='DIRETORIO',
+                        help='grava todas as mensagens recebidas, como chegaram, em arquivos de captura no diretorio informado (ver reproducao.py)')
+
+    parser.add_argument('--captura-tamanho-mb', type=int, default=FILE_SIZE // (1024 * 1024),
+                        help='tamanho, em MiB, a partir do qual um novo arquivo de captura e iniciado')
+
+    parser.add_argument('--captura-arquivos', type=int, default=MAX_FILES,
+                        help='quantidade maxima de arquivos de captura mantidos (os mais antigos sao apagados)')
+
+    parser.add_argument('--metricas', type=int, metavar='PORTA',
+                        help='expoe as metricas do servidor por HTTP, no formato do Prometheus, na porta informada de 127.0.0.1 (com --processos, cada processo usa PORTA + seu numero)')
+
+    parser.add_argument('--log-nivel', choices=registros.LEVELS, default='INFO',
+                        help='nivel minimo dos eventos registrados')
+
+    parser.add_argument('--log-formato', choices=registros.FORMATS, default='texto',
+                        help='texto: uma linha com a mensagem e os campos chave=valor; json: um objeto JSON por linha')
+
+    parser.add_argument('--log-arquivo', metavar='ARQUIVO',
+                        help='arquivo onde os eventos sao registrados (padrao: saida padrao)')
+
+    parser.add_argument('--log-mensagens', type=float, default=1.0,
+                        help='fracao das mensagens tratadas que sao registradas (ex.: 0.01 registra 1 a cada 100; 0 desliga)')
+
+    parser.add_argument('--perfil', metavar='DIRETORIO',
+                        help='amostra periodicamente as pilhas das threads do servidor; o comando perfil grava no diretorio as pilhas colapsadas (flamegraph) e o tempo por funcao')
+
+    parser.add_argument('--perfil-intervalo-ms', type=float, default=INTERVAL * 1000,
+                        help='intervalo, em milissegundos, entre as amostras do perfilador')
+
+    parser.add_argument('--cluster', type=parseAddresses, metavar='HOST:PORTA,...',
+                        help='enderecos do barramento de todos os nos do cluster, na mesma ordem em todos eles')
+
+    parser.add_argument('--no', type=int, default=0,
+                        help='posicao deste servidor na lista de nos do cluster')
+
+    args = parser.parse_args()
+
+    if not 0 <= args.log_mensagens <= 1:
+        parser.error('--log-mensagens deve estar entre 0 e 1')
+
+    if args.tamanho_fila < 1:
+        parser.error('--tamanho-fila deve ser pelo menos 1')
+
+    if args.lote_max_mensagens < 1:
+        parser.error('--lote-max-mensagens deve ser pelo menos 1')
+
+    if args.presenca_intervalo_ms <= 0:
+        parser.error('--presenca-intervalo-ms deve ser positivo')
+
+    if args.tempo_ocioso_s > 0 and not 0 < args.intervalo_ping_s < args.tempo_ocioso_s:
+        parser.error('--intervalo-ping-s deve ser positivo e menor que --tempo-ocioso-s')
+
+    if args.tempo_entrada_s < 0:
+        parser.error('--tempo-entrada-s nao deve ser negativo')
+
+    if args.cluster is not None:
+        if args.processos > 1:
+            parser.error('--cluster nao pode ser usado junto com --processos')
+
+        if not 0 <= args.no < len(args.cluster):
+            parser.error('--no deve ser uma posicao da lista de --cluster')
+
+    return args
+
+def main():
+    '''Inicia o servidor no modo escolhido na linha de comando'''
+
+    global PORT, MAX_MESSAGE_SIZE, OUTBOUND_QUEUE_SIZE, OVERFLOW_POLICY, BATCH_WINDOW, BATCH_MAX_MESSAGES, WORKERS, PRESENCE_INTERVAL, PING_INTERVAL, IDLE_TIMEOUT, JOIN_TIMEOUT, heartbeats
+
+    args = parseArguments()
+
+    PORT = args.porta
+
+    MAX_MESSAGE_SIZE = args.tamanho_maximo_mensagem
+    OUTBOUND_QUEUE_SIZE = args.tamanho_fila
+    OVERFLOW_POLICY = args.politica_estouro
+    BATCH_WINDOW = args.lote_janela_ms / 1000
+    BATCH_MAX_MESSAGES = args.lote_max_mensagens
+    WORKERS = args.processos
+    PRESENCE_INTERVAL = args.presenca_intervalo_ms / 1000
+    PING_INTERVAL = args.intervalo_ping_s
+    IDLE_TIMEOUT = args.tempo_ocioso_s
+    JOIN_TIMEOUT = args.tempo_entrada_s
+
+    # uma unica roda de temporizadores para todas as conexoes, com posicoes bem menores que o menor prazo
+    intervals = [interval for interval in (PING_INTERVAL if IDLE_TIMEOUT > 0 else 0, JOIN_TIMEOUT) if interval > 0]
+
+    if intervals:
+        heartbeats = TimerWheel(time.monotonic(), min(TICK, min(intervals) / 4))
+
+    # com varios processos, cada um abre o seu historico e a sua captura depois de iniciado
+    if WORKERS > 1:
+        runWorkers(args)
+        return
+
+    startLogging(args)
+
+    if args.cluster is not None:
+        joinCluster(args.cluster, args.no)
+
+    openStorage(args)
+    startMetrics(args)
+    startProfiler(args)
+
+    if args.modo == 'asyncio':
+        raiseFileLimit()
+        asyncio.run(runAsyncServer())
+    else:
+        runThreadedServer()
 
 # inicia o loop principal da aplicacao
-main()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,394 @@
+import asyncio
+import queue
+import socket
+import threading
+
+from protocolo import CODECS, JSON_CODEC, DecodeError, FrameDecoder, frameBytes
+
+HOST = 'localhost' # maquina onde esta o servidor
+PORT = 5000        # porta que o servidor esta escutando
+
+READ_SIZE = 64 * 1024 # quantidade maxima de bytes lidos de uma vez da conexao (API asyncio)
+
+RESPONSE_TIMEOUT = 10.0 # tempo maximo, em segundos, aguardando a resposta de uma entrada ou saida
+
+# tipo do evento entregue aos assinantes quando a conexao com o servidor termina (nao trafega na rede)
+CONNECTION_CLOSED = 'connection-closed'
+
+# respostas aguardadas por join() e leave()
+RESPONSES = ('connection-response', 'disconnection-response')
+
+class SessionError(Exception):
+    '''Falha na sessao: conexao encerrada ou resposta nao recebida dentro do tempo limite'''
+
+class Session:
+    '''Estado e mensagens do protocolo de bate-papo, comuns as APIs sincrona (ChatClient) e
+    asyncio (AsyncChatClient): montagem das requisicoes, troca do codec negociado e entrega
+    das mensagens recebidas aos assinantes. Nao depende de interface grafica.
+
+    O connection-request e sempre enviado em JSON e pode pedir o codec 'codec' para o restante
+    da sessao; o codec confirmado pelo servidor passa a ser usado depois do connection-response,
+    e a conexao volta a JSON depois do disconnection-response.
+
+    Com 'presence', a sessao pede a presenca versionada: as listas de membros chegam em paginas
+    (requestPresence(after=...)) e as entradas e saidas, agrupadas em presence-delta, no lugar
+    de user-joined e user-left'''
+
+    def __init__(self, host=HOST, port=PORT, codec=JSON_CODEC.name, batch=True, presence=False):
+        self.host = host
+        self.port = port
+        self.requestedCodec = codec
+        self.batch = batch
+        self.presence = presence
+
+        # codec em uso na conexao: JSON ate o servidor confirmar o codec negociado
+        self.codec = JSON_CODEC
+
+        self.decoder = FrameDecoder()
+
+        # nome e sala do usuario, enquanto estiver no bate-papo
+        self.name = None
+        self.room = None
+
+        # tipo de mensagem (None: todas) -> funcoes chamadas com cada mensagem recebida
+        self.subscribers = {}
+
+    def subscribe(self, msgType, callback):
+        '''Registra 'callback', chamada com o objeto de cada mensagem recebida do tipo 'msgType'
+        (None: de todos os tipos). As funcoes sao chamadas na thread (ChatClient) ou no loop
+        (AsyncChatClient) de recebimento, na ordem de chegada das mensagens'''
+
+        self.subscribers.setdefault(msgType, []).append(callback)
+
+    def unsubscribe(self, msgType, callback):
+        self.subscribers.get(msgType, []).remove(callback)
+
+    def dispatch(self, msgObject):
+        '''Atualiza o estado da sessao com a mensagem recebida 'msgObject' e a entrega aos assinantes'''
+
+        msgType = msgObject.get('type')
+
+        if msgType == 'connection-response' and msgObject.get('success'):
+
+            # passa a usar o codec confirmado pelo servidor (servidores antigos nao o informam)
+            self.codec = CODECS.get(msgObject.get('codec'), JSON_CODEC)
+
+            # sala em que o usuario entrou (servidores sem salas nao a informam)
+            self.room = msgObject.get('room', 'geral')
+
+        elif msgType == 'room-joined':
+            self.room = msgObject['room']
+
+        elif msgType == 'disconnection-response':
+
+            # fim da sessao: o proximo connection-request volta a ser JSON
+            self.codec = JSON_CODEC
+            self.name = None
+            self.room = None
+
+        # verificacao de atividade do servidor: respondida aqui, sem chegar aos assinantes
+        elif msgType == 'ping':
+            self.send({"type": "pong"})
+            return
+
+        for callback in self.subscribers.get(msgType, []) + self.subscribers.get(None, []):
+            callback(msgObject)
+
+    def decodeFrames(self):
+        '''Decodifica e entrega as mensagens completas ja recebidas
+        Saida: lista das respostas aguardadas por join() / leave() entre elas'''
+
+        responses = []
+
+        for frame in self.decoder.frames():
+            try:
+                msgObject = self.codec.decode(frame)
+            except DecodeError:
+                continue
+
+            # o codec e trocado no dispatch, antes de decodificar a mensagem seguinte
+            self.dispatch(msgObject)
+
+            if msgObject.get('type') in RESPONSES:
+                responses.append(msgObject)
+
+        return responses
+
+    def encode(self, msgObject):
+        return frameBytes(self.codec.encode(msgObject))
+
+    # estado de uma nova conexao: nada recebido, codec JSON, fora do bate-papo
+    def resetConnection(self):
+        self.decoder = FrameDecoder()
+        self.codec = JSON_CODEC
+        self.name = None
+        self.room = None
+
+    def joinRequest(self, name, room=None):
+        self.name = name
+
+        msgObject = {
+            "type": "connection-request",
+            "name": name,
+            "codec": self.requestedCodec,
+            "batch": self.batch, # o decodificador de mensagens entende lotes
+            "presence": self.presence,
+            "heartbeat": True # os pings do servidor sao respondidos por dispatch
+        }
+
+        if room is not None:
+            msgObject['room'] = room
+
+        return msgObject
+
+    # envios: send() e implementado por ChatClient e AsyncChatClient
+
+    def sendPublic(self, text):
+        self.sendChat(text, None)
+
+    def sendPrivate(self, receiver, text):
+        self.sendChat(text, receiver)
+
+    def sendChat(self, text, receiver):
+        self.send({
+            "type": "chat-message",
+            "private": receiver is not None,
+            "sender": self.name,
+            "receiver": receiver,
+            "message": text
+        })
+
+    def joinRoom(self, room):
+        self.send({"type": "room-join", "room": room})
+
+    def leaveRoom(self):
+        self.send({"type": "room-leave"})
+
+    def listRooms(self):
+        self.send({"type": "room-list"})
+
+    def requestHistory(self, limit):
+        self.send({"type": "history-request", "limit": limit})
+
+    def requestPresence(self, since=None, after=None):
+        '''Pede a presenca da sala atual: as mudancas posteriores a versao 'since' ou, se elas nao
+        estiverem mais disponiveis no servidor, a primeira pagina da lista de membros; sem 'since',
+        a pagina seguinte ao nome 'after' (a primeira se None)'''
+
+        msgObject = {"type": "presence-request"}
+
+        if since is not None:
+            msgObject['since'] = since
+
+        if after is not None:
+            msgObject['after'] = after
+
+        self.send(msgObject)
+
+class ChatClient(Session):
+    '''Cliente de bate-papo com API sincrona: uma thread le as mensagens do servidor e as entrega
+    aos assinantes (subscribe), e join() / leave() bloqueiam ate a resposta do servidor'''
+
+    def __init__(self, host=HOST, port=PORT, codec=JSON_CODEC.name, batch=True, presence=False):
+        super().__init__(host, port, codec, batch, presence)
+
+        self.socket = None
+        self.receiver = None
+
+        # protege o envio, ja que mensagens podem ser enviadas por mais de uma thread
+        self.sendLock = threading.Lock()
+
+        # connection-response / disconnection-response recebidos, aguardados por join() / leave()
+        self.responses = queue.Queue()
+
+    def connect(self):
+        '''Conecta-se ao servidor e inicia a thread de recebimento (tambem depois de close(),
+        com uma nova conexao)'''
+
+        self.resetConnection()
+
+        # respostas de uma conexao anterior nao respondem aos pedidos desta
+        self.responses = queue.Queue()
+
+        self.socket = socket.create_connection((self.host, self.port))
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        self.receiver = threading.Thread(target=self.receiveLoop, args=(self.socket, self.responses), daemon=True)
+        self.receiver.start()
+
+    def receiveLoop(self, sock, responses):
+        try:
+            while self.decoder.recvFrom(sock):
+                for response in self.decodeFrames():
+                    responses.put(response)
+
+        except OSError:
+            pass
+
+        # acorda quem aguarda uma resposta e avisa os assinantes
+        responses.put(None)
+        self.dispatch({"type": CONNECTION_CLOSED})
+
+    def send(self, msgObject):
+        with self.sendLock:
+            self.socket.sendall(self.encode(msgObject))
+
+    # descarta respostas que chegaram depois do tempo limite de um pedido anterior
+    def discardResponses(self):
+        while True:
+            try:
+                response = self.responses.get_nowait()
+            except queue.Empty:
+                return
+
+            # o fim da conexao continua valendo para o proximo pedido
+            if response is None:
+                self.responses.put(None)
+                return
+
+    def waitResponse(self, timeout):
+        try:
+            response = self.responses.get(timeout=timeout)
+        except queue.Empty:
+            raise SessionError('O servidor não respondeu')
+
+        if response is None:
+            raise SessionError('Conexão com o servidor encerrada')
+
+        return response
+
+    def join(self, name, room=None, timeout=RESPONSE_TIMEOUT):
+        '''Entra no bate-papo com o nome 'name', na sala 'room' (padrao do servidor se None)
+        Saida: o connection-response do servidor (campo "success" indica se a entrada foi aceita)'''
+
+        self.discardResponses()
+        self.send(self.joinRequest(name, room))
+
+        return self.waitResponse(timeout)
+
+    def leave(self, timeout=RESPONSE_TIMEOUT):
+        '''Sai do bate-papo, mantendo a conexao para uma nova entrada
+        Saida: o disconnection-response do servidor'''
+
+        self.discardResponses()
+        self.send({"type": "disconnection-request"})
+
+        return self.waitResponse(timeout)
+
+    def close(self):
+        '''Encerra a conexao; connect() pode abrir uma nova em seguida'''
+
+        if self.socket is not None:
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+            self.socket.close()
+
+        self.socket = None
+        self.receiver = None
+
+class AsyncChatClient(Session):
+    '''Cliente de bate-papo com API asyncio: uma tarefa le as mensagens do servidor e as entrega
+    aos assinantes (subscribe), e join() / leave() aguardam a resposta do servidor. Os envios
+    apenas escrevem no transporte; drain() aguarda o esvaziamento do buffer de escrita'''
+
+    def __init__(self, host=HOST, port=PORT, codec=JSON_CODEC.name, batch=True, presence=False):
+        super().__init__(host, port, codec, batch, presence)
+
+        self.reader = None
+        self.writer = None
+        self.receiver = None
+
+        self.responses = asyncio.Queue()
+
+    async def connect(self):
+        '''Conecta-se ao servidor e inicia a tarefa de recebimento (tambem depois de close(),
+        com uma nova conexao)'''
+
+        self.resetConnection()
+
+        # respostas de uma conexao anterior nao respondem aos pedidos desta
+        self.responses = asyncio.Queue()
+
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.receiver = asyncio.get_running_loop().create_task(self.receiveLoop(self.reader, self.responses))
+
+    async def receiveLoop(self, reader, responses):
+        try:
+            while True:
+                data = await reader.read(READ_SIZE)
+
+                if not data:
+                    break
+
+                self.decoder.feed(data)
+
+                for response in self.decodeFrames():
+                    responses.put_nowait(response)
+
+        except OSError:
+            pass
+
+        responses.put_nowait(None)
+        self.dispatch({"type": CONNECTION_CLOSED})
+
+    def send(self, msgObject):
+        self.writer.write(self.encode(msgObject))
+
+    async def drain(self):
+        await self.writer.drain()
+
+    # descarta respostas que chegaram depois do tempo limite de um pedido anterior
+    def discardResponses(self):
+        while not self.responses.empty():
+
+            # o fim da conexao continua valendo para o proximo pedido
+            if self.responses.get_nowait() is None:
+                self.responses.put_nowait(None)
+                return
+
+    async def waitResponse(self, timeout):
+        try:
+            response = await asyncio.wait_for(self.responses.get(), timeout)
+        except asyncio.TimeoutError:
+            raise SessionError('O servidor não respondeu')
+
+        if response is None:
+            raise SessionError('Conexão com o servidor encerrada')
+
+        return response
+
+    async def join(self, name, room=None, timeout=RESPONSE_TIMEOUT):
+        '''Entra no bate-papo com o nome 'name', na sala 'room' (padrao do servidor se None)
+        Saida: o connection-response do servidor (campo "success" indica se a entrada foi aceita)'''
+
+        self.discardResponses()
+        self.send(self.joinRequest(name, room))
+
+        return await self.waitResponse(timeout)
+
+    async def leave(self, timeout=RESPONSE_TIMEOUT):
+        '''Sai do bate-papo, mantendo a conexao para uma nova entrada
+        Saida: o disconnection-response do servidor'''
+
+        self.discardResponses()
+        self.send({"type": "disconnection-request"})
+
+        return await self.waitResponse(timeout)
+
+    async def close(self):
+        '''Encerra a conexao; connect() pode abrir uma nova em seguida'''
+
+        if self.writer is not None:
+            self.writer.close()
+
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+
+        self.reader = None
+        self.writer = None
+        self.receiver = None
@@ -0,0 +1,78 @@
+import math
+import threading
+
+TICK = 1.0 # duracao, em segundos, de cada posicao da roda
+
+SLOTS = 64 # quantidade de posicoes da roda
+
+class TimerWheel:
+    '''Roda de temporizadores: os prazos sao agrupados em posicoes de 'tick' segundos de uma
+    lista circular de 'slots' posicoes (prazos alem de uma volta ficam na posicao e sao ignorados
+    nas voltas anteriores). Agendar e cancelar custam tempo constante, e avancar a roda custa o
+    numero de posicoes percorridas mais o de prazos nelas, independente da quantidade de
+    temporizadores agendados; os prazos sao arredondados para o fim da sua posicao.
+
+    Cada chave tem no maximo um prazo: agendar de novo substitui o anterior. Usada por mais de
+    uma thread, protegida por um lock'''
+
+    def __init__(self, now, tick=TICK, slots=SLOTS):
+        self.tick = tick
+
+        # chaves de cada posicao e posicao absoluta (em ticks) do prazo de cada chave
+        self.slots = [set() for _ in range(slots)]
+        self.deadlines = {}
+
+        # ultima posicao ja percorrida
+        self.current = math.floor(now / tick)
+
+        self.lock = threading.Lock()
+
+    def schedule(self, key, when):
+        '''Agenda 'key' para expirar no instante 'when' (no relogio usado em advance)'''
+
+        with self.lock:
+            self.remove(key)
+
+            position = max(math.ceil(when / self.tick), self.current + 1)
+
+            self.deadlines[key] = position
+            self.slots[position % len(self.slots)].add(key)
+
+    def cancel(self, key):
+        with self.lock:
+            self.remove(key)
+
+    # retira o prazo de 'key', caso exista (chamada sob o lock)
+    def remove(self, key):
+        position = self.deadlines.pop(key, None)
+
+        if position is not None:
+            self.slots[position % len(self.slots)].discard(key)
+
+    def advance(self, now):
+        '''Avanca a roda ate o instante 'now'
+        Saida: lista das chaves cujo prazo expirou (seus prazos sao retirados da roda)'''
+
+        expired = []
+
+        with self.lock:
+            target = math.floor(now / self.tick)
+
+            # depois de uma pausa maior que uma volta, cada posicao e percorrida uma unica vez
+            if target - self.current > len(self.slots):
+                self.current = target - len(self.slots)
+
+            while self.current < target:
+                self.current += 1
+
+                slot = self.slots[self.current % len(self.slots)]
+
+                for key in [key for key in slot if self.deadlines[key] <= self.current]:
+                    slot.remove(key)
+                    del self.deadlines[key]
+                    expired.append(key)
+
+        return expired
+
+    def __len__(self):
+        return len(self.deadlines)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# os modulos do servidor e do cliente ficam na raiz do repositorio, fora de um pacote
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
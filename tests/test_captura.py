@@ -0,0 +1,44 @@
+import os
+import time
+
+from captura import Capture
+from protocolo import HEADER
+from reproducao import readRecords
+
+def records(directory):
+    '''(conexao, tamanho da mensagem enquadrada) dos registros ja escritos nos arquivos da captura'''
+
+    result = []
+
+    for name in sorted(os.listdir(directory)):
+        result.extend((connectionId, len(frame)) for _, (_, connectionId), frame in readRecords(os.path.join(directory, name)))
+
+    return result
+
+def test_flushWritesBufferedRecords(tmp_path):
+    capture = Capture(tmp_path, flushInterval=3600)
+    capture.record(1, b'{"type": "ping"}')
+    capture.recordClose(1)
+
+    # os registros ficam no buffer ate serem escritos
+    assert records(tmp_path) == []
+
+    capture.flush()
+    assert records(tmp_path) == [(1, HEADER.size + 16), (1, 0)]
+
+    capture.close()
+    capture.close()
+
+def test_periodicFlush(tmp_path):
+    capture = Capture(tmp_path, flushInterval=0.01)
+    capture.record(7, b'{}')
+
+    # sem close(): a thread da captura escreve o buffer sozinha
+    deadline = time.monotonic() + 2
+
+    while not records(tmp_path) and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert records(tmp_path) == [(7, HEADER.size + 2)]
+
+    capture.close()
@@ -0,0 +1,98 @@
+import os
+
+from historico import SEGMENT_SUFFIX, History
+
+def message(room, text):
+    return {"type": "chat-message", "private": False, "sender": "ana", "receiver": None, "message": text, "room": room}
+
+def fill(directory, messages, **options):
+    '''Grava as mensagens (sala, texto) em um novo historico e o encerra
+    Saida: os identificadores atribuidos'''
+
+    history = History(directory, commitInterval=0, **options)
+    ids = [history.append(room, message(room, text)) for room, text in messages]
+    history.close()
+
+    return ids
+
+def segments(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX))
+
+def texts(messages):
+    return [msgObject['message'] for msgObject in messages]
+
+def test_lastAndSince(tmp_path):
+    ids = fill(tmp_path, [('geral', f'g{i}') for i in range(5)] + [('outra', 'o0'), ('geral', 'g5')])
+
+    assert ids == list(range(1, 8))
+
+    history = History(tmp_path, commitInterval=0)
+
+    try:
+        assert texts(history.last('geral', 3)) == ['g3', 'g4', 'g5']
+        assert texts(history.last('outra', 10)) == ['o0']
+        assert history.last('vazia', 10) == []
+        assert history.last('geral', 0) == []
+
+        # a mensagem da outra sala (id 6) nao aparece entre as da sala geral
+        assert texts(history.since('geral', 4, 10)) == ['g4', 'g5']
+        assert texts(history.since('geral', 0, 2)) == ['g0', 'g1']
+        assert history.since('geral', 7, 10) == []
+
+        assert [msgObject['id'] for msgObject in history.last('geral', 2)] == [5, 7]
+
+    finally:
+        history.close()
+
+def test_appendContinuesNumbering(tmp_path):
+    fill(tmp_path, [('geral', 'a'), ('geral', 'b')])
+
+    assert fill(tmp_path, [('geral', 'c')]) == [3]
+
+def test_recoveryDiscardsTruncatedTail(tmp_path):
+    fill(tmp_path, [('geral', f'm{i}') for i in range(3)])
+
+    # queda durante a escrita: header e parte do corpo de uma quarta mensagem
+    path = os.path.join(tmp_path, segments(tmp_path)[-1])
+    size = os.path.getsize(path)
+
+    with open(path, 'ab') as file:
+        file.write(b'\x00\x00\x01\x00{"type": "chat-')
+
+    history = History(tmp_path, commitInterval=0)
+
+    try:
+        assert texts(history.last('geral', 10)) == ['m0', 'm1', 'm2']
+        assert os.path.getsize(path) == size
+
+        # a proxima mensagem e gravada logo apos a ultima completa
+        assert history.append('geral', message('geral', 'm3')) == 4
+
+    finally:
+        history.close()
+
+    history = History(tmp_path, commitInterval=0)
+
+    try:
+        assert texts(history.last('geral', 10)) == ['m0', 'm1', 'm2', 'm3']
+    finally:
+        history.close()
+
+def test_segmentRotation(tmp_path):
+    ids = fill(tmp_path, [('geral', f'mensagem {i}') for i in range(20)], segmentSize=300)
+
+    # cada segmento e nomeado pelo identificador da sua primeira mensagem
+    names = segments(tmp_path)
+
+    assert len(names) > 1
+    assert names[0] == f'{1:020d}{SEGMENT_SUFFIX}'
+
+    history = History(tmp_path, segmentSize=300, commitInterval=0)
+
+    try:
+        # leituras que atravessam segmentos
+        assert texts(history.last('geral', 20)) == [f'mensagem {i}' for i in range(20)]
+        assert [msgObject['id'] for msgObject in history.since('geral', 3, 15)] == ids[3:18]
+
+    finally:
+        history.close()
@@ -0,0 +1,108 @@
+import servidor
+from servidor import DEFAULT_ROOM, Room, SessionRegistry
+
+def record(room, events):
+    '''Registra na sala as mudancas (nome, se entrou), com versoes consecutivas a partir da atual'''
+
+    for name, joined in events:
+        room.recordPresence(room.version + 1, name, ('127.0.0.1', 5000), joined)
+
+def test_changesSince():
+    room = Room('geral')
+    record(room, [('ana', True), ('bia', True), ('caio', True)])
+
+    assert room.version == 3
+    assert [(name, joined) for name, joined, _ in room.changesSince(1)] == [('bia', True), ('caio', True)]
+    assert room.changesSince(3) == []
+
+    # versao futura: o cliente nao pode ter visto essa presenca
+    assert room.changesSince(4) is None
+
+def test_changesCoalescedPerName():
+    room = Room('geral')
+    record(room, [('ana', True), ('bia', True)])
+
+    # a saida de ana substitui a sua entrada: uma unica mudanca por nome
+    record(room, [('ana', False)])
+
+    assert [(name, joined) for name, joined, _ in room.changesSince(0)] == [('bia', True), ('ana', False)]
+    assert [(name, joined) for name, joined, _ in room.changesSince(2)] == [('ana', False)]
+    assert room.names == ['bia']
+
+def test_floorAfterLogOverflow(monkeypatch):
+    monkeypatch.setattr(servidor, 'PRESENCE_LOG_SIZE', 3)
+
+    room = Room('geral', version=10)
+    record(room, [(name, True) for name in ['a', 'b', 'c']])
+
+    assert room.floor == 10
+    assert len(room.changesSince(10)) == 3
+
+    # a quarta mudanca descarta a mais antiga (versao 11): a partir dela, e preciso uma nova lista
+    record(room, [('d', True)])
+
+    assert room.floor == 11
+    assert room.changesSince(10) is None
+    assert [name for name, _, _ in room.changesSince(11)] == ['b', 'c', 'd']
+
+def test_paging():
+    room = Room('geral')
+    names = [f'usuario{i:02d}' for i in range(25)]
+    record(room, [(name, True) for name in reversed(names)])
+
+    pages = []
+    after = None
+
+    while True:
+        users, after = room.page(after, 10)
+        pages.append([name for name, _ in users])
+
+        if after is None:
+            break
+
+    # paginas em ordem de nome, sem repeticoes, e a ultima sem continuacao
+    assert [len(page) for page in pages] == [10, 10, 5]
+    assert sum(pages, []) == names
+
+def test_pagingExactMultiple():
+    room = Room('geral')
+    record(room, [('ana', True), ('bia', True)])
+
+    users, following = room.page(None, 2)
+
+    assert [name for name, _ in users] == ['ana', 'bia']
+    assert following is None
+    assert room.page('bia', 2) == ([], None)
+
+class FakeConnection:
+    '''Conexao sem socket: apenas o estado usado pelo registro'''
+
+    def __init__(self, port):
+        self.address = ('127.0.0.1', port)
+        self.name = None
+        self.room = None
+
+def test_secondJoinRejected():
+    registry = SessionRegistry()
+    connection = FakeConnection(5000)
+    registry.add(connection)
+
+    assert registry.join(connection, 'alice', DEFAULT_ROOM)
+
+    # um segundo connection-request na mesma conexao nao ocupa outro nome nem outra sala
+    assert not registry.join(connection, 'alice2', 'x')
+    assert connection.name == 'alice' and connection.room == DEFAULT_ROOM
+    assert registry.onlineCount() == 1
+    assert 'x' not in registry.rooms
+
+    # depois da saida, o nome e o lugar na sala ficam livres
+    assert registry.leave(connection) == ('alice', DEFAULT_ROOM)
+    registry.remove(connection)
+
+    assert registry.onlineCount() == 0
+    assert registry.rooms[DEFAULT_ROOM].isEmpty()
+
+    other = FakeConnection(5001)
+    registry.add(other)
+
+    assert registry.join(other, 'alice', DEFAULT_ROOM)
@@ -0,0 +1,219 @@
+import socket
+
+import pytest
+
+from protocolo import (BATCH_FLAG, BUFFER_SIZE, CODECS, FIELD_TAGS, HEADER, JSON_CODEC, LIST, MAP, MAX_DEPTH, STR8, TYPE_TAGS,
+                       UINT16, UINT32, UNKNOWN_FIELD, BinaryCodec, DecodeError, FrameDecoder, FrameTooLargeError,
+                       MsgpackCodec, frameBatch, frameMessage)
+
+def test_frameSplitAcrossReads():
+    decoder = FrameDecoder()
+    frame = bytes(frameMessage('{"type": "ping"}'))
+
+    # header e corpo chegam aos pedacos: a mensagem so e entregue quando completa
+    for position in range(len(frame) - 1):
+        decoder.feed(frame[position:position + 1])
+        assert decoder.nextFrame() is None
+
+    decoder.feed(frame[-1:])
+
+    assert bytes(decoder.nextFrame()) == b'{"type": "ping"}'
+    assert decoder.nextFrame() is None
+
+def test_severalFramesInOneRead():
+    decoder = FrameDecoder()
+    messages = [f'mensagem {i}' for i in range(10)]
+
+    # as dez mensagens e o inicio de mais uma chegam em uma unica leitura
+    data = b''.join(bytes(frameMessage(message)) for message in messages)
+    partial = bytes(frameMessage('ultima'))
+    decoder.feed(data + partial[:5])
+
+    assert [bytes(frame).decode() for frame in decoder.frames()] == messages
+
+    decoder.feed(partial[5:])
+
+    assert [bytes(frame) for frame in decoder.frames()] == [b'ultima']
+
+def test_recvFromSocket():
+    left, right = socket.socketpair()
+
+    try:
+        left.sendall(bytes(frameMessage('a')) + bytes(frameMessage('bc')))
+
+        decoder = FrameDecoder()
+
+        assert decoder.recvFrom(right) > 0
+        assert [bytes(frame) for frame in decoder.frames()] == [b'a', b'bc']
+
+        # conexao encerrada pelo outro lado
+        left.close()
+
+        assert decoder.recvFrom(right) == 0
+
+    finally:
+        left.close()
+        right.close()
+
+def test_frameLargerThanBuffer():
+    decoder = FrameDecoder()
+    body = b'x' * (BUFFER_SIZE * 5)
+
+    frame = bytes(frameMessage(body.decode()))
+    decoder.feed(frame[:BUFFER_SIZE])
+    decoder.feed(frame[BUFFER_SIZE:])
+
+    assert bytes(decoder.nextFrame()) == body
+
+def test_bufferAllocatedLazilyAndReleased():
+    decoder = FrameDecoder()
+
+    # conexao ociosa: nenhum buffer alocado
+    assert len(decoder.buffer) == 0
+
+    decoder.feed(bytes(frameMessage('oi')))
+    assert len(decoder.buffer) == BUFFER_SIZE
+    assert bytes(decoder.nextFrame()) == b'oi'
+
+    # uma mensagem grande aumenta o buffer, que e liberado depois que ela e consumida
+    decoder.feed(bytes(frameMessage('x' * BUFFER_SIZE * 4)))
+    assert len(decoder.buffer) > BUFFER_SIZE
+    assert len(decoder.nextFrame()) == BUFFER_SIZE * 4
+
+    decoder.feed(bytes(frameMessage('oi')))
+    assert len(decoder.buffer) == BUFFER_SIZE
+
+def test_batchHeaderIsTransparent():
+    frames = [frameMessage(f'm{i}') for i in range(3)]
+    batch = frameBatch(frames)
+
+    assert HEADER.unpack_from(batch)[0] == BATCH_FLAG | sum(len(frame) for frame in frames)
+
+    # lote seguido de uma mensagem avulsa, entregue aos pedacos
+    data = batch + bytes(frameMessage('avulsa'))
+    decoder = FrameDecoder()
+    received = []
+
+    for position in range(0, len(data), 3):
+        decoder.feed(data[position:position + 3])
+        received.extend(bytes(frame) for frame in decoder.frames())
+
+    assert received == [b'm0', b'm1', b'm2', b'avulsa']
+
+def test_headerCountsBytes():
+    frame = bytes(frameMessage('ação'))
+
+    # o header traz o tamanho em bytes UTF-8, e nao em caracteres
+    assert HEADER.unpack_from(frame)[0] == len('ação'.encode()) == 6
+
+    decoder = FrameDecoder()
+    decoder.feed(frame)
+
+    assert str(decoder.nextFrame(), 'utf-8') == 'ação'
+
+def test_oversizeHeaderRejectedBeforeAllocation():
+    decoder = FrameDecoder(maxFrameSize=1024)
+
+    # apenas o header de uma mensagem de 1 GiB: recusada sem reservar espaco para o corpo
+    decoder.feed(HEADER.pack(1024 * 1024 * 1024))
+
+    with pytest.raises(FrameTooLargeError) as error:
+        decoder.nextFrame()
+
+    assert error.value.size == 1024 * 1024 * 1024
+    assert error.value.limit == 1024
+    assert len(decoder.buffer) == BUFFER_SIZE
+
+def test_frameAtLimitAccepted():
+    decoder = FrameDecoder(maxFrameSize=16)
+    decoder.feed(bytes(frameMessage('x' * 16)))
+
+    assert bytes(decoder.nextFrame()) == b'x' * 16
+
+# mensagem com valores de todos os tipos do codec binario e um campo fora da sua tabela ('ratio')
+SAMPLE = {
+    "type": "chat-message",
+    "sender": "ana",
+    "receiver": None,
+    "private": False,
+    "message": "olá " * 100,
+    "id": 2 ** 40,
+    "port": -5,
+    "ratio": 0.25,
+    "members": [{"name": "bia", "host": "127.0.0.1", "port": 5000}, True, []],
+}
+
+@pytest.mark.parametrize('msgObject', [SAMPLE, {"type": "tipo-novo", "campo": 1}, {"sem": "tipo"}])
+def test_binaryRoundTrip(msgObject):
+    codec = BinaryCodec()
+
+    assert codec.decode(codec.encode(msgObject)) == msgObject
+
+def test_binaryIsSmallerThanJson():
+    assert len(BinaryCodec().encode(SAMPLE)) < len(JSON_CODEC.encode(SAMPLE))
+
+def test_msgpackRoundTrip():
+    pytest.importorskip('msgpack')
+
+    codec = MsgpackCodec()
+
+    assert codec.decode(codec.encode(SAMPLE)) == SAMPLE
+
+    with pytest.raises(DecodeError):
+        codec.decode(codec.encode([1, 2]))
+
+    with pytest.raises(DecodeError):
+        codec.decode(b'\xc1')
+
+# inicio de uma mensagem binaria chat-message com um unico campo, seguido do identificador do campo
+CHAT_ONE_FIELD = bytes([TYPE_TAGS['chat-message'], MAP]) + UINT16.pack(1)
+
+def nested(depth):
+    '''Saida: corpo binario de uma mensagem com 'depth' listas aninhadas no campo "members" (a mais interna vazia)'''
+
+    value = (bytes([LIST]) + UINT32.pack(1)) * (depth - 1) + bytes([LIST]) + UINT32.pack(0)
+    return CHAT_ONE_FIELD + bytes([FIELD_TAGS['members']]) + value
+
+@pytest.mark.parametrize('payload', [
+    b'',                                                        # vazio
+    CHAT_ONE_FIELD[:1],                                         # sem o mapa de campos
+    BinaryCodec().encode(SAMPLE)[:-3],                          # truncado
+    BinaryCodec().encode(SAMPLE) + b'\x00',                     # bytes apos o valor
+    b'\xee' + BinaryCodec().encode({})[1:],                     # tipo de mensagem desconhecido
+    CHAT_ONE_FIELD + b'\xee\x00',                                # identificador de campo desconhecido
+    CHAT_ONE_FIELD + b'\x01\x63',                                # marcador de valor desconhecido
+    CHAT_ONE_FIELD + b'\x01' + bytes([STR8, 2]) + b'\xff\xfe',     # UTF-8 invalido
+    CHAT_ONE_FIELD + bytes([UNKNOWN_FIELD]) + b'\x00\x00',         # nome de campo que nao e string
+    CHAT_ONE_FIELD[:1] + bytes([LIST]) + UINT32.pack(0),        # valor mais externo que nao e um mapa
+    nested(MAX_DEPTH),                                          # aninhamento alem do limite (com o mapa externo)
+])
+def test_binaryMalformed(payload):
+    with pytest.raises(DecodeError):
+        BinaryCodec().decode(payload)
+
+def test_binaryNestingLimit():
+    value = BinaryCodec().decode(nested(MAX_DEPTH - 1))['members']
+    depth = 1
+
+    while value:
+        value = value[0]
+        depth += 1
+
+    assert depth == MAX_DEPTH - 1
+
+@pytest.mark.parametrize('payload', [b'[]', b'"texto"', b'1', b'null', b'{', b'\xff', b'[' * 100000])
+def test_jsonMalformed(payload):
+    with pytest.raises(DecodeError):
+        JSON_CODEC.decode(payload)
+
+# uma lista vazia no lugar do objeto da mensagem, em cada codec
+EMPTY_LISTS = {
+    'json': b'[]',
+    'binary': b'\x00' + bytes([LIST]) + UINT32.pack(0),
+    'msgpack': b'\x90',
+}
+
+@pytest.mark.parametrize('name', sorted(CODECS))
+def test_everyCodecRejectsNonObjects(name):
+    with pytest.raises(DecodeError):
+        CODECS[name].decode(EMPTY_LISTS[name])
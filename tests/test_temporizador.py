@@ -0,0 +1,85 @@
+import servidor
+from temporizador import TimerWheel
+
+def test_advanceExpiresDueKeys():
+    wheel = TimerWheel(0, tick=1.0, slots=8)
+    wheel.schedule('a', 2.0)
+    wheel.schedule('b', 3.5)
+
+    assert wheel.advance(1.5) == []
+    assert wheel.advance(2.0) == ['a']
+
+    # prazos sao arredondados para o fim da sua posicao
+    assert wheel.advance(3.9) == []
+    assert wheel.advance(4.0) == ['b']
+    assert len(wheel) == 0
+
+def test_cancel():
+    wheel = TimerWheel(0, tick=1.0, slots=8)
+    wheel.schedule('a', 2.0)
+    wheel.schedule('b', 2.0)
+    wheel.cancel('a')
+    wheel.cancel('inexistente')
+
+    assert wheel.advance(5.0) == ['b']
+
+def test_rescheduleReplacesDeadline():
+    wheel = TimerWheel(0, tick=1.0, slots=8)
+    wheel.schedule('a', 2.0)
+    wheel.schedule('a', 5.0)
+
+    assert len(wheel) == 1
+    assert wheel.advance(4.0) == []
+    assert wheel.advance(5.0) == ['a']
+
+def test_deadlineBeyondOneTurn():
+    wheel = TimerWheel(0, tick=1.0, slots=4)
+    wheel.schedule('a', 10.0)
+
+    # a chave fica na posicao 10 % 4 e e ignorada nas voltas anteriores
+    assert wheel.advance(6.0) == []
+    assert wheel.advance(9.0) == []
+    assert wheel.advance(10.0) == ['a']
+
+def test_pastDeadlineExpiresOnNextTick():
+    wheel = TimerWheel(10.0, tick=1.0, slots=8)
+    wheel.schedule('a', 3.0)
+
+    assert wheel.advance(11.0) == ['a']
+
+def test_longPause():
+    wheel = TimerWheel(0, tick=1.0, slots=4)
+    wheel.schedule('a', 2.0)
+    wheel.schedule('b', 3.0)
+
+    # depois de uma pausa de varias voltas, todos os prazos vencidos expiram de uma vez
+    assert sorted(wheel.advance(100.0)) == ['a', 'b']
+    assert len(wheel) == 0
+
+class FakeConnection:
+    '''Conexao com apenas o estado usado na verificacao de atividade'''
+
+    def __init__(self, name=None, heartbeat=False):
+        self.name = name
+        self.heartbeat = heartbeat
+        self.lastActivity = 100.0
+        self.outsideSince = 50.0
+
+def test_nextCheckByConnectionState(monkeypatch):
+    monkeypatch.setattr(servidor, 'JOIN_TIMEOUT', 10.0)
+    monkeypatch.setattr(servidor, 'PING_INTERVAL', 15.0)
+    monkeypatch.setattr(servidor, 'IDLE_TIMEOUT', 45.0)
+
+    # fora do bate-papo, o prazo de entrada conta a partir da aceitacao (ou saida), e nao da atividade
+    assert servidor.nextCheck(FakeConnection()) == 60.0
+
+    # no bate-papo, apenas quem responde a pings os recebe; os demais sao apenas desconectados quando ociosos
+    assert servidor.nextCheck(FakeConnection('ana', heartbeat=True)) == 115.0
+    assert servidor.nextCheck(FakeConnection('ana')) == 145.0
+
+def test_nextCheckDisabled(monkeypatch):
+    monkeypatch.setattr(servidor, 'JOIN_TIMEOUT', 0)
+    monkeypatch.setattr(servidor, 'IDLE_TIMEOUT', 0)
+
+    assert servidor.nextCheck(FakeConnection()) is None
+    assert servidor.nextCheck(FakeConnection('ana', heartbeat=True)) is None